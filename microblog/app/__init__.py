@@ -1,54 +1,70 @@
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-
 import os
-from flask_login import LoginManager
-from flask_openid import OpenID
-from config import basedir, ADMINS, MAIL_SERVER, MAIL_PORT, MAIL_USERNAME, MAIL_PASSWORD
+import time
 
-app = Flask(__name__)
-"""
-If you are wondering why the import statement is at the end and not at the beginning of the script as it is always done, 
-the reason is to avoid circular references, because you are going to see that the views module needs to import the app 
-variable defined in this script. Putting the import at the end avoids the circular import error.
-"""
-app.config.from_object('config')
-# Initialize database
-db = SQLAlchemy(app)
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
 
 """
-The views are the handlers that respond to requests from web browsers or other clients. 
-In Flask handlers are written as Python functions. Each view function is mapped to one or more request URLs.
+The database is created here without an application, and create_app() below binds it to one, together with the other extensions
+(they live in app/extensions.py). Importing the app package is then cheap: it does not build an application, does not touch the tmp
+directory and does not import the extensions, the views, the forms, Flask-Login or Flask-OpenID. A script that only needs the models
+(db_migrate.py, for example) imports app.models and stops there, and the tests build one application with their own configuration
+instead of patching the settings of a global one.
 """
-lm = LoginManager()
-lm.init_app(app)
-lm.login_view = 'login'
-oid = OpenID(app, os.path.join(basedir, 'tmp'))
+db = SQLAlchemy()
 
 
-if not app.debug:
-    import logging
-    from logging.handlers import SMTPHandler, RotatingFileHandler
+def create_app(config='config'):
     """
-    The log file will go to our tmp directory, with name microblog.log. We are using the RotatingFileHandler so that there is a limit to the amount of logs that are generated. In this case we are limiting the size of a log file to one megabyte, and we will keep the last ten log files as backups.
+    Builds the application. The configuration is read from the config module, and config can name another module or object to
+    load instead, or be a dictionary of settings that are applied on top of the config module.
+    """
+    started = time.time()
+    from .extensions import sqlite_profile, changes, last_seen, identity_cache, fragments, nicknames, compression, post_writer, \
+        avatars, querycount, metrics, log_pipeline
+    app = Flask(__name__)
+    app.config.from_object('config')
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config != 'config':
+        app.config.from_object(config)
+    # Initialize database
+    sqlite_profile.init_app(app, db)
+    db.init_app(app)
+    changes.init_app(app, db)
+    last_seen.init_app(app)
+    identity_cache.init_app(app)
+    fragments.init_app(app)
+    nicknames.init_app(app)
+    compression.init_app(app)
+    post_writer.init_app(app)
+    avatars.init_app(app)
+    querycount.init_app(app)
+    metrics.init_app(app)
+    metrics.gauge('microblog_nickname_index_bytes', 'Estimated memory used by the nickname index.',
+                  lambda: nicknames.stats()['memory'])
+    metrics.gauge('microblog_nickname_index_entries', 'Nicknames in the nickname index.', lambda: nicknames.stats()['size'])
+    metrics.gauge('microblog_post_queue_length', 'Posts waiting for the post writer.', lambda: post_writer.stats()['queued'])
+    metrics.gauge('microblog_avatar_cache_bytes', 'Bytes of avatar images in the disk cache.', lambda: avatars.stats()['bytes'])
 
-    The logging.Formatter class provides custom formatting for the log messages. Since these messages are going to a file, we want them to have as much information as possible, so we write a timestamp, the logging level and the file and line number where the message originated in addition to the log message and the stack trace.
+    """
+    The views are the handlers that respond to requests from web browsers or other clients. In Flask handlers are written as Python functions. Each view function is mapped to one or more request URLs.
 
-    To make the logging more useful, we are lowering the logging level, both in the app logger and the file logger handler, as this will give us the opportunity to write useful messages to the log without having to call them errors. As an example, we start by logging the application start up as an informational level. From now on, each time you start the application without debugging the log will record the event.
+    They live in the main blueprint, which also sets up Flask-Login and Flask-OpenID when it is registered. The views module is only imported here, the first time an application is built, so neither it nor the packages it needs are loaded by the scripts that never build one.
     """
-    file_handler = RotatingFileHandler('tmp/microblog.log', 'a', 1 * 1024 * 1024, 10)
-    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-    app.logger.setLevel(logging.INFO)
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-    app.logger.info('microblog startup')
-
-    credentials = None
-    if MAIL_USERNAME or MAIL_PASSWORD:
-        credentials = (MAIL_USERNAME, MAIL_PASSWORD)
-    mail_handler = SMTPHandler((MAIL_SERVER, MAIL_PORT), 'no-reply@', MAIL_SERVER, ADMINS, 'microblog failure', credentials)
-    mail_handler.setLevel(logging.ERROR)
-    app.logger.addHandler(mail_handler)
-
-
-from app import views, models
+    from .views import bp
+    app.register_blueprint(bp)
+
+    if not app.debug and not app.testing:
+        """
+        The log file will go to our tmp directory, with name microblog.log. We are using the RotatingFileHandler so that there is a limit to the amount of logs that are generated. In this case we are limiting the size of a log file to one megabyte, and we will keep the last ten log files as backups.
+
+        The logging.Formatter class provides custom formatting for the log messages. Since these messages are going to a file, we want them to have as much information as possible, so we write a timestamp, the logging level and the file and line number where the message originated in addition to the log message and the stack trace.
+
+        To make the logging more useful, we are lowering the logging level, both in the app logger and the file logger handler, as this will give us the opportunity to write useful messages to the log without having to call them errors. As an example, we start by logging the application start up as an informational level, together with the time it took to build the application. From now on, each time you start the application without debugging the log will record the event.
+
+        Neither the file nor the mail handler are attached to app.logger directly any more, a request thread only puts the record in a queue and the LogPipeline writes the file and sends the error mail digests from a background thread (see app/logs.py).
+        """
+        log_pipeline.init_app(app)
+        app.logger.info('microblog startup in %.3fs', time.time() - started)
+    return app
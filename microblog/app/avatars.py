@@ -0,0 +1,377 @@
+import io
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from hashlib import sha256
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from flask import Response, abort, request
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+"""
+The avatars used to be Gravatar URLs, so every page with posts made the browser fetch a few dozen images from another site, over
+plain HTTP, and how fast they came and how long they were cached was up to Gravatar. Now User.avatar() links to /avatar/<hash>/<size>
+on our own server and the AvatarCache behind that URL serves the images from a cache on disk:
+
+- The images are stored under the SHA-256 of their bytes (AVATAR_CACHE_DIR/blobs), so an image shared by several avatars is kept
+  once. A small reference file per email hash and size (AVATAR_CACHE_DIR/refs) says which image it is.
+- When Pillow is installed the upstream (AVATAR_UPSTREAM, Gravatar by default, any server with the same URL scheme will do) is asked
+  once per user, at AVATAR_MAX_SIZE pixels, and every other size is scaled down from that image here. Without Pillow each size is
+  fetched from the upstream, which does the scaling. Entries older than AVATAR_CACHE_TTL seconds are fetched again.
+- When several requests miss the same upstream image at the same time only the first one goes to the upstream, the others wait for
+  its answer.
+- The cache keeps at most AVATAR_CACHE_MAX_BYTES bytes of images, the least recently served avatars are dropped to make room and an
+  image goes when no avatar uses it any more. Every process keeps its own account of the files, so with several workers the directory
+  can go a little over the limit, and an image another worker dropped is simply fetched again.
+- A user without a Gravatar gets a placeholder drawn from their hash, the same pattern and colour every time, and that placeholder is
+  cached like an image. When the upstream cannot be reached the placeholder (or the old image, if we have one) is served without
+  being cached, and the upstream is left alone for AVATAR_UPSTREAM_RETRY seconds.
+
+The URL stays the same when a user changes their Gravatar, so browsers may keep an avatar for AVATAR_MAX_AGE seconds and then
+revalidate it, the ETag is the hash of the image (the name it is stored under, so it is not computed again for every request).
+"""
+
+HASH = re.compile('^[0-9a-f]{32}$')
+
+EXTENSIONS = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/gif': '.gif', 'image/svg+xml': '.svg'}
+MIMETYPES = dict((extension, mimetype) for mimetype, extension in EXTENSIONS.items())
+
+Ref = namedtuple('Ref', ['digest', 'mimetype', 'mtime'])
+
+
+def placeholder(email_hash, size):
+    """
+    Draws the placeholder for email_hash, a symmetric 5x5 pattern in a colour picked from the hash, as an SVG image.
+    """
+    hue = int(email_hash[:3], 16) % 360
+    cells = []
+    for i in range(15):
+        if int(email_hash[3 + i], 16) % 2 == 0:
+            row, column = i % 5, i // 5
+            cells.append((column, row))
+            if column != 2:
+                cells.append((4 - column, row))
+    rects = ''.join('<rect x="%d" y="%d" width="1" height="1"/>' % cell for cell in sorted(cells))
+    svg = ('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="-0.5 -0.5 6 6" shape-rendering="crispEdges">'
+           '<rect x="-0.5" y="-0.5" width="6" height="6" fill="#f0f0f0"/><g fill="hsl(%d, 55%%, 55%%)">%s</g></svg>'
+           % (size, size, hue, rects))
+    return svg.encode('utf-8')
+
+
+def resize(data, size):
+    """
+    Scales the image in data to size x size pixels and returns it as a PNG.
+    """
+    image = Image.open(io.BytesIO(data)).convert('RGBA').resize((size, size), Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, 'PNG', optimize=True)
+    return out.getvalue()
+
+
+class Fetch(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.data = None
+        self.mimetype = None
+        self.cacheable = False
+        self.digest = None
+
+
+class AvatarCache(object):
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._refs = None
+        self._blobs = {}
+        self._bytes = 0
+        self._fetches = {}
+        self._down_until = 0
+        self.hits = 0
+        self.misses = 0
+        self.resized = 0
+        self.upstream_requests = 0
+        self.upstream_errors = 0
+        self.evictions = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AVATAR_UPSTREAM', 'https://www.gravatar.com/avatar/%(hash)s?d=404&s=%(size)d')
+        app.config.setdefault('AVATAR_CACHE_DIR', os.path.join(app.root_path, '..', 'tmp', 'avatars'))
+        app.config.setdefault('AVATAR_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        app.config.setdefault('AVATAR_CACHE_TTL', 7 * 24 * 3600)
+        app.config.setdefault('AVATAR_MAX_SIZE', 512)
+        app.config.setdefault('AVATAR_MAX_AGE', 24 * 3600)
+        app.config.setdefault('AVATAR_RESIZE', True)
+        app.config.setdefault('AVATAR_UPSTREAM_TIMEOUT', 3)
+        app.config.setdefault('AVATAR_UPSTREAM_RETRY', 30)
+        self.app = app
+        app.extensions['avatars'] = self
+
+    @property
+    def resizes(self):
+        return Image is not None and self.app.config['AVATAR_RESIZE']
+
+    def send(self, email_hash, size):
+        """
+        The view of /avatar/<hash>/<size>.
+        """
+        if not HASH.match(email_hash) or not 1 <= size <= self.app.config['AVATAR_MAX_SIZE']:
+            abort(404)
+        data, mimetype, cacheable, digest = self.get(email_hash, size)
+        response = Response(data, mimetype=mimetype)
+        # only an answer that was not cached has to be hashed here
+        response.set_etag(digest or sha256(data).hexdigest())
+        if cacheable:
+            response.headers['Cache-Control'] = 'public, max-age=%d' % self.app.config['AVATAR_MAX_AGE']
+        else:
+            response.headers['Cache-Control'] = 'public, no-cache'
+        return response.make_conditional(request)
+
+    def get(self, email_hash, size):
+        """
+        Returns (data, mimetype, cacheable, digest) for the avatar, digest is the SHA-256 of the image when it is in the cache and
+        None otherwise. cacheable is False when the upstream could not be asked and we are making do with a placeholder or an
+        expired image.
+        """
+        key = (email_hash, size)
+        found = self._lookup(key)
+        if found is not None and found[2]:
+            with self._lock:
+                self.hits += 1
+            return found[0], found[1], True, found[3]
+        with self._lock:
+            self.misses += 1
+        largest = self.app.config['AVATAR_MAX_SIZE']
+        if not self.resizes or size == largest:
+            result = self._fetch(key)
+        else:
+            result = self._scaled(email_hash, size)
+        if result is not None:
+            return result
+        if found is not None:
+            return found[0], found[1], False, found[3]
+        return placeholder(email_hash, size), 'image/svg+xml', False, None
+
+    def clear(self):
+        """
+        Deletes every cached file.
+        """
+        with self._lock:
+            self._load()
+            for key in self._refs:
+                self._remove(self._ref_path(key))
+            for digest, (path, size, count) in self._blobs.items():
+                self._remove(path)
+            self._refs, self._blobs, self._bytes = OrderedDict(), {}, 0
+            self._down_until = 0
+
+    def stats(self):
+        with self._lock:
+            return {'avatars': len(self._refs or ()), 'images': len(self._blobs), 'bytes': self._bytes, 'hits': self.hits,
+                    'misses': self.misses, 'resized': self.resized, 'upstream_requests': self.upstream_requests,
+                    'upstream_errors': self.upstream_errors, 'evictions': self.evictions}
+
+    def _scaled(self, email_hash, size):
+        """
+        Scales the largest size of the avatar, fetching it if needed, down to size.
+        """
+        largest = (email_hash, self.app.config['AVATAR_MAX_SIZE'])
+        source = self._lookup(largest)
+        if source is None or not source[2]:
+            source = self._fetch(largest) or source
+        if source is None:
+            return None
+        data, mimetype, cacheable = source[:3]
+        if mimetype == 'image/svg+xml':
+            data = placeholder(email_hash, size)
+        else:
+            try:
+                data, mimetype = resize(data, size), 'image/png'
+            except Exception as e:
+                self.app.logger.warning('could not resize the avatar of %s: %s', email_hash, e)
+                return None
+            with self._lock:
+                self.resized += 1
+        digest = self._store((email_hash, size), data, mimetype) if cacheable else None
+        return data, mimetype, cacheable, digest
+
+    def _fetch(self, key):
+        """
+        Asks the upstream for the avatar at key and caches the answer. Concurrent calls for the same key share one request.
+        Returns (data, mimetype, cacheable, digest), or None when the upstream could not be asked.
+        """
+        with self._lock:
+            fetch = self._fetches.get(key)
+            leader = fetch is None
+            if leader:
+                fetch = self._fetches[key] = Fetch()
+        if not leader:
+            fetch.done.wait(self.app.config['AVATAR_UPSTREAM_TIMEOUT'] + 1)
+        else:
+            try:
+                self._ask_upstream(fetch, *key)
+                if fetch.cacheable:
+                    fetch.digest = self._store(key, fetch.data, fetch.mimetype)
+            finally:
+                with self._lock:
+                    del self._fetches[key]
+                fetch.done.set()
+        if fetch.data is None:
+            return None
+        return fetch.data, fetch.mimetype, fetch.cacheable, fetch.digest
+
+    def _ask_upstream(self, fetch, email_hash, size):
+        if time.time() < self._down_until:
+            return
+        url = self.app.config['AVATAR_UPSTREAM'] % {'hash': email_hash, 'size': size}
+        with self._lock:
+            self.upstream_requests += 1
+        try:
+            with urlopen(url, timeout=self.app.config['AVATAR_UPSTREAM_TIMEOUT']) as upstream:
+                mimetype = upstream.headers.get_content_type()
+                data = upstream.read()
+        except HTTPError as e:
+            if e.code == 404:
+                # no avatar for this address, the placeholder is the answer
+                fetch.data, fetch.mimetype, fetch.cacheable = placeholder(email_hash, size), 'image/svg+xml', True
+                return
+            self._upstream_failed(url, e)
+            return
+        except Exception as e:
+            self._upstream_failed(url, e)
+            return
+        if mimetype not in EXTENSIONS:
+            self._upstream_failed(url, ValueError('unexpected content type %s' % mimetype))
+            return
+        fetch.data, fetch.mimetype, fetch.cacheable = data, mimetype, True
+
+    def _upstream_failed(self, url, error):
+        self.app.logger.warning('avatar upstream failed for %s: %s', url, error)
+        with self._lock:
+            self.upstream_errors += 1
+            self._down_until = time.time() + self.app.config['AVATAR_UPSTREAM_RETRY']
+
+    def _directory(self, *parts):
+        return os.path.join(os.path.abspath(self.app.config['AVATAR_CACHE_DIR']), *parts)
+
+    def _ref_path(self, key):
+        return self._directory('refs', key[0][:2], '%s-%d' % key)
+
+    def _blob_path(self, digest, mimetype):
+        return self._directory('blobs', digest[:2], digest + EXTENSIONS[mimetype])
+
+    def _lookup(self, key):
+        """
+        Returns (data, mimetype, fresh, digest) for the avatar at key if it is in the cache, or None.
+        """
+        with self._lock:
+            self._load()
+            ref = self._refs.get(key)
+            if ref is None:
+                return None
+            self._refs.move_to_end(key)
+        try:
+            with open(self._blob_path(ref.digest, ref.mimetype), 'rb') as f:
+                data = f.read()
+        except OSError:
+            # another worker dropped the image
+            with self._lock:
+                if self._refs.get(key) is ref:
+                    self._release(key)
+            return None
+        return data, ref.mimetype, time.time() - ref.mtime < self.app.config['AVATAR_CACHE_TTL'], ref.digest
+
+    def _load(self):
+        """
+        Reads the references that are already in the cache directory, the first time the cache is used. Called with the lock held.
+        """
+        if self._refs is not None:
+            return
+        found = []
+        for root, dirs, files in os.walk(self._directory('refs')):
+            for name in files:
+                email_hash, _, size = name.rpartition('-')
+                path = os.path.join(root, name)
+                try:
+                    size = int(size)
+                    with open(path) as f:
+                        digest, extension = os.path.splitext(f.read().strip())
+                    mtime = os.stat(path).st_mtime
+                    blob_size = os.stat(self._blob_path(digest, MIMETYPES[extension])).st_size
+                except (OSError, KeyError, ValueError):
+                    continue
+                found.append((mtime, (email_hash, size), Ref(digest, MIMETYPES[extension], mtime), blob_size))
+        found.sort(key=lambda item: item[0])
+        self._refs = OrderedDict()
+        for mtime, key, ref, blob_size in found:
+            self._refs[key] = ref
+            self._retain(ref, blob_size)
+
+    def _store(self, key, data, mimetype):
+        digest = sha256(data).hexdigest()
+        ref = Ref(digest, mimetype, time.time())
+        self._write(self._ref_path(key), (digest + EXTENSIONS[mimetype]).encode('ascii'))
+        with self._lock:
+            self._load()
+            if digest not in self._blobs:
+                # written with the lock held, so it cannot be deleted as unused before the reference below counts
+                self._write(self._blob_path(digest, mimetype), data)
+            old = self._refs.pop(key, None)
+            self._refs[key] = ref
+            self._retain(ref, len(data))
+            if old is not None:
+                self._release_image(old)
+            while self._bytes > self.app.config['AVATAR_CACHE_MAX_BYTES'] and len(self._refs) > 1:
+                self.evictions += 1
+                self._release(next(iter(self._refs)))
+        return digest
+
+    def _retain(self, ref, size):
+        blob = self._blobs.get(ref.digest)
+        if blob is None:
+            blob = self._blobs[ref.digest] = [self._blob_path(ref.digest, ref.mimetype), size, 0]
+            self._bytes += size
+        blob[2] += 1
+
+    def _release(self, key):
+        """
+        Drops the avatar at key, and its image once no other avatar uses it. Called with the lock held.
+        """
+        self._remove(self._ref_path(key))
+        self._release_image(self._refs.pop(key))
+
+    def _release_image(self, ref):
+        blob = self._blobs.get(ref.digest)
+        if blob is None:
+            return
+        blob[2] -= 1
+        if blob[2] == 0:
+            del self._blobs[ref.digest]
+            self._bytes -= blob[1]
+            self._remove(blob[0])
+
+    @staticmethod
+    def _write(path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # written next to its final name and renamed, so no request ever reads half a file
+        fd, partial = tempfile.mkstemp(dir=directory, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(partial, path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
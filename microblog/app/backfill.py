@@ -0,0 +1,95 @@
+import time
+
+from sqlalchemy import Boolean, Column, Integer, MetaData, String, Table, and_, func, inspect, select
+
+"""
+Filling a new column with one UPDATE over the whole table holds the SQLite write lock until the last row is written, and the
+application cannot save anything for as long as that takes. backfill() does the same work in small batches instead, each one a
+short transaction over a range of ids:
+
+- A batch covers the next batch_size ids of the table, so sparse ids do not make for empty batches.
+- Between two batches we sleep, at least pause seconds and long enough that the backfill holds the write lock for no more than
+  max_duty of the time, so the writes of the application get their turn even when the batches are slow.
+- The last id done is stored in the backfill_progress table in the same transaction as the batch. If the migration is interrupted,
+  running it again continues after the last committed batch, and a finished backfill is not run again.
+
+A migration that adds a derived column first makes the schema change (the application must already write the new column for new
+rows by then) and then calls backfill() with a function that fills one range of ids. Because an interrupted upgrade is run again from
+the start, the schema change has to be skipped when it is already there, column_exists() helps with that:
+
+    def fill(conn, first_id, last_id):
+        conn.execute(user.update().where(and_(user.c.id >= first_id, user.c.id <= last_id)).values(...))
+
+    def upgrade(migrate_engine):
+        post_meta.bind = migrate_engine
+        if not column_exists(migrate_engine, 'user', 'x'):
+            post_meta.tables['user'].columns['x'].create()
+        backfill(migrate_engine, '012_user_x', user, fill)
+
+The module lives in the app package because the application uses it too, the counter reconciliation in app/counters.py runs its
+batches through backfill(). Migrations import it with from app.backfill import backfill.
+"""
+
+progress_meta = MetaData()
+backfill_progress = Table('backfill_progress', progress_meta,
+    Column('name', String(length=128), primary_key=True, nullable=False),
+    Column('last_id', Integer, default=0),
+    Column('batches', Integer, default=0),
+    Column('finished', Boolean, default=False),
+)
+
+
+def column_exists(engine, table_name, column_name):
+    return column_name in [column['name'] for column in inspect(engine).get_columns(table_name)]
+
+
+def progress(engine, name):
+    """
+    Returns the (last_id, batches, finished) checkpoint of a backfill, or None if it never ran.
+    """
+    backfill_progress.create(engine, checkfirst=True)
+    return engine.execute(select([backfill_progress.c.last_id, backfill_progress.c.batches, backfill_progress.c.finished])
+                          .where(backfill_progress.c.name == name)).first()
+
+
+def backfill(engine, name, table, fill, batch_size=1000, pause=0.05, max_duty=0.5, busy_timeout=5000, log=None):
+    """
+    Calls fill(conn, first_id, last_id) for consecutive ranges of batch_size ids of table, each in its own transaction, and
+    returns the number of batches run. The ids are read once when the backfill starts, rows inserted after that are left to the
+    application.
+    """
+    checkpoint = progress(engine, name)
+    if checkpoint is not None and checkpoint.finished:
+        return 0
+    last_id, batches = (checkpoint.last_id, checkpoint.batches) if checkpoint is not None else (0, 0)
+    id_column = table.c.id
+    max_id = engine.execute(select([func.max(id_column)])).scalar()
+    run = 0
+    while max_id is not None and last_id < max_id:
+        start = time.time()
+        with engine.begin() as conn:
+            if engine.dialect.name == 'sqlite':
+                conn.execute('PRAGMA busy_timeout = %d' % busy_timeout)
+            end = conn.execute(select([id_column]).where(and_(id_column > last_id, id_column <= max_id))
+                               .order_by(id_column).limit(1).offset(batch_size - 1)).scalar()
+            if end is None:
+                end = max_id
+            fill(conn, last_id + 1, end)
+            _save(conn, name, end, batches + 1, False)
+        last_id = end
+        batches += 1
+        run += 1
+        if log is not None:
+            log('%s: ids up to %d of %d done' % (name, last_id, max_id))
+        if last_id >= max_id:
+            break
+        elapsed = time.time() - start
+        time.sleep(max(pause, elapsed * (1.0 - max_duty) / max_duty))
+    with engine.begin() as conn:
+        _save(conn, name, last_id, batches, True)
+    return run
+
+
+def _save(conn, name, last_id, batches, finished):
+    conn.execute(backfill_progress.insert().prefix_with('OR REPLACE'),
+                 name=name, last_id=last_id, batches=batches, finished=finished)
@@ -0,0 +1,215 @@
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import and_, bindparam, func, select
+
+from app import db
+from .models import User, Post, FeedEntry, ImportProgress, followers, hash_email
+from .timeline import fans_out_on_read
+
+"""
+Loading an existing corpus through the ORM costs an add() and a commit() per row. The bulk importer streams the records of a JSONL
+or CSV file instead, and writes them with executemany batches of IMPORT_BATCH_SIZE rows, committing every IMPORT_BATCHES_PER_COMMIT
+batches. Only one chunk of records is held in memory at a time, plus the map from nicknames to ids that is needed to resolve the
+authors of the posts.
+
+Users files have one record per user with the nickname, email and (optionally) about_me and last_seen fields. Posts files have the
+nickname of the author, the body and the timestamp. Users whose nickname or email is already taken are skipped, and so are posts
+whose author is unknown. A record that cannot be read at all, a line that is not JSON or a timestamp we cannot parse, is counted as
+invalid and logged with its line number, and the import goes on with the next one. Imported posts are fanned out to the feed of
+their author and of the author's followers, like timeline.fan_out() does, one INSERT ... SELECT per chunk, and the post_count of
+every author goes up by the posts of the chunk.
+
+Every commit also records in the import_progress table how far into the file it got, so running the same import again after an
+interruption skips what is already in the database. The progress is keyed by the absolute path of the file, use restart=True to
+import a file again from the beginning.
+"""
+
+USERS = 'users'
+POSTS = 'posts'
+
+_TIMESTAMP_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+def read_records(path):
+    """
+    Yields the records of path one by one as (line number, dictionary) pairs. Files ending in .csv are read with a header row,
+    anything else is read as JSON lines. A line that is not a JSON object is yielded with None in place of the dictionary.
+    """
+    if path.lower().endswith('.csv'):
+        with io.open(path, newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+    else:
+        with io.open(path, encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        record = None
+                    yield number, record if isinstance(record, dict) else None
+
+
+def parse_timestamp(value):
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    value = value.strip().replace('T', ' ').rstrip('Z')
+    for format in _TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError('invalid timestamp %r' % value)
+
+
+def _chunks(records, size):
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _nickname_map(conn):
+    users = User.__table__
+    return dict((nickname, user_id) for user_id, nickname in conn.execute(select([users.c.id, users.c.nickname])))
+
+
+def _parse_user(record):
+    email = (record.get('email') or '').strip() or None
+    return dict(nickname=(record.get('nickname') or '').strip(), email=email, email_hash=hash_email(email) if email else None,
+                about_me=record.get('about_me') or None, last_seen=parse_timestamp(record.get('last_seen')), profile_version=0,
+                fanout_on_read=False)
+
+
+def _parse_post(record):
+    return dict(nickname=(record.get('nickname') or '').strip(), body=(record.get('body') or '')[:140],
+                timestamp=parse_timestamp(record.get('timestamp')) or datetime.utcnow())
+
+
+def _insert_users(conn, batch, nicknames):
+    users = User.__table__
+    rows = [row for row in batch if row['nickname'] and row['nickname'] not in nicknames]
+    if not rows:
+        return 0
+    conn.execute(users.insert().prefix_with('OR IGNORE'), rows)
+    names = [row['nickname'] for row in rows]
+    inserted = 0
+    for i in range(0, len(names), 500):
+        for user_id, nickname in conn.execute(
+                select([users.c.id, users.c.nickname]).where(users.c.nickname.in_(names[i:i + 500]))):
+            if nickname not in nicknames:
+                nicknames[nickname] = user_id
+                inserted += 1
+    return inserted
+
+
+def _insert_posts(conn, batch, nicknames):
+    posts = Post.__table__
+    rows = []
+    for record in batch:
+        author = nicknames.get(record['nickname'])
+        if author is None or not record['body']:
+            continue
+        rows.append(dict(body=record['body'], timestamp=record['timestamp'], user_id=author))
+    if not rows:
+        return 0
+    conn.execute(posts.insert(), rows)
+    # SQLite numbers the rows itself. From the first row on this transaction holds the write lock of the database, so no other
+    # writer can insert a post in between and our posts are the newest len(rows) ids
+    last = conn.execute(select([func.max(posts.c.id)])).scalar()
+    _count_posts(conn, rows)
+    _fan_out(conn, rows, last - len(rows) + 1, last)
+    return len(rows)
+
+
+def _count_posts(conn, rows):
+    users = User.__table__
+    counts = {}
+    for row in rows:
+        counts[row['user_id']] = counts.get(row['user_id'], 0) + 1
+    conn.execute(users.update().where(users.c.id == bindparam('_id')).values(post_count=users.c.post_count + bindparam('_added')),
+                 [{'_id': user_id, '_added': added} for user_id, added in counts.items()])
+
+
+def _fan_out(conn, rows, first_id, last_id):
+    """
+    Fans out the posts in rows, which were given the ids first_id to last_id. The authors go through the same fan-out-on-read
+    check as a post published by timeline.publish(), with the newest of their posts in the chunk, and the posts of the authors it
+    switched (or that were already switched) only go to their own feed.
+    """
+    posts = Post.__table__
+    users = User.__table__
+    feed = FeedEntry.__table__
+    newest = {}
+    for row in rows:
+        if row['user_id'] not in newest or row['timestamp'] > newest[row['user_id']]:
+            newest[row['user_id']] = row['timestamp']
+    for author_id, timestamp in newest.items():
+        fans_out_on_read(author_id, timestamp, conn)
+    in_range = and_(posts.c.id >= first_id, posts.c.id <= last_id)
+    conn.execute(feed.insert().prefix_with('OR IGNORE').from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        select([posts.c.user_id, posts.c.id, posts.c.timestamp]).where(in_range)))
+    conn.execute(feed.insert().prefix_with('OR IGNORE').from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        select([followers.c.follower_id, posts.c.id, posts.c.timestamp]).where(and_(
+            in_range,
+            followers.c.followed_id == posts.c.user_id,
+            users.c.id == posts.c.user_id,
+            users.c.fanout_on_read == False))))
+
+
+def import_file(kind, path, batch_size=None, batches_per_commit=None, restart=False):
+    """
+    Imports the users or posts in path and returns a dictionary with the number of records read, inserted, skipped and invalid
+    so far, counting the ones committed by earlier interrupted runs.
+    """
+    if kind not in (USERS, POSTS):
+        raise ValueError('unknown import kind %r' % kind)
+    config = current_app.config
+    batch_size = batch_size or config['IMPORT_BATCH_SIZE']
+    batches_per_commit = batches_per_commit or config['IMPORT_BATCHES_PER_COMMIT']
+    source = '%s:%s' % (kind, os.path.abspath(path))
+    progress = ImportProgress.__table__
+    engine = db.engine
+    with engine.begin() as conn:
+        if restart:
+            conn.execute(progress.delete().where(progress.c.source == source))
+        row = conn.execute(select([progress.c.position, progress.c.inserted, progress.c.skipped, progress.c.invalid])
+                           .where(progress.c.source == source)).first()
+        nicknames = _nickname_map(conn)
+    position, inserted, skipped, invalid = [value or 0 for value in row] if row is not None else (0, 0, 0, 0)
+    parse, insert = (_parse_user, _insert_users) if kind == USERS else (_parse_post, _insert_posts)
+    records = islice(read_records(path), position, None)
+    for chunk in _chunks(records, batch_size * batches_per_commit):
+        valid = []
+        for number, record in chunk:
+            try:
+                if record is None:
+                    raise ValueError('not a JSON object')
+                valid.append(parse(record))
+            except (AttributeError, TypeError, ValueError) as e:
+                # a field of the wrong type (a number where a string should be) is as unreadable as a bad timestamp
+                current_app.logger.warning('%s line %d: invalid record skipped (%s)', path, number, e)
+                invalid += 1
+        with engine.begin() as conn:
+            added = 0
+            for batch in _chunks(valid, batch_size):
+                added += insert(conn, batch, nicknames)
+            position += len(chunk)
+            inserted += added
+            skipped += len(valid) - added
+            conn.execute(progress.insert().prefix_with('OR REPLACE'),
+                         source=source, position=position, inserted=inserted, skipped=skipped, invalid=invalid)
+    return {'read': position, 'inserted': inserted, 'skipped': skipped, 'invalid': invalid}
@@ -0,0 +1,105 @@
+import gzip
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+Pages, JSON and exports used to go out uncompressed, which is a lot of bytes for a phone on a slow connection. The Compression
+extension compresses them in an after_request hook:
+
+- The encoding is negotiated from Accept-Encoding. Brotli is preferred when the brotli package is installed, gzip otherwise.
+- Only text types are compressed (COMPRESS_MIMETYPES). Images are already compressed, and a response that already has a
+  Content-Encoding (or is smaller than COMPRESS_MIN_SIZE bytes) is left alone.
+- A streamed response (the export) is compressed piece by piece and every piece is flushed, so the client still gets the data as
+  it is produced.
+- The ETag of a compressed response gets the encoding appended, a gzipped page and a plain one are different bytes. not_modified()
+  in app/fragments.py accepts the tag with any of these suffixes.
+
+Compressed bodies are not kept: every page carries the CSRF token of its session, so the same bytes are hardly ever served twice.
+"""
+
+DEFAULT_MIMETYPES = ['text/html', 'text/css', 'text/plain', 'text/csv', 'text/xml', 'text/javascript', 'application/javascript',
+                     'application/json', 'application/x-ndjson', 'application/xml', 'image/svg+xml']
+
+
+def encodings():
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_stream(chunks, encoding, level):
+    """
+    Compresses an iterable of byte strings, flushing the compressor after each one.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+        return
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class Compression(object):
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_MIMETYPES', DEFAULT_MIMETYPES)
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_GZIP_LEVEL', 9)
+        app.config.setdefault('COMPRESS_BROTLI_QUALITY', 5)
+        self.app = app
+        app.after_request(self.after_request)
+        app.extensions['compression'] = self
+
+    def negotiate(self):
+        """
+        Returns the encoding the client prefers, or None.
+        """
+        return request.accept_encodings.best_match(encodings())
+
+    def level(self, encoding):
+        return self.app.config['COMPRESS_BROTLI_QUALITY' if encoding == 'br' else 'COMPRESS_GZIP_LEVEL']
+
+    def after_request(self, response):
+        if response.status_code < 200 or response.status_code in (204, 304) or 'Content-Encoding' in response.headers:
+            return response
+        if response.mimetype not in self.app.config['COMPRESS_MIMETYPES']:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = compress_stream(response.iter_encoded(), encoding, self.level(encoding))
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.app.config['COMPRESS_MIN_SIZE']:
+                return response
+            response.set_data(compress(data, encoding, self.level(encoding)))
+        response.headers['Content-Encoding'] = encoding
+        tag, weak = response.get_etag()
+        if tag is not None:
+            response.set_etag('%s-%s' % (tag, encoding), weak)
+        return response
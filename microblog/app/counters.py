@@ -0,0 +1,71 @@
+from sqlalchemy import DDL, event, func, or_, select
+
+from .backfill import backfill, backfill_progress
+from .models import User, Post, followers
+
+"""
+The profile page shows how many posts a user wrote, how many followers they have and how many users they follow. Counting those
+rows on every view gets slower the longer the user is around, so the user table keeps the three numbers in the post_count,
+follower_count and followed_count columns instead. They are changed in the same transaction as the rows they count:
+timeline.publish(), timeline.follow() and timeline.unfollow() add or subtract one, and the bulk importer adds the number of posts
+each batch gave every author. Posts can also be deleted by code that does not go through the timeline, so the decrement is done by
+an AFTER DELETE trigger on the post table, created together with it by db.create_all() like the search triggers in app/search.py
+(and by migration 014 for existing databases).
+
+A counter can still drift, when rows are written or deleted by hand, or by code that does not know about the counters. reconcile()
+counts everything again and repairs the users whose numbers are wrong. It goes through the user table in batches with backfill()
+from app/backfill.py, so the application can keep writing while it runs, and an interrupted run continues where it stopped
+when it is started again (db_recount.py).
+"""
+
+RECONCILE = 'reconcile_counters'
+
+users = User.__table__
+posts = Post.__table__
+
+COUNTER_DDL = [
+    "CREATE TRIGGER post_count_delete AFTER DELETE ON post BEGIN "
+    "UPDATE user SET post_count = post_count - 1 WHERE id = old.user_id; END",
+]
+
+for statement in COUNTER_DDL:
+    event.listen(posts, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+
+def true_counts():
+    """
+    Returns the correlated subqueries that count the posts, followers and followed users of the user row.
+    """
+    post_count = select([func.count()]).select_from(posts).where(posts.c.user_id == users.c.id).as_scalar()
+    follower_count = select([func.count()]).select_from(followers).where(followers.c.followed_id == users.c.id).as_scalar()
+    followed_count = select([func.count()]).select_from(followers).where(followers.c.follower_id == users.c.id).as_scalar()
+    return post_count, follower_count, followed_count
+
+
+def recount(conn, first_id, last_id):
+    """
+    Recomputes the counters of the users with ids between first_id and last_id and returns how many of them were wrong.
+    """
+    post_count, follower_count, followed_count = true_counts()
+    return conn.execute(users.update().where(users.c.id.between(first_id, last_id)).where(or_(
+        users.c.post_count.isnot(post_count),
+        users.c.follower_count.isnot(follower_count),
+        users.c.followed_count.isnot(followed_count),
+    )).values(post_count=post_count, follower_count=follower_count, followed_count=followed_count)).rowcount
+
+
+def reconcile(engine, batch_size=1000, pause=0.05, resume=False, log=None):
+    """
+    Repairs the counters of every user and returns the number of users that had drifted. Without resume a new pass starts at the
+    first user, with resume an interrupted pass is finished (only the users repaired in this call are counted then).
+    """
+    if not resume:
+        backfill_progress.create(engine, checkfirst=True)
+        engine.execute(backfill_progress.delete().where(backfill_progress.c.name == RECONCILE))
+    repaired = [0]
+
+    def fill(conn, first_id, last_id):
+        repaired[0] += recount(conn, first_id, last_id)
+
+    backfill(engine, RECONCILE, users, fill, batch_size=batch_size, pause=pause, log=log)
+    return repaired[0]
@@ -0,0 +1,111 @@
+import os
+import sqlite3
+
+from flask import current_app
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import Pool, QueuePool
+
+"""
+With the default settings SQLite uses a rollback journal, so every commit (an edit of a profile, a new post, a last_seen flush) locks
+out all the readers until it is done. The production profile changes that:
+
+- The journal is switched to WAL, which lets readers keep going while a single writer commits. The synchronous, busy_timeout,
+  mmap_size and cache_size pragmas are applied to every new connection, DEFAULT_PRAGMAS below has their values and
+  SQLITE_PRAGMAS in the configuration replaces it.
+- Connections are kept in a per-process QueuePool instead of being opened for every request. A pooled connection that was opened
+  before a fork is never handed out in the child process, each worker builds its own pool.
+- Read-only view queries (profile, timeline and login lookups) go through read_session(), which is bound to a second pool of
+  connections opened in SQLite's read-only mode. GET traffic then never queues up behind the write lock.
+
+With the default profile nothing changes and read_session() simply returns db.session, which is also what the tests use.
+"""
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -20000,
+}
+
+
+class TunedConnection(sqlite3.Connection):
+    """
+    The connections opened by the production profile remember the process that opened them, see _check_pid below.
+    """
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.pid = os.getpid()
+
+
+class SQLiteProfile(object):
+    def __init__(self, app=None, db=None):
+        self.db = None
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault('SQLITE_PROFILE', 'default')
+        app.config.setdefault('SQLITE_PRAGMAS', DEFAULT_PRAGMAS)
+        app.config.setdefault('SQLITE_POOL_SIZE', 5)
+        app.config.setdefault('SQLITE_READ_POOL_SIZE', 10)
+        self.db = db
+        app.extensions['sqlite_profile'] = self
+        app.extensions['sqlite_read_session'] = None
+        if app.config['SQLITE_PROFILE'] != 'production':
+            return
+        path = self.database_path(app)
+        pragmas = app.config['SQLITE_PRAGMAS']
+        options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        options.setdefault('poolclass', QueuePool)
+        options.setdefault('pool_size', app.config['SQLITE_POOL_SIZE'])
+        options.setdefault('creator', lambda: _connect(path, pragmas))
+        read_pragmas = dict((name, value) for name, value in pragmas.items() if name != 'journal_mode')
+        read_pragmas['query_only'] = 'ON'
+        read_engine = create_engine('sqlite://', poolclass=QueuePool,
+                                    pool_size=app.config['SQLITE_READ_POOL_SIZE'],
+                                    creator=lambda: _connect('file:%s?mode=ro' % path, read_pragmas, uri=True))
+        app.extensions['sqlite_read_session'] = scoped_session(sessionmaker(bind=read_engine))
+        app.teardown_appcontext(self._remove_read_session)
+
+    def database_path(self, app):
+        path = make_url(app.config['SQLALCHEMY_DATABASE_URI']).database
+        if not os.path.isabs(path):
+            path = os.path.join(app.root_path, path)
+        return path
+
+    def read_session(self):
+        """
+        Returns the session that read-only view queries should use. Objects loaded through it must not be modified, a view that
+        needs to write loads what it changes through db.session.
+        """
+        reads = current_app.extensions.get('sqlite_read_session')
+        if reads is None:
+            return self.db.session
+        return reads
+
+    def _remove_read_session(self, exc=None):
+        current_app.extensions['sqlite_read_session'].remove()
+
+
+def _connect(database, pragmas, uri=False):
+    connection = sqlite3.connect(database, uri=uri, check_same_thread=False, factory=TunedConnection)
+    cursor = connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+    return connection
+
+
+@event.listens_for(Pool, 'checkout')
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    """
+    This is the recipe from the SQLAlchemy documentation for pools that cross a fork: a connection opened by the parent process is
+    discarded, and the pool opens a fresh one in the worker.
+    """
+    pid = getattr(dbapi_connection, 'pid', None)
+    if pid is not None and pid != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError('Connection opened by pid %s, attempting to check out in pid %s' % (pid, os.getpid()))
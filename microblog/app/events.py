@@ -0,0 +1,98 @@
+from collections import namedtuple
+
+from sqlalchemy import event, inspect
+
+"""
+Flask-SQLAlchemy can send a signal for every object in every flush (SQLALCHEMY_TRACK_MODIFICATIONS), but that costs a lot on every
+session and nothing in the application listened to it. What our caches really need is much narrower: "tell me after the commit when
+the nickname or about_me of a User changed", so they can drop exactly the entries that went stale.
+
+The ChangeBus does just that. Subscribers register for a model and, optionally, a set of fields. During a flush we only look at the
+objects of subscribed models, and only record an update when one of the subscribed fields has changed. The recorded changes are held
+on the session until the transaction commits and are thrown away if it rolls back, so subscribers never hear about data that did
+not make it to the database.
+
+Only changes made through the ORM session are seen. Bulk statements issued with Core (the feed fan-out, the last_seen flush) do not
+go through a flush and are not reported.
+"""
+
+Change = namedtuple('Change', ['model', 'id', 'op', 'fields'])
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+
+
+class ChangeBus(object):
+    def __init__(self, app=None, db=None):
+        self._subscriptions = {}
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        if not event.contains(db.session, 'after_flush', self._after_flush):
+            event.listen(db.session, 'after_flush', self._after_flush)
+            event.listen(db.session, 'after_commit', self._after_commit)
+            event.listen(db.session, 'after_rollback', self._after_rollback)
+        app.extensions['change_bus'] = self
+
+    def subscribe(self, model, fields=None, ops=(INSERT, UPDATE, DELETE)):
+        """
+        Registers the decorated function to be called with a Change after every commit that inserted, updated or deleted an
+        instance of model. When fields is given, updates that do not touch any of them are ignored.
+        """
+        def decorator(callback):
+            self._subscriptions.setdefault(model, []).append(
+                (frozenset(fields) if fields else None, frozenset(ops), callback))
+            return callback
+        return decorator
+
+    def unsubscribe(self, model, callback):
+        self._subscriptions[model] = [subscription for subscription in self._subscriptions.get(model, ())
+                                      if subscription[2] is not callback]
+
+    def _after_flush(self, session, flush_context):
+        if not self._subscriptions:
+            return
+        changes = None
+        for op, objects in ((INSERT, session.new), (UPDATE, session.dirty), (DELETE, session.deleted)):
+            for obj in objects:
+                subscriptions = self._subscriptions.get(type(obj))
+                if subscriptions is None:
+                    continue
+                change = self._describe(obj, op, subscriptions)
+                if change is not None:
+                    if changes is None:
+                        changes = session.info.setdefault('change_bus', [])
+                    changes.append(change)
+
+    @staticmethod
+    def _describe(obj, op, subscriptions):
+        state = inspect(obj)
+        key = state.mapper.primary_key_from_instance(obj)
+        key = key[0] if len(key) == 1 else tuple(key)
+        if op != UPDATE:
+            return Change(type(obj), key, op, None)
+        watched = set()
+        for fields, ops, callback in subscriptions:
+            if UPDATE in ops:
+                watched.update(fields if fields is not None else state.mapper.column_attrs.keys())
+        changed = frozenset(name for name in watched if state.attrs[name].history.has_changes())
+        if not changed:
+            return None
+        return Change(type(obj), key, op, changed)
+
+    def _after_commit(self, session):
+        changes = session.info.pop('change_bus', None)
+        if not changes:
+            return
+        for change in changes:
+            for fields, ops, callback in self._subscriptions.get(change.model, ()):
+                if change.op not in ops:
+                    continue
+                if change.op == UPDATE and fields is not None and not (fields & change.fields):
+                    continue
+                callback(change)
+
+    def _after_rollback(self, session):
+        session.info.pop('change_bus', None)
@@ -0,0 +1,71 @@
+import csv
+import io
+import json
+
+from flask import current_app
+from sqlalchemy import select
+
+from app import db
+from .models import Post
+from .pagination import older_than
+
+"""
+Exporting the posts of a user through user.posts.all() would load every post in memory before the first byte is written. The
+functions here read the posts newest first in keyset ordered chunks of EXPORT_CHUNK_SIZE rows (each chunk is a seek on the
+(user_id, timestamp, id) index that starts right after the last post of the previous chunk) and turn every chunk into text as soon
+as it is read. The export view and db_export.py send those pieces out as they come, so memory stays flat no matter how many posts
+the user has.
+"""
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+FORMATS = {NDJSON: 'application/x-ndjson', CSV: 'text/csv'}
+CSV_COLUMNS = ['id', 'timestamp', 'body']
+
+
+def post_chunks(user_id, chunk_size=None, session=None):
+    """
+    Yields the posts of a user as lists of (id, timestamp, body) rows, newest first.
+    """
+    session = session or db.session
+    chunk_size = chunk_size or current_app.config['EXPORT_CHUNK_SIZE']
+    posts = Post.__table__
+    key = None
+    while True:
+        query = select([posts.c.id, posts.c.timestamp, posts.c.body]).where(posts.c.user_id == user_id)
+        if key is not None:
+            query = query.where(older_than(posts.c.timestamp, posts.c.id, key))
+        rows = session.execute(query.order_by(posts.c.timestamp.desc(), posts.c.id.desc()).limit(chunk_size)).fetchall()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        key = (rows[-1].timestamp, rows[-1].id)
+
+
+def _timestamp(value):
+    return value.isoformat() if value is not None else None
+
+
+def export_posts(user_id, format=NDJSON, chunk_size=None, session=None):
+    """
+    Yields the export of a user's posts as text, one piece per chunk of posts.
+    """
+    if format not in FORMATS:
+        raise ValueError('unknown export format %r' % format)
+    if format == CSV:
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(CSV_COLUMNS)
+        yield out.getvalue()
+    for rows in post_chunks(user_id, chunk_size, session):
+        if format == NDJSON:
+            yield ''.join(json.dumps({'id': row.id, 'timestamp': _timestamp(row.timestamp), 'body': row.body}) + '\n'
+                          for row in rows)
+        else:
+            out = io.StringIO()
+            writer = csv.writer(out)
+            for row in rows:
+                writer.writerow([row.id, _timestamp(row.timestamp), row.body])
+            yield out.getvalue()
@@ -0,0 +1,31 @@
+from .last_seen import LastSeenTracker
+from .identity_cache import IdentityCache
+from .querycount import QueryCounter
+from .database import SQLiteProfile
+from .events import ChangeBus
+from .fragments import FragmentCache
+from .logs import LogPipeline
+from .metrics import Metrics
+from .nicknames import NicknameIndex
+from .compression import Compression
+from .post_writer import PostWriter
+from .avatars import AvatarCache
+
+"""
+The extensions are created here without an application, and create_app() in app/__init__.py binds them to one. This module is only
+imported by create_app() and by the code that runs inside an application (the views, the forms, the tests), so a script that only
+needs the models does not load the caches, the log pipeline, the metrics or the avatar proxy, nor what they import.
+"""
+sqlite_profile = SQLiteProfile()
+read_session = sqlite_profile.read_session
+changes = ChangeBus()
+last_seen = LastSeenTracker()
+identity_cache = IdentityCache()
+fragments = FragmentCache()
+nicknames = NicknameIndex()
+compression = Compression()
+post_writer = PostWriter()
+avatars = AvatarCache()
+querycount = QueryCounter()
+metrics = Metrics()
+log_pipeline = LogPipeline()
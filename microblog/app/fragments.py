@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+from hashlib import md5
+
+from flask import current_app, render_template, request, session
+from markupsafe import Markup
+
+"""
+Most of the time spent on a profile page goes into rendering the same post rows over and over. The FragmentCache keeps rendered
+pieces of HTML in a size-bounded LRU, keyed by the id of the model they show plus a version stamp. A post row, for example, is keyed
+by the post id, a hash of the post's body and timestamp, and the profile_version of its author (which changes when the nickname or
+email changes), so an entry can never be served stale: when the data changes the key changes, and the old entry simply ages out of
+the LRU.
+
+Templates use cached_post(post) instead of including post.html, and views can cache any other piece with render().
+
+The etag() helper builds a strong ETag out of a list of cheap values. Views that can describe their whole page that way answer a
+matching If-None-Match with a 304 before they render a template or query any posts. Every page has the search form with the CSRF
+token of the session in it, so csrf_state() has to be one of those values.
+"""
+
+
+class FragmentCache(object):
+    def __init__(self, app=None):
+        self.maxsize = 2048
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', 2048)
+        self.maxsize = app.config['FRAGMENT_CACHE_SIZE']
+        app.jinja_env.globals['cached_post'] = self.render_post
+        app.extensions['fragments'] = self
+
+    def render(self, key, template_name, **context):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+        html = Markup(render_template(template_name, **context))
+        if self.maxsize > 0:
+            with self._lock:
+                self._entries[key] = html
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return html
+
+    def render_post(self, post):
+        author = post.author
+        version = md5(('%s %s' % (post.timestamp, post.body)).encode('utf-8')).hexdigest()
+        return self.render(('post', post.id, version, author.id, author.profile_version), 'post.html', post=post)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+def etag(*parts):
+    return md5(repr(parts).encode('utf-8')).hexdigest()
+
+
+def csrf_state():
+    """
+    Describes the CSRF token a page rendered now would carry: the token of the session, and how many halves of WTF_CSRF_TIME_LIMIT
+    have passed. A page kept by the browser is then never older than half the time limit, and never belongs to another session, so
+    the forms in it still work.
+    """
+    token = session.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    return token, int(time.time() // (limit / 2.0)) if limit else None
+
+
+def not_modified(tag):
+    """
+    Returns True when the client already has the page described by tag. Pages that show a flashed message are never treated as
+    unchanged, the message has to be rendered. A compressed page was sent with the encoding appended to its tag (see
+    app/compression.py), any of those tags matches.
+    """
+    if '_flashes' in session:
+        return False
+    return any(request.if_none_match.contains(tag + suffix) for suffix in ('', '-gzip', '-br'))
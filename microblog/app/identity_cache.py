@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+"""
+Flask-Login calls our user_loader on every request to rebuild current_user, and that used to be one SELECT per request just to
+find out who is logged in.
+
+The IdentityCache sits in front of that callback. It is a small LRU keyed by user id where every entry also expires after a
+configurable time to live. We never hand out the cached object itself, because a User instance belongs to the session that loaded
+it and would be shared by all the threads serving requests. Instead we keep a plain copy of the column values and build a fresh
+detached User from them on every hit. A detached instance still has its identity, so it can be added back to a session (as the
+edit view does) and SQLAlchemy will issue an UPDATE, not an INSERT.
+
+The hit, miss and eviction counters are returned by stats(), so the size of the cache can be tuned by looking at them.
+"""
+
+
+class IdentityCache(object):
+    def __init__(self, app=None):
+        self.maxsize = 1024
+        self.ttl = 300
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IDENTITY_CACHE_SIZE', 1024)
+        app.config.setdefault('IDENTITY_CACHE_TTL', 300)
+        self.maxsize = app.config['IDENTITY_CACHE_SIZE']
+        self.ttl = app.config['IDENTITY_CACHE_TTL']
+        app.extensions['identity_cache'] = self
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] <= now:
+                del self._entries[user_id]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            cls, values = entry[1], entry[2]
+        return self._snapshot(cls, values)
+
+    def put(self, user):
+        if self.maxsize <= 0:
+            return
+        values = self._values(user)
+        with self._lock:
+            self._entries[user.id] = (time.time() + self.ttl, type(user), values)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def load(self, user_id, loader):
+        """
+        Returns the cached snapshot of a user, calling loader(user_id) on a miss. The loaded instance is copied into the cache
+        and the caller gets a detached snapshot as well, so a hit and a miss look exactly the same to the rest of the request.
+        """
+        user = self.get(user_id)
+        if user is not None:
+            return user
+        user = loader(user_id)
+        if user is None:
+            return None
+        self.put(user)
+        return self._snapshot(type(user), self._values(user))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+    @staticmethod
+    def _values(user):
+        return dict((key, getattr(user, key)) for key in inspect(user).mapper.column_attrs.keys())
+
+    @staticmethod
+    def _snapshot(cls, values):
+        user = cls(**values)
+        make_transient_to_detached(user)
+        return user
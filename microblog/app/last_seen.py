@@ -0,0 +1,138 @@
+import atexit
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, or_
+
+"""
+Recording the last time a user was seen used to cost a database commit on every request. SQLite only allows one writer at a
+time, so all those tiny transactions ended up serializing the whole application.
+
+The LastSeenTracker keeps the timestamps in memory instead. A user is only marked dirty again once the configured window has
+passed since the last recorded visit, and the dirty users are written back to the user table with a single batched UPDATE,
+either from a background timer or when the process shuts down. The values shown on the profile page are therefore eventually
+consistent: the view asks the tracker first and falls back to the column stored in the database.
+
+Once a visit is older than the window the next one is written anyway, so a flush also forgets the users whose last visit is
+older than that and already written, and the tracker only holds the users that were seen within the last window.
+"""
+
+
+class LastSeenTracker(object):
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._seen = {}
+        self._dirty = {}
+        self._thread = None
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LAST_SEEN_WINDOW', 60)
+        app.config.setdefault('LAST_SEEN_FLUSH_INTERVAL', 30)
+        self.app = app
+        app.extensions['last_seen'] = self
+
+    def touch(self, user_id, now=None):
+        """
+        Records a visit. Nothing is written to the database here, we only remember the time and mark the user dirty when the
+        previous recorded visit is older than the window. The background flusher is started lazily on the first visit, so that
+        importing the application (in the tests or in the db_*.py scripts) does not spawn any threads.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        window = timedelta(seconds=self.app.config['LAST_SEEN_WINDOW'])
+        with self._lock:
+            previous = self._seen.get(user_id)
+            if previous is not None and now - previous < window:
+                return False
+            self._seen[user_id] = now
+            self._dirty[user_id] = now
+        self._ensure_started()
+        return True
+
+    def last_seen(self, user_id, default=None):
+        with self._lock:
+            seen = self._seen.get(user_id)
+        if seen is None or (default is not None and default > seen):
+            return default
+        return seen
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+            self._dirty.clear()
+
+    def pending(self):
+        with self._lock:
+            return len(self._dirty)
+
+    def flush(self, now=None):
+        """
+        Writes every dirty timestamp back in one executemany UPDATE inside a single transaction. The WHERE clause makes sure we
+        never move last_seen backwards when several processes flush the same user. If the write fails the timestamps are put back
+        in the dirty set, so they will be retried on the next flush. Visits older than the window that are not waiting to be
+        written are dropped from memory first, the profile page reads them from the database.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        expired = now - timedelta(seconds=self.app.config['LAST_SEEN_WINDOW'])
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            for user_id in [user_id for user_id, seen in self._seen.items() if seen < expired and user_id not in dirty]:
+                del self._seen[user_id]
+        if not dirty:
+            return 0
+        from app import db
+        from app.models import User
+        table = User.__table__
+        stmt = table.update().where(table.c.id == bindparam('_id')).where(
+            or_(table.c.last_seen == None, table.c.last_seen < bindparam('_last_seen'))
+        ).values(last_seen=bindparam('_last_seen'))
+        rows = [{'_id': user_id, '_last_seen': seen} for user_id, seen in dirty.items()]
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as conn:
+                    conn.execute(stmt, rows)
+        except Exception:
+            with self._lock:
+                for user_id, seen in dirty.items():
+                    if self._dirty.get(user_id, seen) <= seen:
+                        self._dirty[user_id] = seen
+            raise
+        return len(rows)
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        interval = self.app.config['LAST_SEEN_FLUSH_INTERVAL']
+        if not interval:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='last-seen-flusher')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('last_seen flush failed')
+
+    def stop(self):
+        """
+        Stops the background flusher and writes whatever is still pending. This is registered with atexit, so a normal shutdown
+        of the server does not lose the visits recorded since the last flush.
+        """
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        self.flush()
@@ -0,0 +1,234 @@
+import atexit
+import copy
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+from collections import OrderedDict
+from email.message import EmailMessage
+from logging.handlers import RotatingFileHandler
+
+"""
+Writing the log file and sending error mail straight from app.logger means that the request that logs an error also has to wait for
+the disk and for an SMTP connection to MAIL_SERVER. During a burst of 500s every request thread ends up stuck in smtplib, and a
+partial failure becomes a full outage.
+
+The LogPipeline moves all of that out of the request threads:
+
+- app.logger only gets a QueueHandler. Logging a record formats it and puts it in a bounded queue, that's all. When the queue is full
+  the record is dropped and counted instead of blocking the request.
+- A background listener takes records off the queue and writes them to the rotating log file.
+- Records at ERROR level or above are collected by the DigestMailHandler. Identical tracebacks (same place in the code, same
+  traceback text) are collapsed into one entry with a count, and once per LOG_MAIL_INTERVAL seconds a single digest email is sent
+  with everything collected in that interval.
+"""
+
+FILE_FORMAT = '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+
+_STOP = object()
+
+
+class DroppingQueueHandler(logging.Handler):
+    """
+    A non-blocking queue handler. A copy of the record is turned into plain strings before it is queued, so the traceback and the
+    frames it references are not kept alive while the record waits for the listener. The other handlers of the logger still get the
+    record as it was logged.
+    """
+    def __init__(self, records, on_enqueue=None):
+        logging.Handler.__init__(self)
+        self.queue = records
+        self.on_enqueue = on_enqueue
+        self.dropped = 0
+        self._formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = self._formatter.formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.dropped += 1
+            return
+        except Exception:
+            self.handleError(record)
+            return
+        if self.on_enqueue is not None:
+            self.on_enqueue()
+
+
+class DigestMailHandler(logging.Handler):
+    def __init__(self, mailhost, fromaddr, toaddrs, subject, credentials=None, timeout=10.0):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.mailhost = mailhost
+        self.fromaddr = fromaddr
+        self.toaddrs = toaddrs
+        self.subject = subject
+        self.credentials = credentials
+        self.timeout = timeout
+        self.digest = OrderedDict()
+        self.sent = 0
+
+    @staticmethod
+    def signature(record):
+        return (record.levelname, record.pathname, record.lineno, record.exc_text or record.msg)
+
+    def emit(self, record):
+        key = self.signature(record)
+        entry = self.digest.get(key)
+        if entry is None:
+            self.digest[key] = [record, 1, record.created]
+        else:
+            entry[1] += 1
+            entry[2] = record.created
+
+    def flush(self):
+        """
+        Sends everything collected since the last flush as one email. If the mail server cannot be reached the digest is dropped
+        and the failure goes to the log file, we never retry in a loop against a server that is already down.
+        """
+        if not self.digest:
+            return
+        digest, self.digest = self.digest, OrderedDict()
+        total = sum(entry[1] for entry in digest.values())
+        parts = []
+        for record, count, last in digest.values():
+            header = '%d x %s' % (count, self.format(record)) if count > 1 else self.format(record)
+            if count > 1:
+                header += '\n(last seen %s)' % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last))
+            parts.append(header)
+        message = EmailMessage()
+        message['From'] = self.fromaddr
+        message['To'] = ', '.join(self.toaddrs)
+        message['Subject'] = '%s (%d errors, %d distinct)' % (self.subject, total, len(digest))
+        message.set_content('\n\n'.join(parts))
+        try:
+            smtp = smtplib.SMTP(self.mailhost[0], self.mailhost[1], timeout=self.timeout)
+            try:
+                if self.credentials:
+                    smtp.login(*self.credentials)
+                smtp.send_message(message)
+            finally:
+                smtp.quit()
+            self.sent += 1
+        except Exception:
+            logging.getLogger(__name__).warning('could not send the error digest to %s:%s', *self.mailhost, exc_info=True)
+
+
+class LogPipeline(object):
+    def __init__(self, app=None):
+        self.queue = None
+        self.queue_handler = None
+        self.handlers = []
+        self.mail_handler = None
+        self.interval = 60
+        self._thread = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, logger=None):
+        if self._thread is not None:
+            self.stop()
+        self.handlers = []
+        self.mail_handler = None
+        config = app.config
+        config.setdefault('LOG_QUEUE_SIZE', 10000)
+        config.setdefault('LOG_MAIL_INTERVAL', 60)
+        self.interval = config['LOG_MAIL_INTERVAL']
+        self.queue = queue.Queue(config['LOG_QUEUE_SIZE'])
+        if config.get('LOG_FILE'):
+            directory = os.path.dirname(config['LOG_FILE'])
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            file_handler = RotatingFileHandler(config['LOG_FILE'], 'a', 1 * 1024 * 1024, 10, delay=True)
+            file_handler.setFormatter(logging.Formatter(FILE_FORMAT))
+            file_handler.setLevel(logging.INFO)
+            self.handlers.append(file_handler)
+        if config.get('MAIL_SERVER') and config.get('ADMINS'):
+            credentials = None
+            if config.get('MAIL_USERNAME') or config.get('MAIL_PASSWORD'):
+                credentials = (config.get('MAIL_USERNAME'), config.get('MAIL_PASSWORD'))
+            self.mail_handler = DigestMailHandler((config['MAIL_SERVER'], config['MAIL_PORT']), 'no-reply@' + config['MAIL_SERVER'],
+                                                  config['ADMINS'], 'microblog failure', credentials)
+            self.mail_handler.setFormatter(logging.Formatter(FILE_FORMAT))
+            self.handlers.append(self.mail_handler)
+        logger = logger if logger is not None else app.logger
+        if self.queue_handler is not None:
+            logger.removeHandler(self.queue_handler)
+        self.queue_handler = DroppingQueueHandler(self.queue, self._ensure_started)
+        logger.setLevel(logging.INFO)
+        logger.addHandler(self.queue_handler)
+        app.extensions['log_pipeline'] = self
+
+    @property
+    def dropped(self):
+        return self.queue_handler.dropped
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'dropped': self.dropped,
+                'mails_sent': self.mail_handler.sent if self.mail_handler else 0}
+
+    def _ensure_started(self):
+        """
+        The listener thread is only started when the first record is logged, so importing the application does not start threads.
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='log-listener')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _run(self):
+        next_mail = time.time() + self.interval
+        while True:
+            try:
+                record = self.queue.get(timeout=max(0.0, next_mail - time.time()))
+            except queue.Empty:
+                record = None
+            if record is _STOP:
+                break
+            if record is not None:
+                self._handle(record)
+            if time.time() >= next_mail:
+                if self.mail_handler is not None:
+                    self.mail_handler.flush()
+                next_mail = time.time() + self.interval
+
+    def drain(self):
+        """
+        Handles every record that is still in the queue and sends the pending digest right away. This runs at shutdown, and the
+        tests call it to avoid waiting for the interval.
+        """
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self._handle(record)
+        for handler in self.handlers:
+            handler.flush()
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self.queue.put(_STOP)
+            thread.join()
+        self.drain()
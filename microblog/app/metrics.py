@@ -0,0 +1,269 @@
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+
+from flask import Response, request
+from jinja2 import Template
+
+"""
+The Metrics extension times every request and keeps the results in histograms, one set per endpoint:
+
+- microblog_request_duration_seconds, the wall time from before_request to teardown_request.
+- microblog_template_render_seconds, the time spent rendering templates (only the outermost render is counted, the fragments that a
+  template renders from the cache do not count twice).
+- microblog_sql_queries, the number of SQL statements the request issued.
+- microblog_sql_duration_seconds, the time those statements took.
+
+The statements and their durations are the ones the QueryCounter (app/querycount.py) already records for every request, so it has to
+be bound to the application as well.
+
+The post writer (app/post_writer.py) records its groups in two more histograms, with post_writer in place of the endpoint.
+
+The histograms are served at METRICS_URL in the Prometheus text format. When the application runs in several worker processes each of
+them only sees its own requests, so with METRICS_DIR set every process also writes its histograms to METRICS_DIR/metrics_<pid>.json
+(at most once per METRICS_WRITE_INTERVAL seconds) and the metrics page adds up the files of all the workers. A worker deletes its file
+when it exits, and the page skips (and deletes) the files of processes that are no longer running, so a dead worker is not counted
+forever. A new process also deletes a file that is left under its pid, from an older process that had the same pid. The sum can go
+down when a worker goes away, Prometheus treats that as a counter reset.
+
+Requests that take longer than METRICS_SLOW_REQUEST seconds are logged as a warning together with their slowest SQL statements.
+
+Other parts of the application can publish a number with gauge() (the nickname index reports its size that way), gauges are served
+after the histograms.
+"""
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+HISTOGRAMS = (
+    ('microblog_request_duration_seconds', 'Request wall time.', LATENCY_BUCKETS),
+    ('microblog_template_render_seconds', 'Time spent rendering templates.', LATENCY_BUCKETS),
+    ('microblog_sql_queries', 'SQL statements issued per request.', COUNT_BUCKETS),
+    ('microblog_sql_duration_seconds', 'Time spent in SQL statements.', LATENCY_BUCKETS),
+    ('microblog_post_batch_size', 'Posts committed together by the post writer.', COUNT_BUCKETS),
+    ('microblog_post_commit_seconds', 'Time the post writer took to write and commit a group of posts.', LATENCY_BUCKETS),
+)
+
+
+class RequestStats(object):
+    def __init__(self):
+        self.start = time.time()
+        self.render_time = 0.0
+        self.render_depth = 0
+
+
+class Metrics(object):
+    def __init__(self, app=None):
+        self.app = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._gauges = {}
+        self._last_write = 0.0
+        self._atexit = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_URL', '/metrics')
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_WRITE_INTERVAL', 5)
+        app.config.setdefault('METRICS_SLOW_REQUEST', 1.0)
+        app.config.setdefault('METRICS_SLOW_QUERIES', 5)
+        self.app = app
+        app.jinja_env.template_class = _timed_template(self)
+        app.before_request(self._start_request)
+        app.teardown_request(self._end_request)
+        if app.config['METRICS_URL']:
+            app.add_url_rule(app.config['METRICS_URL'], 'metrics', self.view)
+        app.extensions['metrics'] = self
+        if app.config['METRICS_DIR']:
+            _remove(self.path())
+
+    def current(self):
+        return getattr(self._local, 'stats', None)
+
+    def _start_request(self):
+        if request.endpoint in ('static', 'metrics'):
+            return
+        self._local.stats = RequestStats()
+
+    def _end_request(self, exc=None):
+        stats = self.current()
+        if stats is None:
+            return
+        self._local.stats = None
+        duration = time.time() - stats.start
+        endpoint = request.endpoint or 'unknown'
+        querycount = self.app.extensions.get('querycount')
+        queries = (querycount.request_queries() if querycount is not None else None) or []
+        sql_time = sum(elapsed for elapsed, statement in queries)
+        self.observe('microblog_request_duration_seconds', endpoint, duration)
+        self.observe('microblog_template_render_seconds', endpoint, stats.render_time)
+        self.observe('microblog_sql_queries', endpoint, len(queries))
+        self.observe('microblog_sql_duration_seconds', endpoint, sql_time)
+        if duration >= self.app.config['METRICS_SLOW_REQUEST']:
+            slowest = sorted(queries, key=lambda query: query[0], reverse=True)
+            slowest = slowest[:self.app.config['METRICS_SLOW_QUERIES']]
+            self.app.logger.warning('slow request %s %s: %.3fs, %d SQL statements in %.3fs, slowest:\n%s',
+                                    request.method, request.path, duration, len(queries), sql_time,
+                                    '\n'.join('%.3fs %s' % query for query in slowest))
+        if self.app.config['METRICS_DIR'] and time.time() - self._last_write >= self.app.config['METRICS_WRITE_INTERVAL']:
+            self.write()
+
+    def observe(self, name, endpoint, value):
+        buckets = _buckets[name]
+        with self._lock:
+            histogram = self._histograms.get((name, endpoint))
+            if histogram is None:
+                histogram = self._histograms[(name, endpoint)] = [[0] * (len(buckets) + 1), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(buckets)
+            histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def gauge(self, name, description, callback):
+        """
+        Registers a gauge, callback is called every time the metrics page is rendered and returns the current value. Gauges are
+        not written to METRICS_DIR, the page shows the value of the process that serves it.
+        """
+        self._gauges[name] = (description, callback)
+
+    def snapshot(self):
+        with self._lock:
+            return [[name, endpoint, list(counts), total, count]
+                    for (name, endpoint), (counts, total, count) in self._histograms.items()]
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def path(self, pid=None):
+        return os.path.join(self.app.config['METRICS_DIR'], 'metrics_%d.json' % (pid or os.getpid()))
+
+    def write(self):
+        """
+        Writes the histograms of this process to its file in METRICS_DIR. The file is replaced in one step, so a worker that
+        reads it at the same time never sees half of it.
+        """
+        if not self.app.config['METRICS_DIR']:
+            return
+        path = self.path()
+        temp = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(temp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp, path)
+        self._last_write = time.time()
+        if not self._atexit:
+            atexit.register(self.remove)
+            self._atexit = True
+
+    def remove(self):
+        """
+        Deletes the file of this process, called when it exits.
+        """
+        if self.app.config['METRICS_DIR']:
+            _remove(self.path())
+
+    def collect(self):
+        """
+        Returns the histograms of all the workers added together, with this process' own numbers taken from memory.
+        """
+        merged = {}
+        snapshots = [self.snapshot()]
+        if self.app.config['METRICS_DIR']:
+            own = self.path()
+            for path in glob.glob(os.path.join(self.app.config['METRICS_DIR'], 'metrics_*.json')):
+                if path == own:
+                    continue
+                try:
+                    pid = int(os.path.basename(path)[len('metrics_'):-len('.json')])
+                except ValueError:
+                    continue
+                if not _running(pid):
+                    _remove(path)
+                    continue
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (IOError, ValueError):
+                    continue
+        for snapshot in snapshots:
+            for name, endpoint, counts, total, count in snapshot:
+                histogram = merged.get((name, endpoint))
+                if histogram is None:
+                    merged[(name, endpoint)] = [list(counts), total, count]
+                else:
+                    histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                    histogram[1] += total
+                    histogram[2] += count
+        return merged
+
+    def render(self):
+        merged = self.collect()
+        lines = []
+        for name, description, buckets in HISTOGRAMS:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s histogram' % name)
+            for endpoint in sorted(endpoint for histogram, endpoint in merged if histogram == name):
+                counts, total, count = merged[(name, endpoint)]
+                cumulative = 0
+                for bound, bucket in zip(buckets + ('+Inf',), counts):
+                    cumulative += bucket
+                    lines.append('%s_bucket{endpoint="%s",le="%s"} %d' % (name, endpoint, bound, cumulative))
+                lines.append('%s_sum{endpoint="%s"} %s' % (name, endpoint, repr(float(total))))
+                lines.append('%s_count{endpoint="%s"} %d' % (name, endpoint, count))
+        for name in sorted(self._gauges):
+            description, callback = self._gauges[name]
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, repr(float(callback()))))
+        return '\n'.join(lines) + '\n'
+
+    def view(self):
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+
+_buckets = dict((name, buckets) for name, description, buckets in HISTOGRAMS)
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # it runs, as another user
+        return True
+    return True
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _timed_template(metrics):
+    class TimedTemplate(Template):
+        def render(self, *args, **kwargs):
+            stats = metrics.current()
+            if stats is None:
+                return Template.render(self, *args, **kwargs)
+            stats.render_depth += 1
+            start = time.time()
+            try:
+                return Template.render(self, *args, **kwargs)
+            finally:
+                stats.render_depth -= 1
+                if stats.render_depth == 0:
+                    stats.render_time += time.time() - start
+    return TimedTemplate
@@ -1,5 +1,9 @@
 from app import db
+from flask import url_for
 from hashlib import md5
+from sqlalchemy import event, func, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.base import NEVER_SET, NO_VALUE
 
 """
 Relational databases are good at storing relations between data items. Consider the case of a user writing a blog post. The user will have a record in the users table, and the post will have a record in the posts table. The most efficient way to record who wrote a given post is to link the two related records.
@@ -11,6 +15,52 @@ Our posts table will have the required id, the body of the post and a timestamp.
 We said we wanted to link users to the posts that they write. The way to do that is by adding a field to the post that contains the id of the user that wrote it. This id is called a foreign key. Our database design tool shows foreign keys as a link between the foreign key and the id field of the table it refers to. This kind of link is called a one-to-many relationship, one user writes many posts.
 """
 
+"""
+Gravatar identifies avatars by the md5 hash of an email address. A few of our users signed up with an address that is not the one their Gravatar account uses, the AVATAR_EMAIL_ALIASES table maps those addresses to the one that should be hashed instead.
+"""
+AVATAR_EMAIL_ALIASES = {
+    # zhouen.nathan@yahoo.com is replaced with nathanzhou@qq.com so that Gravatar can work for this email address
+    'zhouen.nathan@yahoo.com': 'nathanzhou@qq.com',
+}
+
+
+def hash_email(email):
+    email = AVATAR_EMAIL_ALIASES.get(email, email)
+    return md5(email.encode('utf-8')).hexdigest()
+
+
+"""
+The followers association table links users to the users they follow. It has no model class of its own, it is only used by the followed relationship below. Both columns together form the primary key, so a user cannot follow the same person twice, and the extra index on followed_id lets us find the followers of a user quickly when we fan out a new post.
+"""
+followers = db.Table('followers',
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_followers_followed_id', 'followed_id')
+)
+
+
+"""
+Flask-OpenID keeps the associations it makes with OpenID providers, and the nonces of the logins it has already seen, in a store. These
+two tables are used by the SQL store in app/openid_store.py. Both are looked up through their primary key, and the expires and timestamp
+indexes let the store delete what is too old without reading the rest of the table.
+"""
+openid_associations = db.Table('openid_association',
+    db.Column('server_url', db.String(2047), primary_key=True),
+    db.Column('handle', db.String(255), primary_key=True),
+    db.Column('secret', db.LargeBinary(128)),
+    db.Column('issued', db.Integer),
+    db.Column('lifetime', db.Integer),
+    db.Column('assoc_type', db.String(64)),
+    db.Column('expires', db.Integer, index=True)
+)
+
+openid_nonces = db.Table('openid_nonce',
+    db.Column('server_url', db.String(2047), primary_key=True),
+    db.Column('timestamp', db.Integer, primary_key=True),
+    db.Column('salt', db.String(40), primary_key=True),
+    db.Index('ix_openid_nonce_timestamp', 'timestamp')
+)
+
 class User(db.Model):
     """
     The User class that we just created contains several fields, defined as class variables. Fields are created as instances of the db.Column class, which takes the field type as an argument, plus other optional arguments that allow us, for example, to indicate which fields are unique and indexed.
@@ -28,22 +78,75 @@ class User(db.Model):
     """
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime)
+    email_hash = db.Column(db.String(32))
+
+    """
+    profile_version goes up every time one of the fields shown next to the user's posts or in the profile header changes. The fragment cache and the ETags of the profile page use it as a version stamp.
+    """
+    profile_version = db.Column(db.Integer, default=0)
+
+    """
+    Users with a lot of followers, or that post a lot, are not fanned out into the feeds of their followers when they write a post. Once a user is switched to fan-out-on-read the flag stays set, and the home timeline reads their posts directly from the post table instead.
+    """
+    fanout_on_read = db.Column(db.Boolean, default=False)
+
+    """
+    The number of posts the user wrote, of users following them and of users they follow. The profile page shows these, and counting the rows on every view would get slower as the user's history grows, so the counters are kept up to date in the same transaction as the rows they count (see app/counters.py).
+    """
+    post_count = db.Column(db.Integer, default=0)
+    follower_count = db.Column(db.Integer, default=0)
+    followed_count = db.Column(db.Integer, default=0)
+    followed = db.relationship('User',
+                               secondary=followers,
+                               primaryjoin=(followers.c.follower_id == id),
+                               secondaryjoin=(followers.c.followed_id == id),
+                               backref=db.backref('followers', lazy='dynamic'),
+                               lazy='dynamic')
 
     @staticmethod
-    def make_unique_nickname(nickname):
+    def make_unique_nickname(nickname, cached=True):
         """
-        This method simply adds a counter to the requested nickname until a unique name is found. For example, if the username "miguel" exists, the method will suggest "miguel2", but if that also exists it will go to "miguel3" and so on. Note that we coded the method as a static method, since it this operation does not apply to any particular instance of the class.
+        This method adds a counter to the requested nickname until a unique name is found. For example, if the username "miguel" exists, the method will suggest "miguel2", but if that also exists it will go to "miguel3" and so on. Note that we coded the method as a static method, since it this operation does not apply to any particular instance of the class.
+
+        Probing "miguel2", "miguel3", ... with one query each gets very slow for popular names, so instead we get every nickname that starts with the requested one at once from the nickname index (or, while the index is not loaded, with a single range query nickname >= 'miguel' AND nickname < 'miguem' that SQLite answers from the index on the nickname column), then we pick the first free counter in Python.
         """
-        if User.query.filter_by(nickname=nickname).first() is None:
+        from app.extensions import nicknames
+        taken = set()
+        base_taken = False
+        for existing in nicknames.prefixed(nickname, cached=cached):
+            suffix = existing[len(nickname):]
+            if suffix == '':
+                base_taken = True
+            elif suffix.isdigit() and suffix[0] != '0':
+                taken.add(int(suffix))
+        if not base_taken:
             return nickname
         version = 2
-        while True:
-            new_nickname = nickname + str(version)
-            if User.query.filter_by(nickname=new_nickname).first() is None:
-                break
+        while version in taken:
             version += 1
-        return new_nickname
-    
+        return nickname + str(version)
+
+    @staticmethod
+    def create_unique(nickname, email, attempts=5):
+        """
+        Two signups asking for the same nickname at the same time can both be handed the same suggestion by make_unique_nickname. The unique index on the nickname column makes the second commit fail, so we roll back and ask for a new suggestion, which now sees the winner. The retries ask the database, the nickname index of this process may not know the winner yet. If it was the email that collided, the other request already created this very user and we return it.
+        """
+        for attempt in range(attempts):
+            user = User(nickname=User.make_unique_nickname(nickname, cached=attempt == 0), email=email)
+            db.session.add(user)
+            try:
+                db.session.commit()
+                return user
+            except IntegrityError:
+                db.session.rollback()
+                existing = User.query.filter_by(email=email).first()
+                if existing is not None:
+                    return existing
+        raise RuntimeError('could not allocate a unique nickname for %r' % nickname)
+
+    def is_following(self, user):
+        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+
     @property
     def is_authenticated(self):
         return True
@@ -69,13 +172,12 @@ class User(db.Model):
         Turns out with the Gravatar service this is really easy to do. You just need to create an md5 hash of the user email and then incorporate it into the specially crafted URL that you see above. After the md5 of the email you can provide a number of options to customize the avatar. The d=mm determines what placeholder image is returned when a user does not have an Gravatar account. The mm option returns the "mystery man" image, a gray silhouette of a person. The s=N option requests the avatar scaled to the given size in pixels.
 
         The nice thing about making the User class responsible for returning avatars is that if some day we decide Gravatar avatars are not what we want, we just rewrite the avatar method to return different URLs (even ones that points to our own web server, if we decide we want to host our own avatars), and all our templates will start showing the new avatars automatically.
+
+        The hash of the email is stored in the email_hash column, it is computed once when the email is set (see _update_email_hash below) and this method only has to format the URL.
+
+        That day has come: the URL now points to the avatar view on our own server, which serves the Gravatar image from a disk cache, or a placeholder drawn from the hash for users without one (see app/avatars.py).
         """
-        email = self.email
-        # https: // en.gravatar.com / userimage / 76305420 / e795a415c4e6e3415c961787136428ef.jpg?size = 200
-        # this line is to replace zhouen.nathan@yahoo.com with nathanzhou@qq.com so that Gravatar can work for this email address
-        if email == "zhouen.nathan@yahoo.com":
-            email = "nathanzhou@qq.com"
-        return 'http://www.gravatar.com/avatar/%s?d=mm&s=%d' % (md5(email.encode('utf-8')).hexdigest(), size)
+        return url_for('main.avatar', email_hash=self.email_hash or hash_email(self.email), size=size)
     
     def __repr__(self):
         """
@@ -83,9 +185,30 @@ class User(db.Model):
         """
         return '<User %r>' % (self.nickname)
 
+@event.listens_for(User.email, 'set')
+def _update_email_hash(target, value, oldvalue, initiator):
+    target.email_hash = hash_email(value) if value is not None else None
+
+
+@event.listens_for(User.nickname, 'set')
+@event.listens_for(User.email, 'set')
+@event.listens_for(User.about_me, 'set')
+def _bump_profile_version(target, value, oldvalue, initiator):
+    """
+    The increment is done by the UPDATE itself. The instance being edited is often a snapshot from the identity cache, and its
+    profile_version can be behind the row when another process has bumped it since, adding one in Python would then reuse a version. A
+    user that is not in the database yet keeps the default.
+    """
+    if oldvalue in (NO_VALUE, NEVER_SET) or value == oldvalue or not inspect(target).has_identity:
+        return
+    target.profile_version = func.coalesce(User.profile_version, 0) + 1
+
+
 class Post(db.Model):
     """
+    Post listings are paged by (timestamp, id) cursors, the composite index on (user_id, timestamp, id) lets SQLite seek directly to the start of any page of a user's posts.
     """
+    __table_args__ = (db.Index('ix_post_user_timestamp_id', 'user_id', 'timestamp', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime)
@@ -94,6 +217,35 @@ class Post(db.Model):
     def __repr__(self):
         return '<Post %r>' % (self.body)
 
+
+class FeedEntry(db.Model):
+    """
+    The feed table holds the materialized home timeline of every user: one row per post that the user should see, written when the post is created. Reading the home page is then a range scan over the (user_id, timestamp, post_id) index, newest first, instead of a join between the followers and post tables.
+    """
+    __tablename__ = 'feed'
+    __table_args__ = (db.Index('ix_feed_user_timestamp_post', 'user_id', 'timestamp', 'post_id'),)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<FeedEntry %r %r>' % (self.user_id, self.post_id)
+
+
+class ImportProgress(db.Model):
+    """
+    The bulk importer (app/bulk_import.py) records here how many records of each source file it has committed. The row is written in the same transaction as the records themselves, so after an interruption the import picks up exactly where the last commit left it.
+    """
+    __tablename__ = 'import_progress'
+    source = db.Column(db.String(255), primary_key=True)
+    position = db.Column(db.Integer, default=0)
+    inserted = db.Column(db.Integer, default=0)
+    skipped = db.Column(db.Integer, default=0)
+    invalid = db.Column(db.Integer, default=0)
+
+    def __repr__(self):
+        return '<ImportProgress %r %r>' % (self.source, self.position)
+
 """
 We have added the Post class, which will represent blog posts written by users. The user_id field in the Post class was initialized as a foreign key, so that Flask-SQLAlchemy knows that this field will link to a user.
 
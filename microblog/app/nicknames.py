@@ -0,0 +1,203 @@
+import bisect
+import sys
+import threading
+import time
+
+from sqlalchemy import select
+
+from .events import DELETE
+
+"""
+Checking if a nickname is taken, suggesting a free one at signup and completing nicknames as they are typed all ask the user table the
+same question: which nicknames are there, or which of them start with these letters. The NicknameIndex answers it from memory. It
+keeps every nickname in a sorted list, so the nicknames that start with a prefix are one bisect away, and a dictionary from nickname
+to user id for exact lookups.
+
+The index is loaded by a background thread the first time it is used. Until that load finishes the index is cold and every question
+goes to the database, so the first requests after a start never wait for the whole user table to be read. Afterwards:
+
+- Nicknames changed through the session of this process are applied right after the commit (the index subscribes to the ChangeBus).
+- Changes made by other worker processes or written with Core (db_import.py) are picked up by a full reload, started in the
+  background when the index is older than NICKNAME_INDEX_REFRESH seconds.
+
+So the index can be a little behind for changes made elsewhere. That is fine for suggestions and autocompletion, and where a wrong
+answer would matter (saving a nickname) the unique index on the nickname column still has the last word.
+
+stats() reports the size of the index and an estimate of the memory it takes, the same numbers are served by the metrics page.
+"""
+
+
+class NicknameIndex(object):
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._names = []
+        self._ids = {}
+        self._by_id = {}
+        self._memory = 0
+        self._loaded_at = None
+        self._loading = False
+        self._pending = None
+        self.hits = 0
+        self.fallbacks = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('NICKNAME_INDEX', True)
+        app.config.setdefault('NICKNAME_INDEX_REFRESH', 300)
+        app.config.setdefault('NICKNAME_AUTOCOMPLETE_LIMIT', 10)
+        self.app = app
+        app.extensions['nicknames'] = self
+
+    @property
+    def warm(self):
+        return self._loaded_at is not None
+
+    def lookup(self, nickname):
+        """
+        Returns the id of the user with this nickname, or None.
+        """
+        if self._use_index():
+            with self._lock:
+                self.hits += 1
+                return self._ids.get(nickname)
+        from .models import User
+        table = User.__table__
+        return self._engine().execute(select([table.c.id]).where(table.c.nickname == nickname)).scalar()
+
+    def is_taken(self, nickname):
+        return self.lookup(nickname) is not None
+
+    def prefixed(self, prefix, limit=None, cached=True):
+        """
+        Returns the nicknames that start with prefix in alphabetical order, at most limit of them. With cached=False the
+        database is asked even when the index is loaded.
+        """
+        if cached and self._use_index():
+            with self._lock:
+                self.hits += 1
+                names = []
+                for i in range(bisect.bisect_left(self._names, prefix), len(self._names)):
+                    name = self._names[i]
+                    if not name.startswith(prefix) or (limit is not None and len(names) >= limit):
+                        break
+                    names.append(name)
+                return names
+        from .models import User
+        table = User.__table__
+        query = select([table.c.nickname]).order_by(table.c.nickname).limit(limit)
+        if prefix:
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            query = query.where(table.c.nickname >= prefix).where(table.c.nickname < upper)
+        return [name for (name,) in self._engine().execute(query)]
+
+    def load(self):
+        """
+        Reads every nickname and swaps the new index in. Changes committed while the load was running are applied again
+        afterwards, the rows we read may predate them.
+        """
+        from .models import User
+        table = User.__table__
+        with self._lock:
+            self._pending = set()
+        try:
+            rows = self._engine().execute(select([table.c.id, table.c.nickname]).where(table.c.nickname != None)).fetchall()
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        names = sorted(row.nickname for row in rows)
+        ids = dict((row.nickname, row.id) for row in rows)
+        by_id = dict((row.id, row.nickname) for row in rows)
+        memory = (sys.getsizeof(names) + sys.getsizeof(ids) + sys.getsizeof(by_id) +
+                  sum(sys.getsizeof(name) + sys.getsizeof(user_id) for name, user_id in ids.items()))
+        with self._lock:
+            self._names, self._ids, self._by_id, self._memory = names, ids, by_id, memory
+            self._loaded_at = time.time()
+            pending, self._pending = self._pending, None
+        for user_id in pending:
+            self._refresh(user_id)
+        return len(names)
+
+    def update(self, change):
+        """
+        Applies a ChangeBus change of a user to the index.
+        """
+        with self._lock:
+            if self._pending is not None:
+                self._pending.add(change.id)
+            if self._loaded_at is None:
+                return
+        if change.op == DELETE:
+            self._apply(change.id, None)
+        else:
+            self._refresh(change.id)
+
+    def clear(self):
+        with self._lock:
+            self._names, self._ids, self._by_id, self._memory = [], {}, {}, 0
+            self._loaded_at = None
+            self._pending = None
+
+    def stats(self):
+        with self._lock:
+            return {'warm': self.warm, 'size': len(self._names), 'memory': self._memory,
+                    'hits': self.hits, 'fallbacks': self.fallbacks}
+
+    def _engine(self):
+        from app import db
+        return db.get_engine(self.app)
+
+    def _use_index(self):
+        if not self.app.config['NICKNAME_INDEX']:
+            return False
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.time() - loaded_at > self.app.config['NICKNAME_INDEX_REFRESH']:
+            self._start_loading()
+        if loaded_at is None:
+            with self._lock:
+                self.fallbacks += 1
+            return False
+        return True
+
+    def _start_loading(self):
+        with self._lock:
+            if self._loading:
+                return
+            self._loading = True
+        thread = threading.Thread(target=self._run_load, name='nickname-index-loader')
+        thread.daemon = True
+        thread.start()
+
+    def _run_load(self):
+        try:
+            with self.app.app_context():
+                self.load()
+        except Exception:
+            self.app.logger.exception('nickname index load failed')
+        finally:
+            with self._lock:
+                self._loading = False
+
+    def _refresh(self, user_id):
+        from .models import User
+        table = User.__table__
+        self._apply(user_id, self._engine().execute(select([table.c.nickname]).where(table.c.id == user_id)).scalar())
+
+    def _apply(self, user_id, nickname):
+        with self._lock:
+            old = self._by_id.pop(user_id, None)
+            if old is not None:
+                self._names.pop(bisect.bisect_left(self._names, old))
+                del self._ids[old]
+                self._memory -= sys.getsizeof(old) + sys.getsizeof(user_id)
+            if nickname is not None:
+                other = self._ids.get(nickname)
+                if other is not None:
+                    self._names.pop(bisect.bisect_left(self._names, nickname))
+                    del self._by_id[other]
+                bisect.insort(self._names, nickname)
+                self._ids[nickname] = user_id
+                self._by_id[user_id] = nickname
+                self._memory += sys.getsizeof(nickname) + sys.getsizeof(user_id)
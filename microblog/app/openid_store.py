@@ -0,0 +1,152 @@
+import contextlib
+import threading
+import time
+
+from flask import current_app
+from openid.association import Association
+from openid.store.filestore import FileOpenIDStore
+from openid.store.interface import OpenIDStore
+from openid.store import nonce
+from sqlalchemy import and_, create_engine, exc, literal_column, select
+from sqlalchemy.pool import StaticPool
+
+from app import db
+from .models import openid_associations, openid_nonces
+
+"""
+Flask-OpenID used to keep its associations and nonces in the tmp directory, one file for every association and every login. Nothing
+ever removed the nonce files, so tmp kept growing and every login did a little more directory work than the one before.
+
+The SQLStore keeps them in the openid_association and openid_nonce tables instead. Every lookup goes through a primary key, a nonce is
+recorded with a single INSERT that fails if it was already used, and expired rows are deleted a batch at a time: a call into the store
+that finds the cleanup due deletes at most OPENID_STORE_CLEANUP_BATCH rows of each table, and when that was not all of them the next
+call deletes the next batch, so no login ever waits for a long DELETE.
+
+OPENID_STORE selects the store:
+
+- 'sql' keeps the tables in the application database, shared by all the worker processes.
+- 'memory' keeps them in an in-memory SQLite database of the process. It is the fastest, but it only works when the application runs
+  in one process, and the associations are lost on a restart (the providers simply make new ones).
+- 'filesystem' is the old store in OPENID_FS_STORE_PATH.
+"""
+
+
+class SQLStore(OpenIDStore):
+    def __init__(self, get_engine, cleanup_interval=300, cleanup_batch=500, lock=None):
+        self.get_engine = get_engine
+        self.cleanup_interval = cleanup_interval
+        self.cleanup_batch = cleanup_batch
+        self._lock = lock or contextlib.nullcontext()
+        self._cleanup_lock = threading.Lock()
+        self._next_cleanup = 0
+
+    def storeAssociation(self, server_url, association):
+        self._collect()
+        with self._lock, self.get_engine().begin() as conn:
+            conn.execute(openid_associations.delete().where(and_(openid_associations.c.server_url == server_url,
+                                                                 openid_associations.c.handle == association.handle)))
+            conn.execute(openid_associations.insert(), server_url=server_url, handle=association.handle,
+                         secret=association.secret, issued=association.issued, lifetime=association.lifetime,
+                         assoc_type=association.assoc_type, expires=association.issued + association.lifetime)
+
+    def getAssociation(self, server_url, handle=None):
+        self._collect()
+        query = select([openid_associations]).where(and_(openid_associations.c.server_url == server_url,
+                                                         openid_associations.c.expires > int(time.time())))
+        if handle is not None:
+            query = query.where(openid_associations.c.handle == handle)
+        with self._lock:
+            row = self.get_engine().execute(query.order_by(openid_associations.c.issued.desc()).limit(1)).first()
+        if row is None:
+            return None
+        return Association(row.handle, row.secret, row.issued, row.lifetime, row.assoc_type)
+
+    def removeAssociation(self, server_url, handle):
+        with self._lock:
+            result = self.get_engine().execute(openid_associations.delete().where(
+                and_(openid_associations.c.server_url == server_url, openid_associations.c.handle == handle)))
+        return result.rowcount > 0
+
+    def useNonce(self, server_url, timestamp, salt):
+        """
+        A nonce can be used once. Nonces older than nonce.SKEW are refused without looking at the table, which is why the cleanup
+        can forget them.
+        """
+        if abs(timestamp - time.time()) > nonce.SKEW:
+            return False
+        self._collect()
+        try:
+            with self._lock:
+                self.get_engine().execute(openid_nonces.insert(), server_url=server_url, timestamp=timestamp, salt=salt)
+        except exc.IntegrityError:
+            return False
+        return True
+
+    def cleanupNonces(self):
+        return self._delete_all(openid_nonces, openid_nonces.c.timestamp < int(time.time()) - nonce.SKEW)
+
+    def cleanupAssociations(self):
+        return self._delete_all(openid_associations, openid_associations.c.expires <= int(time.time()))
+
+    def _delete_all(self, table, condition):
+        deleted = 0
+        while True:
+            count = self._delete_batch(table, condition)
+            deleted += count
+            if count < self.cleanup_batch:
+                return deleted
+
+    def _delete_batch(self, table, condition):
+        rowid = literal_column('rowid')
+        batch = select([rowid]).select_from(table).where(condition).limit(self.cleanup_batch)
+        with self._lock:
+            return self.get_engine().execute(table.delete().where(rowid.in_(batch))).rowcount
+
+    def _collect(self):
+        """
+        Runs one batch of the cleanup when it is due. Only one thread does it, the others go on without waiting.
+        """
+        if time.time() < self._next_cleanup or not self._cleanup_lock.acquire(False):
+            return
+        try:
+            now = int(time.time())
+            nonces = self._delete_batch(openid_nonces, openid_nonces.c.timestamp < now - nonce.SKEW)
+            associations = self._delete_batch(openid_associations, openid_associations.c.expires <= now)
+            more = nonces == self.cleanup_batch or associations == self.cleanup_batch
+            self._next_cleanup = time.time() + (0 if more else self.cleanup_interval)
+        finally:
+            self._cleanup_lock.release()
+
+
+class OpenIDStores(object):
+    """
+    The store factory given to Flask-OpenID. It builds the store selected by OPENID_STORE once per application, and Flask-OpenID
+    gets that same store on every login.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('OPENID_STORE', 'sql')
+        app.config.setdefault('OPENID_STORE_CLEANUP_INTERVAL', 300)
+        app.config.setdefault('OPENID_STORE_CLEANUP_BATCH', 500)
+        app.config.setdefault('OPENID_FS_STORE_PATH', None)
+        kind = app.config['OPENID_STORE']
+        options = {'cleanup_interval': app.config['OPENID_STORE_CLEANUP_INTERVAL'],
+                   'cleanup_batch': app.config['OPENID_STORE_CLEANUP_BATCH']}
+        if kind == 'sql':
+            store = SQLStore(lambda: db.get_engine(app), **options)
+        elif kind == 'memory':
+            engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+            openid_associations.create(engine)
+            openid_nonces.create(engine)
+            store = SQLStore(lambda: engine, lock=threading.Lock(), **options)
+        elif kind == 'filesystem':
+            store = FileOpenIDStore(app.config['OPENID_FS_STORE_PATH'])
+        else:
+            raise ValueError('unknown OPENID_STORE %r' % kind)
+        app.extensions['openid_store'] = store
+
+    def __call__(self):
+        return current_app.extensions['openid_store']
@@ -0,0 +1,80 @@
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+"""
+Post listings are paged with keyset (cursor) pagination instead of OFFSET. With OFFSET the database has to walk over every skipped
+row, so page 500 of a heavy poster's profile costs 500 times more than page 1. A cursor remembers the (timestamp, id) of the last
+post shown, and the next page starts right after it, which is a single seek on the (user_id, timestamp, id) index no matter how deep
+the page is.
+
+The id is part of the key because several posts can share a timestamp, the pair is always unique so no post is skipped or shown
+twice. Cursors are passed around in URLs as "<timestamp>_<id>" strings.
+"""
+
+CURSOR_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+class KeysetPage(object):
+    def __init__(self, items, next_cursor=None, cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.cursor = cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(timestamp, id):
+    return '%s_%d' % (timestamp.strftime(CURSOR_TIMESTAMP_FORMAT), id)
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (timestamp, id) pair stored in a cursor, or None if the cursor is missing or malformed, which simply sends the
+    user back to the first page.
+    """
+    if not cursor:
+        return None
+    try:
+        timestamp, id = cursor.split('_', 1)
+        return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(id)
+    except ValueError:
+        return None
+
+
+def older_than(timestamp_column, id_column, key):
+    """
+    Builds the condition that selects the rows that come after key in (timestamp DESC, id DESC) order. It is written as a range
+    on the timestamp plus a tie breaker on the id, so SQLite can seek the composite index instead of evaluating an OR for every row.
+    """
+    timestamp, id = key
+    return and_(timestamp_column <= timestamp,
+                or_(timestamp_column < timestamp, id_column < id))
+
+
+def paginate(query, timestamp_column, id_column, cursor, per_page):
+    """
+    Returns one page of an ORM query, newest first. We ask for one more row than we need, so we know whether there is a next page
+    without running a COUNT.
+    """
+    key = decode_cursor(cursor)
+    if key is not None:
+        query = query.filter(older_than(timestamp_column, id_column, key))
+    rows = query.order_by(timestamp_column.desc(), id_column.desc()).limit(per_page + 1).all()
+    return make_page(rows[:per_page], len(rows) > per_page, cursor,
+                     lambda row: (getattr(row, timestamp_column.key), getattr(row, id_column.key)))
+
+
+def make_page(items, has_next, cursor, key_of):
+    next_cursor = None
+    if has_next and items:
+        next_cursor = encode_cursor(*key_of(items[-1]))
+    return KeysetPage(items, next_cursor, cursor)
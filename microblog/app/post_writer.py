@@ -0,0 +1,225 @@
+import atexit
+import queue
+import threading
+import time
+
+"""
+SQLite lets one connection write at a time, and every commit waits for the journal to reach the disk. When each new post is its own
+transaction, the number of posts we can take per second is the number of commits the disk can do per second, no matter how many
+request threads are waiting.
+
+With POST_GROUP_COMMIT enabled the PostWriter takes the posts from the request threads through a queue instead, and a single writer
+thread publishes them in groups: it takes the first post that arrives, then keeps taking posts until it has POST_BATCH_SIZE of them or
+POST_BATCH_WINDOW seconds have passed, and commits the whole group at once. The request thread waits until the commit of its group is
+done, so when publish() returns the post is in the database just like before, only many posts share one commit. A post that makes
+the group fail (the author was deleted in the meantime, for example) does not take the others down, the group is rolled back and
+its posts are committed one by one, and the failing one raises its error in its own request.
+
+The queue holds at most POST_QUEUE_SIZE posts. When it is full, publish() waits POST_QUEUE_TIMEOUT seconds for room and then raises
+PostQueueFull, the view answers with a 503 so that clients back off instead of piling up more requests. The same happens when the
+writer does not get to a queued post within POST_WRITE_TIMEOUT seconds (the post is then taken out of the queue, unless its group is
+already being written), and once stop() has been called: the posts still queued are written, new ones are refused.
+
+The size of every group and the time its commit took are recorded in the microblog_post_batch_size and
+microblog_post_commit_seconds histograms of the metrics page, and stats() returns the totals and the length of the queue.
+
+Without POST_GROUP_COMMIT publish() writes and commits the post in the request, as the index view always did.
+"""
+
+
+class PostQueueFull(Exception):
+    pass
+
+
+class PendingPost(object):
+    def __init__(self, author_id, body, timestamp):
+        self.author_id = author_id
+        self.body = body
+        self.timestamp = timestamp
+        self.post_id = None
+        self.error = None
+        self.taken = False
+        self.cancelled = False
+        self.done = threading.Event()
+
+
+_STOP = object()
+
+
+class PostWriter(object):
+    def __init__(self, app=None):
+        self.app = None
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._atexit = False
+        self._stopped = False
+        self.batches = 0
+        self.posts = 0
+        self.failures = 0
+        self.largest_batch = 0
+        self.commit_time = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('POST_GROUP_COMMIT', False)
+        app.config.setdefault('POST_QUEUE_SIZE', 1000)
+        app.config.setdefault('POST_QUEUE_TIMEOUT', 2.0)
+        app.config.setdefault('POST_BATCH_SIZE', 100)
+        app.config.setdefault('POST_BATCH_WINDOW', 0.005)
+        app.config.setdefault('POST_WRITE_TIMEOUT', 10.0)
+        self.app = app
+        self._stopped = False
+        app.extensions['post_writer'] = self
+
+    def publish(self, author_id, body, timestamp=None):
+        """
+        Publishes a post and returns its id once it has been committed.
+        """
+        if not self.app.config['POST_GROUP_COMMIT']:
+            from app import db
+            from . import timeline
+            post = timeline.publish(author_id, body, timestamp)
+            db.session.commit()
+            return post.id
+        pending = PendingPost(author_id, body, timestamp)
+        posts = self._ensure_started()
+        try:
+            posts.put(pending, timeout=self.app.config['POST_QUEUE_TIMEOUT'])
+        except queue.Full:
+            raise PostQueueFull('%d posts are waiting to be written' % posts.qsize())
+        if not pending.done.wait(self.app.config['POST_WRITE_TIMEOUT']):
+            with self._lock:
+                pending.cancelled = not pending.taken
+            if pending.cancelled:
+                raise PostQueueFull('the post writer did not get to the post in time')
+            # its group is being committed right now
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.post_id
+
+    def stats(self):
+        with self._lock:
+            return {'queued': self._queue.qsize() if self._queue is not None else 0, 'batches': self.batches,
+                    'posts': self.posts, 'failures': self.failures, 'largest_batch': self.largest_batch,
+                    'commit_time': self.commit_time}
+
+    def _ensure_started(self):
+        """
+        Returns the queue of the writer thread, starting the thread if it is not running (or has died). Raises PostQueueFull once the
+        writer has been stopped.
+        """
+        with self._lock:
+            if self._stopped:
+                raise PostQueueFull('the post writer is stopped')
+            if self._thread is not None and self._thread.is_alive():
+                return self._queue
+            if self._queue is None:
+                self._queue = queue.Queue(self.app.config['POST_QUEUE_SIZE'])
+            self._thread = threading.Thread(target=self._run, args=(self._queue,), name='post-writer')
+            self._thread.daemon = True
+            self._thread.start()
+            if not self._atexit:
+                atexit.register(self.stop)
+                self._atexit = True
+            return self._queue
+
+    def stop(self):
+        """
+        Writes the posts that are already queued and stops the writer thread. From then on publish() refuses new posts, until
+        init_app() binds the writer again.
+        """
+        with self._lock:
+            self._stopped = True
+            thread, self._thread = self._thread, None
+            posts, self._queue = self._queue, None
+        if thread is not None and thread.is_alive():
+            posts.put(_STOP)
+            thread.join()
+        # a post that came in while we were stopping has nobody left to write it
+        while posts is not None:
+            try:
+                item = posts.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                item.error = PostQueueFull('the post writer is stopped')
+                item.done.set()
+
+    def _run(self, pending):
+        from app import db
+        with self.app.app_context():
+            stopping = False
+            while not stopping:
+                first = pending.get()
+                if first is _STOP:
+                    break
+                batch = [first]
+                deadline = time.time() + self.app.config['POST_BATCH_WINDOW']
+                while len(batch) < self.app.config['POST_BATCH_SIZE']:
+                    remaining = deadline - time.time()
+                    try:
+                        item = pending.get(timeout=remaining) if remaining > 0 else pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                batch = self._take(batch)
+                if not batch:
+                    continue
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    self.app.logger.exception('post writer failed')
+                    for item in batch:
+                        if not item.done.is_set():
+                            item.error = e
+                            item.done.set()
+                finally:
+                    db.session.remove()
+
+    def _take(self, batch):
+        """
+        Marks the posts of the batch as being written and leaves out the ones whose request gave up on them.
+        """
+        with self._lock:
+            for item in batch:
+                item.taken = not item.cancelled
+        return [item for item in batch if item.taken]
+
+    def _write(self, batch):
+        from app import db
+        from . import timeline
+        start = time.time()
+        try:
+            for item in batch:
+                item.post_id = timeline.publish(item.author_id, item.body, item.timestamp).id
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) > 1:
+                for item in batch:
+                    self._write([item])
+                return
+            batch[0].post_id = None
+            batch[0].error = e
+            with self._lock:
+                self.failures += 1
+            batch[0].done.set()
+            return
+        elapsed = time.time() - start
+        with self._lock:
+            self.batches += 1
+            self.posts += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.commit_time += elapsed
+        metrics = self.app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.observe('microblog_post_batch_size', 'post_writer', len(batch))
+            metrics.observe('microblog_post_commit_seconds', 'post_writer', elapsed)
+        for item in batch:
+            item.done.set()
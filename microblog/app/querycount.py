@@ -0,0 +1,142 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""
+A page that lazy loads one row per item it renders (the classic N+1 problem) still looks fine with three posts on a development
+database, so we want the tests to catch it. The QueryCounter listens to every statement that SQLAlchemy sends to the database and
+offers two ways to put a budget on them:
+
+- count_queries() and max_queries(n) are context managers for tests, the second one fails with QueryBudgetExceeded when the code
+  inside the block runs more than n statements.
+- With SQLALCHEMY_MAX_QUERIES_PER_REQUEST set (we only do that in debug and testing), every request that issues more statements than
+  the limit raises QueryBudgetExceeded, so a test that renders a page fails straight away.
+
+Every statement of a request is also timed, request_queries() returns them with their durations. The metrics extension reads them
+from there instead of listening to the engine a second time (see app/metrics.py).
+"""
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryCounter(object):
+    _listening = False
+
+    def __init__(self, app=None):
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_MAX_QUERIES_PER_REQUEST', None)
+        if not QueryCounter._listening:
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+            event.listen(Engine, 'handle_error', _handle_error)
+            QueryCounter._listening = True
+        if self not in _counters:
+            _counters.append(self)
+        app.before_request(self._start_request)
+        app.after_request(self._check_request)
+        app.teardown_request(self._end_request)
+        app.extensions['querycount'] = self
+
+    def _recorders(self):
+        recorders = getattr(self._local, 'recorders', None)
+        if recorders is None:
+            recorders = self._local.recorders = []
+        return recorders
+
+    def _discard(self, statements):
+        recorders = self._recorders()
+        for i, recorder in enumerate(recorders):
+            if recorder is statements:
+                del recorders[i]
+                return
+
+    def _record(self, statement):
+        for recorder in self._recorders():
+            recorder.append(statement)
+
+    def _time(self, elapsed, statement):
+        timings = getattr(self._local, 'timings', None)
+        if timings is not None:
+            timings.append((elapsed, statement))
+
+    def request_queries(self):
+        """
+        Returns the (seconds, statement) pairs of the statements issued so far by the current request, or None outside of one.
+        """
+        return g.get('_querycount_timings')
+
+    @contextmanager
+    def count_queries(self):
+        """
+        Collects the SQL statements executed by the current thread inside the block. The list is yielded right away and keeps
+        growing until the block exits.
+        """
+        statements = []
+        self._recorders().append(statements)
+        try:
+            yield statements
+        finally:
+            self._discard(statements)
+
+    @contextmanager
+    def max_queries(self, limit):
+        with self.count_queries() as statements:
+            yield statements
+        if len(statements) > limit:
+            raise QueryBudgetExceeded('%d SQL statements issued, the budget is %d:\n%s' % (
+                len(statements), limit, '\n'.join(statements)))
+
+    def _start_request(self):
+        statements = []
+        self._recorders().append(statements)
+        g._querycount_statements = statements
+        g._querycount_timings = self._local.timings = []
+
+    def _check_request(self, response):
+        statements = g.get('_querycount_statements')
+        limit = current_app.config['SQLALCHEMY_MAX_QUERIES_PER_REQUEST']
+        if statements is not None and limit is not None and len(statements) > limit:
+            raise QueryBudgetExceeded('%d SQL statements issued by this request, the budget is %d:\n%s' % (
+                len(statements), limit, '\n'.join(statements)))
+        return response
+
+    def _end_request(self, exc=None):
+        # the lists stay in g until the request is gone, the metrics teardown may run after this one
+        self._local.timings = None
+        statements = g.get('_querycount_statements')
+        if statements is not None:
+            self._discard(statements)
+
+
+_counters = []
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('querycount_start', []).append(time.time())
+    for counter in _counters:
+        counter._record(statement)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('querycount_start')
+    if not starts:
+        return
+    elapsed = time.time() - starts.pop()
+    for counter in _counters:
+        counter._time(elapsed, statement)
+
+
+def _handle_error(context):
+    starts = context.connection.info.get('querycount_start') if context.connection is not None else None
+    if starts:
+        starts.pop()
@@ -0,0 +1,92 @@
+from sqlalchemy import DDL, event, text
+from sqlalchemy.orm import joinedload
+
+from app import db
+from .models import Post
+from .pagination import KeysetPage
+
+"""
+Searching with LIKE '%word%' has to read every row of the post table. Instead we keep a SQLite FTS5 index of the post bodies in the
+post_search virtual table. It is an external content table: it does not store a second copy of the bodies, only the index, and
+points back to the post table through the post id (the rowid). Three triggers on the post table keep the index in sync on every
+insert, update and delete, no matter if the change comes from the ORM, from a Core statement or from the bulk importer.
+
+Results are ranked with the BM25 function of FTS5 (lower is better) and paged with a cursor made of the (rank, id) of the last
+result shown, like the post listings in pagination.py are paged by (timestamp, id).
+
+The virtual table and the triggers are created together with the post table by db.create_all(), and by migration 011 for existing
+databases. db_reindex.py rebuilds the index from the post table.
+"""
+
+SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE post_search USING fts5(body, content='post', content_rowid='id')",
+    "CREATE TRIGGER post_search_insert AFTER INSERT ON post BEGIN "
+    "INSERT INTO post_search(rowid, body) VALUES (new.id, new.body); END",
+    "CREATE TRIGGER post_search_delete AFTER DELETE ON post BEGIN "
+    "INSERT INTO post_search(post_search, rowid, body) VALUES ('delete', old.id, old.body); END",
+    "CREATE TRIGGER post_search_update AFTER UPDATE OF body ON post BEGIN "
+    "INSERT INTO post_search(post_search, rowid, body) VALUES ('delete', old.id, old.body); "
+    "INSERT INTO post_search(rowid, body) VALUES (new.id, new.body); END",
+]
+
+for statement in SEARCH_DDL:
+    event.listen(Post.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Post.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS post_search').execute_if(dialect='sqlite'))
+
+_SEARCH = text(
+    'SELECT id, rank FROM ('
+    'SELECT rowid AS id, bm25(post_search) AS rank FROM post_search WHERE post_search MATCH :query'
+    ') WHERE :after_rank IS NULL OR rank > :after_rank OR (rank = :after_rank AND id > :after_id) '
+    'ORDER BY rank, id LIMIT :limit')
+
+
+def match_query(terms):
+    """
+    Turns what the user typed into an FTS5 query. Every word is quoted, so characters like quotes, dashes or a word like NOT are
+    searched for instead of being read as query syntax, and all the words have to be in the post.
+    """
+    words = terms.split()
+    return ' '.join('"%s"' % word.replace('"', '""') for word in words)
+
+
+def encode_cursor(rank, id):
+    return '%r_%d' % (rank, id)
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        rank, id = cursor.rsplit('_', 1)
+        return float(rank), int(id)
+    except ValueError:
+        return None
+
+
+def search_posts(terms, per_page, cursor=None, session=None):
+    """
+    Returns one page of the posts that match terms, best match first, with their authors loaded.
+    """
+    session = session or db.session
+    query = match_query(terms)
+    if not query:
+        return KeysetPage([], None, cursor)
+    after_rank, after_id = decode_cursor(cursor) or (None, None)
+    rows = session.execute(_SEARCH, {'query': query, 'after_rank': after_rank, 'after_id': after_id,
+                                     'limit': per_page + 1}).fetchall()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    posts = {}
+    if rows:
+        posts = dict((post.id, post) for post in session.query(Post).options(joinedload(Post.author))
+                     .filter(Post.id.in_([row.id for row in rows])))
+    next_cursor = encode_cursor(rows[-1].rank, rows[-1].id) if has_next else None
+    return KeysetPage([posts[row.id] for row in rows if row.id in posts], next_cursor, cursor)
+
+
+def rebuild(session=None):
+    """
+    Rebuilds the whole index from the post table, for databases that had posts before the index existed.
+    """
+    session = session or db.session
+    session.execute("INSERT INTO post_search(post_search) VALUES ('rebuild')")
@@ -0,0 +1,158 @@
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import DateTime, and_, func, literal, select
+from sqlalchemy.orm import joinedload
+
+from app import db
+from . import counters  # the post_count trigger is created with the post table
+from .models import User, Post, FeedEntry, followers
+from .pagination import decode_cursor, older_than, make_page
+
+"""
+The home timeline shows the posts of the user and of everyone the user follows, newest first.
+
+Doing that with a join between followers and post on every page view gets slower with every user that is followed, so instead we
+fan out on write: when a post is published we add a row to the feed table of the author and of each follower. Reading the home
+page then only needs the (user_id, timestamp, post_id) index of the feed table.
+
+Fanning out a post written by someone with a huge number of followers (or by someone who posts all the time) would make every one
+of their writes very expensive. Those authors are switched to fan-out-on-read: their posts only go to their own feed, and the
+timelines of their followers merge in their recent posts from the post table when the page is read.
+
+All the functions here work with Core statements on the current session and never commit, the caller decides when the transaction
+ends.
+"""
+
+feed = FeedEntry.__table__
+users = User.__table__
+posts = Post.__table__
+
+
+def publish(author_id, body, timestamp=None):
+    """
+    Writes a new post and fans it out. The post is flushed so that it has an id, the caller still has to commit.
+    """
+    post = Post(body=body, timestamp=timestamp or datetime.utcnow(), user_id=author_id)
+    db.session.add(post)
+    db.session.flush()
+    db.session.execute(users.update().where(users.c.id == author_id).values(post_count=users.c.post_count + 1))
+    fan_out(post.id, author_id, post.timestamp)
+    return post
+
+
+def fan_out(post_id, author_id, timestamp):
+    session = db.session
+    session.execute(feed.insert().values(user_id=author_id, post_id=post_id, timestamp=timestamp))
+    if fans_out_on_read(author_id, timestamp):
+        return
+    session.execute(feed.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        select([followers.c.follower_id, literal(post_id), literal(timestamp, DateTime)]).where(followers.c.followed_id == author_id)
+    ))
+
+
+def fans_out_on_read(author_id, timestamp, session=None):
+    """
+    Decides whether a post by this author is too expensive to fan out. The follower count comes from the counter in the user
+    table, the recent posts are counted on the post index, and once an author crosses either limit the decision is remembered in
+    the user table. The bulk importer asks with its own connection as session.
+    """
+    session = session or db.session
+    fanout_on_read, follower_count = session.execute(
+        select([users.c.fanout_on_read, users.c.follower_count]).where(users.c.id == author_id)).first()
+    if fanout_on_read:
+        return True
+    config = current_app.config
+    recent_posts = session.execute(
+        select([func.count()]).select_from(posts).where(and_(
+            posts.c.user_id == author_id,
+            posts.c.timestamp > timestamp - timedelta(hours=1)))).scalar()
+    if (follower_count or 0) <= config['FEED_FANOUT_MAX_FOLLOWERS'] and recent_posts <= config['FEED_FANOUT_MAX_POSTS_PER_HOUR']:
+        return False
+    session.execute(users.update().where(users.c.id == author_id).values(fanout_on_read=True))
+    return True
+
+
+def follow(follower_id, followed_id):
+    """
+    Adds the follow relationship and copies the most recent posts of the followed user into the follower's feed, so the home
+    page is not empty right after following someone. Returns False if the relationship already existed.
+
+    We do not look for the relationship first, two requests could both miss it and the second INSERT would fail on the primary key.
+    The INSERT OR IGNORE leaves the existing row alone instead, and only the request that inserted the row moves the counters.
+    """
+    session = db.session
+    if follower_id == followed_id:
+        return False
+    inserted = session.execute(followers.insert().prefix_with('OR IGNORE').values(
+        follower_id=follower_id, followed_id=followed_id)).rowcount
+    if inserted != 1:
+        return False
+    _count_follow(follower_id, followed_id, 1)
+    fanout_on_read = session.execute(select([users.c.fanout_on_read]).where(users.c.id == followed_id)).scalar()
+    if not fanout_on_read:
+        recent = select([literal(follower_id), posts.c.id, posts.c.timestamp]).where(posts.c.user_id == followed_id) \
+            .order_by(posts.c.timestamp.desc()).limit(current_app.config['FEED_BACKFILL'])
+        session.execute(feed.insert().prefix_with('OR IGNORE').from_select(['user_id', 'post_id', 'timestamp'], recent))
+    return True
+
+
+def unfollow(follower_id, followed_id):
+    session = db.session
+    deleted = session.execute(followers.delete().where(and_(followers.c.follower_id == follower_id,
+                                                            followers.c.followed_id == followed_id))).rowcount
+    if deleted != 1:
+        return False
+    _count_follow(follower_id, followed_id, -1)
+    session.execute(feed.delete().where(and_(
+        feed.c.user_id == follower_id,
+        feed.c.post_id.in_(select([posts.c.id]).where(posts.c.user_id == followed_id)))))
+    return True
+
+
+def _count_follow(follower_id, followed_id, delta):
+    session = db.session
+    session.execute(users.update().where(users.c.id == follower_id).values(followed_count=users.c.followed_count + delta))
+    session.execute(users.update().where(users.c.id == followed_id).values(follower_count=users.c.follower_count + delta))
+
+
+def is_following(follower_id, followed_id, session=None):
+    session = session or db.session
+    return session.execute(select([followers.c.follower_id]).where(and_(
+        followers.c.follower_id == follower_id, followers.c.followed_id == followed_id))).first() is not None
+
+
+def home_timeline(user_id, per_page, cursor=None, session=None):
+    """
+    Returns a page of the home timeline of a user, newest first. The feed rows come from a single range scan on the feed index,
+    and the posts of followed fan-out-on-read authors are merged in by (timestamp, id). Both sides start after the same cursor, so
+    deep pages cost the same as the first one.
+    """
+    session = session or db.session
+    key = decode_cursor(cursor)
+    query = select([feed.c.timestamp, feed.c.post_id]).where(feed.c.user_id == user_id)
+    if key is not None:
+        query = query.where(older_than(feed.c.timestamp, feed.c.post_id, key))
+    entries = session.execute(
+        query.order_by(feed.c.timestamp.desc(), feed.c.post_id.desc()).limit(per_page + 1)).fetchall()
+    entries = [(row[0], row[1]) for row in entries]
+    heavy = select([followers.c.followed_id]).select_from(
+        followers.join(users, users.c.id == followers.c.followed_id)).where(and_(
+            followers.c.follower_id == user_id, users.c.fanout_on_read == True))
+    query = select([posts.c.timestamp, posts.c.id]).where(posts.c.user_id.in_(heavy))
+    if key is not None:
+        query = query.where(older_than(posts.c.timestamp, posts.c.id, key))
+    pulled = session.execute(
+        query.order_by(posts.c.timestamp.desc(), posts.c.id.desc()).limit(per_page + 1)).fetchall()
+    if pulled:
+        entries = sorted(set(entries) | set((row[0], row[1]) for row in pulled), reverse=True)
+    has_next = len(entries) > per_page
+    entries = entries[:per_page]
+    items = []
+    if entries:
+        ids = [post_id for timestamp, post_id in entries]
+        by_id = dict((post.id, post) for post in
+                     session.query(Post).options(joinedload(Post.author)).filter(Post.id.in_(ids)))
+        items = [by_id[post_id] for post_id in ids if post_id in by_id]
+    return make_page(items, has_next, cursor, lambda post: (post.timestamp, post.id))
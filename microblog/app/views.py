@@ -1,5 +1,4 @@
-from flask import render_template, flash, redirect, session, url_for, request, g
-from datetime import datetime
+from flask import Blueprint, render_template, flash, redirect, session, url_for, request, g, make_response, abort, Response, stream_with_context, current_app, jsonify
 """
 The g global is setup by Flask as a place to store and share data during the life of a request. As I'm sure you guessed by now, we will be storing the logged in user here.
 
@@ -7,36 +6,69 @@ The url_for function that we used in the redirect call is defined by Flask as a
 
 The flask.session provides a much more complex service along those lines. Once data is stored in the session object it will be available during that request and any future requests made by the same client. Data remains in the session until explicitly removed. To be able to do this, Flask keeps a different session container for each client of our application.
 """
-from flask_login import login_user, logout_user, current_user, login_required
-from app import app, db
-from app import oid, lm
-from .forms import LoginForm, EditForm
-from .models import User
+from flask_login import LoginManager, login_user, logout_user, current_user, login_required
+from flask_openid import OpenID
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from app import db
+from .extensions import last_seen, identity_cache, read_session, changes, fragments, nicknames, post_writer, avatars
+from .fragments import etag, not_modified, csrf_state
+from .export import export_posts, FORMATS
+from .forms import LoginForm, EditForm, PostForm, SearchForm
+from .models import User, Post
+from .pagination import paginate
+from . import timeline
+from .search import search_posts
+from .openid_store import OpenIDStores
+from .post_writer import PostQueueFull
+
+"""
+All the views are registered on the main blueprint, so their endpoints are called main.index, main.user and so on. Flask-Login and Flask-OpenID are only needed by these views, so they are created here and bound to the application when the blueprint is registered. Flask-OpenID gets its associations and nonces from the store selected by OPENID_STORE (see app/openid_store.py).
+"""
+bp = Blueprint('main', __name__)
+lm = LoginManager()
+lm.login_view = 'main.login'
+openid_store = OpenIDStores()
+oid = OpenID(store_factory=openid_store)
+
+
+@bp.record_once
+def init_extensions(state):
+    lm.init_app(state.app)
+    openid_store.init_app(state.app)
+    oid.init_app(state.app)
 
 """
 The two route decorators above the function create the mappings from URLs / and /index to this function.
 """
-@app.route('/')
-@app.route('/index')
+@bp.route('/', methods=['GET', 'POST'])
+@bp.route('/index', methods=['GET', 'POST'])
 @login_required
 def index():
-    user = g.user
-    posts = [  # fake array of posts
-        {
-            'author': {'nickname': 'John'},
-            'body': 'Beautiful day in Portland!'
-        },
-        {
-            'author': {'nickname': 'Susan'},
-            'body': 'The Avengers movie was so cool!'
-        }
-    ]
-    return render_template(
+    form = PostForm()
+    status = 200
+    if form.validate_on_submit():
+        try:
+            post_writer.publish(g.user.id, form.post.data)
+        except PostQueueFull:
+            # too many posts are waiting to be written, the client should try again a little later
+            flash('We are very busy right now, please try to post again in a moment.')
+            status = 503
+        else:
+            flash('Your post is now live!')
+            return redirect(url_for('main.index'))
+    posts = timeline.home_timeline(g.user.id, current_app.config['POSTS_PER_PAGE'], request.args.get('cursor'),
+                                   session=read_session())
+    response = make_response(render_template(
         'index.html',
         title='Home',
-        user=user,
+        form=form,
+        user=g.user,
         posts=posts
-    )
+    ), status)
+    if status == 503:
+        response.headers['Retry-After'] = '1'
+    return response
 """
 To render the template we had to import a new function from the Flask framework called render_template. 
 This function takes a template filename and a variable list of template arguments and returns the rendered template, 
@@ -74,11 +106,11 @@ all templates and put them in a base template from which all other templates are
 """
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 @oid.loginhandler
 def login():
     if g.user is not None and g.user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = LoginForm()
     if form.validate_on_submit():
         session['remember_me'] = form.remember_me.data
@@ -88,7 +120,7 @@ def login():
         'login.html',
         title='Sign In',
         form=form,
-        providers=app.config['OPENID_PROVIDERS']
+        providers=current_app.config['OPENID_PROVIDERS']
     )
 """
 So basically, we have imported our LoginForm class, instantiated an object from it, and sent it down to the template. This is all that is required to get form fields rendered.
@@ -110,8 +142,23 @@ When validate_on_submit returns True our login view function calls two new funct
 def load_user(id):
     """
     user ids in Flask-Login are always unicode strings, so a conversion to an integer is necessary before we can send the id to Flask-SQLAlchemy.
+
+    The identity cache answers most of these calls from memory and hands back a detached snapshot of the user, only a miss goes to the database.
     """
-    return User.query.get(int(id))
+    return identity_cache.load(int(id), read_session().query(User).get)
+
+
+@changes.subscribe(User, fields=['nickname', 'about_me', 'email'])
+def invalidate_identity(change):
+    """
+    The identity cache holds a copy of the user, so it has to forget it once the profile is edited (or the user is deleted).
+    """
+    identity_cache.invalidate(change.id)
+
+
+@changes.subscribe(User, fields=['nickname'])
+def update_nickname_index(change):
+    nicknames.update(change)
 
 
 @oid.after_login
@@ -121,19 +168,16 @@ def after_login(resp):
     """
     if resp.email is None or resp.email == "":
         flash('Invalid login. Please try again.')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     """
     If the email is not found we consider this a new user, so we add a new user to our database, pretty much as we have learned in the previous chapter. Note that we handle the case of a missing nickname, since some OpenID providers may not have that information.
     """
-    user = User.query.filter_by(email=resp.email).first()
+    user = read_session().query(User).filter_by(email=resp.email).first()
     if user is None:
         nickname = resp.nickname
         if nickname is None or nickname == "":
             nickname = resp.email.split('@')[0]
-        nickname = User.make_unique_nickname(nickname)
-        user = User(nickname=nickname, email=resp.email)
-        db.session.add(user)
-        db.session.commit()
+        user = User.create_unique(nickname, resp.email)
     remember_me = False
     if 'remember_me' in session:
         remember_me = session['remember_me']
@@ -142,24 +186,23 @@ def after_login(resp):
     """
     The concept of the next page is simple. Let's say you navigate to a page that requires you to be logged in, but you aren't just yet. In Flask-Login you can protect views against non logged in users by adding the login_required decorator. If the user tries to access one of the affected URLs then it will be redirected to the login page automatically. Flask-Login will store the original URL as the next page, and it is up to us to return the user to this page once the login process completed.
     """
-    return redirect(request.args.get('next') or url_for('index'))
+    return redirect(request.args.get('next') or url_for('main.index'))
 
 """
 we check g.user to determine if a user is already logged in. To implement this we will use the before_request event from Flask. Any functions that are decorated with before_request will run before the view function each time a request is received. 
 """
-@app.before_request
+@bp.before_app_request
 def before_request():
     g.user = current_user
-    if g.user.is_authenticated:
-        g.user.last_seen = datetime.utcnow()
-        db.session.add(g.user)
-        db.session.commit()
+    if g.user.is_authenticated and request.endpoint != 'static':
+        last_seen.touch(g.user.id)
+        g.search_form = SearchForm()
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     logout_user()
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 
 # User Profile Page
@@ -167,24 +210,81 @@ def logout():
 The @app.route decorator that we used to declare this view function looks a little bit different than the previous ones. In this case we have an argument in it, which is indicated as <nickname>. This translates into an argument of the same name added to the view function. When the client requests, say, URL /user/miguel the view function will be invoked with nickname set to 'miguel'.
 The implementation of the view function should have no surprises. First we try to load the user from the database, using the nickname that we received as argument. If that doesn't work then we just redirect to the main page with an error message, as we have seen in the previous chapter.
 
-Once we have our user, we just send it in the render_template call, along with some fake posts. Note that in the user profile page we will be displaying only posts by this user, so our fake posts have the author field correctly set.
+Once we have our user, we just send it in the render_template call, along with one page of the posts written by this user. The page is selected with a cursor passed in the query string, see app/pagination.py.
 """
-@app.route('/user/<nickname>')
+@bp.route('/user/<nickname>')
 @login_required
 def user(nickname):
-    user = User.query.filter_by(nickname=nickname).first()
+    reads = read_session()
+    user = reads.query(User).filter_by(nickname=nickname).first()
     if user == None:
         flash('User %s not found.' % nickname)
-        return redirect(url_for('index'))
-    posts = [
-        {'author': user, 'body': 'Test post #1'},
-        {'author': user, 'body': 'Test post #2'}
-    ]
-    return render_template('user.html',
-                           user=user,
-                           posts=posts)
-
-@app.route('/edit', methods=['GET', 'POST'])
+        return redirect(url_for('main.index'))
+    cursor = request.args.get('cursor')
+    seen = last_seen.last_seen(user.id, user.last_seen)
+    following = timeline.is_following(g.user.id, user.id, session=reads)
+    """
+    Everything that can change this page is cheap to look up: the profile_version and the post, follower and following counters of the user, the id of the newest post (a single seek on the post index), the last seen time, who is looking at it and the CSRF token of their session. The counters are columns of the user row (see app/counters.py), so no rows are counted here. If the browser already has the page with that ETag we answer 304 without rendering anything or querying the posts.
+    """
+    latest = reads.query(Post.id).filter_by(user_id=user.id) \
+        .order_by(Post.timestamp.desc(), Post.id.desc()).limit(1).scalar()
+    counts = (user.post_count, user.follower_count, user.followed_count)
+    tag = etag(user.id, user.profile_version, counts, latest, seen, following, g.user.id, g.user.nickname, cursor, csrf_state())
+    if not_modified(tag):
+        response = make_response('', 304)
+    else:
+        posts = paginate(reads.query(Post).options(joinedload(Post.author)).filter_by(user_id=user.id), Post.timestamp, Post.id,
+                         cursor, current_app.config['POSTS_PER_PAGE'])
+        header = fragments.render(('profile', user.id, user.profile_version, counts, seen, user.id == g.user.id, following),
+                                  'profile_header.html', user=user, last_seen=seen, following=following)
+        response = make_response(render_template('user.html',
+                                                 user=user,
+                                                 header=header,
+                                                 posts=posts))
+    response.set_etag(tag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+"""
+Following and unfollowing only touch the followers association table and the feed of the current user, the timeline module takes care of both.
+"""
+@bp.route('/follow/<nickname>')
+@login_required
+def follow(nickname):
+    user = User.query.filter_by(nickname=nickname).first()
+    if user is None:
+        flash('User %s not found.' % nickname)
+        return redirect(url_for('main.index'))
+    if user.id == g.user.id:
+        flash('You can\'t follow yourself!')
+        return redirect(url_for('main.user', nickname=nickname))
+    if not timeline.follow(g.user.id, user.id):
+        flash('Cannot follow ' + nickname + '.')
+        return redirect(url_for('main.user', nickname=nickname))
+    db.session.commit()
+    flash('You are now following ' + nickname + '!')
+    return redirect(url_for('main.user', nickname=nickname))
+
+
+@bp.route('/unfollow/<nickname>')
+@login_required
+def unfollow(nickname):
+    user = User.query.filter_by(nickname=nickname).first()
+    if user is None:
+        flash('User %s not found.' % nickname)
+        return redirect(url_for('main.index'))
+    if user.id == g.user.id:
+        flash('You can\'t unfollow yourself!')
+        return redirect(url_for('main.user', nickname=nickname))
+    if not timeline.unfollow(g.user.id, user.id):
+        flash('Cannot unfollow ' + nickname + '.')
+        return redirect(url_for('main.user', nickname=nickname))
+    db.session.commit()
+    flash('You have stopped following ' + nickname + '.')
+    return redirect(url_for('main.user', nickname=nickname))
+
+
+@bp.route('/edit', methods=['GET', 'POST'])
 @login_required
 def edit():
     form = EditForm(g.user.nickname)
@@ -192,27 +292,92 @@ def edit():
         g.user.nickname = form.nickname.data
         g.user.about_me = form.about_me.data
         db.session.add(g.user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # the nickname was taken by another process since the nickname index last heard of it
+            db.session.rollback()
+            form.nickname.errors.append('This nickname is already in use. Please choose another one.')
+            return render_template('edit.html', form=form)
         flash('Your changes have been saved.')
-        return redirect(url_for('edit'))
+        return redirect(url_for('main.edit'))
     else:
         form.nickname.data = g.user.nickname
         form.about_me.data = g.user.about_me
     return render_template('edit.html', form=form)
 
 
+"""
+The autocomplete view returns the nicknames that start with what was typed so far as JSON, in alphabetical order. It is answered by the nickname index, so it does not touch the database once the index is loaded.
+"""
+@bp.route('/autocomplete/nicknames')
+@login_required
+def autocomplete_nicknames():
+    prefix = request.args.get('q', '').strip()
+    if not prefix:
+        return jsonify(nicknames=[])
+    limit = current_app.config['NICKNAME_AUTOCOMPLETE_LIMIT']
+    return jsonify(nicknames=nicknames.prefixed(prefix, limit))
+
+
+"""
+The search form in the navigation bar posts to the search view, which only validates the form and redirects to the results page. Keeping the query in the URL of the results page means that results can be bookmarked and paged with a plain GET, the next page is selected with a cursor like the post listings. The query goes in the query string (?q=) and not in the path, so a query with a slash in it still reaches the view.
+"""
+@bp.route('/search', methods=['POST'])
+@login_required
+def search():
+    if not g.search_form.validate_on_submit():
+        return redirect(url_for('main.index'))
+    return redirect(url_for('main.search_results', q=g.search_form.search.data))
+
+
+@bp.route('/search_results')
+@login_required
+def search_results():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return redirect(url_for('main.index'))
+    results = search_posts(query, current_app.config['POSTS_PER_PAGE'], request.args.get('cursor'), session=read_session())
+    return render_template('search_results.html',
+                           query=query,
+                           results=results)
+
+
+"""
+Avatars are served from our own server, out of a disk cache in front of Gravatar (see app/avatars.py). They are the same for everyone,
+so they do not need a login.
+"""
+@bp.route('/avatar/<email_hash>/<int:size>')
+def avatar(email_hash, size):
+    return avatars.send(email_hash, size)
+
+
+"""
+The export is sent as it is read. stream_with_context keeps the request (and with it the database session) around while the
+generator runs, and when the client accepts it the compression layer compresses the pieces on the fly (see app/compression.py).
+"""
+@bp.route('/export/posts.<format>')
+@login_required
+def export(format):
+    if format not in FORMATS:
+        abort(404)
+    pieces = export_posts(g.user.id, format, session=read_session())
+    headers = {'Content-Disposition': 'attachment; filename="%s-posts.%s"' % (g.user.nickname, format)}
+    return Response(stream_with_context(pieces), mimetype=FORMATS[format], headers=headers)
+
+
 """
 Custom HTTP error handlers
 
 Flask provides a mechanism for an application to install its own error pages. As an example, let's define custom error pages for the HTTP errors 404 and 500, the two most common ones. 
 """
 
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def not_found_error(error):
     return render_template('404.html'), 404
 
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
     return render_template('500.html'), 500
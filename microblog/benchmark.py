@@ -0,0 +1,326 @@
+#!../flask/bin/python
+"""
+Benchmarking the application
+
+This script fills a scratch database with a synthetic data set (users, posts and a follower graph), then plays scripted sessions
+against the application and reports the throughput and the p50, p95 and p99 latency of every page. A session logs a user in
+(the login is stubbed, we write the user id in the session cookie instead of going through OpenID), opens the home page and
+its second page, pages through the profile of someone the user follows, opens the edit page and saves it, and writes a post.
+
+By default the requests go through app.test_client(), with --server they go over HTTP to a real local server running in a thread.
+Several data set sizes can be given, the same sessions are replayed against each of them:
+
+./benchmark.py --size 100x1000 --size 1000x20000 --save-baseline benchmark_baseline.json
+./benchmark.py --size 100x1000 --size 1000x20000 --baseline benchmark_baseline.json
+
+With --startup RUNS the script also measures how long a fresh interpreter takes to import the models and to build the application
+with create_app().
+
+With --baseline the results are compared with a previous run, and the script exits with status 1 if the throughput dropped or a p95
+latency grew by more than --tolerance. Baselines only mean something on the machine that recorded them, so we do not keep one in
+the repository.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import HTTPRedirectHandler, build_opener
+
+from sqlalchemy import select
+
+from flask import current_app
+
+from app import create_app, db
+from app.extensions import identity_cache, fragments, last_seen, metrics
+from app.models import User, Post, FeedEntry, followers, hash_email
+from app.counters import reconcile
+
+CURSOR = re.compile(r'\?cursor=([^"&]+)"')
+
+
+def generate(users, posts, follows, seed=1):
+    """
+    Writes the synthetic data set with a few executemany statements. Authors are picked with a skewed distribution, so like in
+    a real site a few users write most of the posts, and the feed table is materialized in one INSERT ... SELECT the way
+    timeline.fan_out() would have left it.
+    """
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    engine = db.engine
+    engine.execute(User.__table__.insert(), [
+        dict(id=i, nickname='user%d' % i, email='user%d@example.com' % i, email_hash=hash_email('user%d@example.com' % i),
+             about_me='I am user %d' % i, last_seen=now, profile_version=0, fanout_on_read=False)
+        for i in range(1, users + 1)])
+    edges = []
+    for i in range(1, users + 1):
+        picked = [followed for followed in rng.sample(range(1, users + 1), min(follows + 1, users)) if followed != i]
+        edges.extend(dict(follower_id=i, followed_id=followed) for followed in picked[:follows])
+    if edges:
+        engine.execute(followers.insert(), edges)
+    weights = [1.0 / rank for rank in range(1, users + 1)]
+    authors = rng.choices(range(1, users + 1), weights, k=posts)
+    start = now - timedelta(days=30)
+    stamps = sorted(start + timedelta(seconds=rng.randint(0, 30 * 24 * 3600)) for i in range(posts))
+    engine.execute(Post.__table__.insert(), [
+        dict(id=i + 1, body='post number %d' % (i + 1), timestamp=stamp, user_id=author)
+        for i, (stamp, author) in enumerate(zip(stamps, authors))])
+    post = Post.__table__
+    feed = FeedEntry.__table__
+    engine.execute(feed.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'], select([post.c.user_id, post.c.id, post.c.timestamp])))
+    engine.execute(feed.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        select([followers.c.follower_id, post.c.id, post.c.timestamp]).where(followers.c.followed_id == post.c.user_id)))
+    # the rows above were written behind the counters' back, count them like db_recount.py would
+    reconcile(engine, batch_size=10000, pause=0)
+    return edges
+
+
+class TestClientDriver(object):
+    def __init__(self, app, user_id):
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session['user_id'] = session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+
+    def request(self, method, url, data=None):
+        response = self.client.open(url, method=method, data=data)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class _NoRedirect(HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class ServerDriver(object):
+    def __init__(self, app, base_url, user_id):
+        self.base_url = base_url
+        self.opener = build_opener(_NoRedirect)
+        session = app.session_interface.get_signing_serializer(app).dumps(
+            {'user_id': str(user_id), '_user_id': str(user_id), '_fresh': True})
+        self.opener.addheaders = [('Cookie', '%s=%s' % (app.session_cookie_name, session))]
+
+    def request(self, method, url, data=None):
+        body = urlencode(data).encode('utf-8') if data is not None else None
+        try:
+            response = self.opener.open(self.base_url + url, body)
+            return response.getcode(), response.read().decode('utf-8')
+        except HTTPError as e:
+            return e.code, e.read().decode('utf-8')
+
+
+def play_session(driver, user_id, followed, rng, samples):
+    """
+    Plays one scripted session and appends a (page, status, seconds) sample for every request to samples.
+    """
+    def timed(page, method, url, data=None):
+        start = time.time()
+        status, text = driver.request(method, url, data)
+        samples.append((page, status, time.time() - start))
+        return text
+
+    def next_page(text):
+        match = CURSOR.search(text)
+        return match.group(1) if match else None
+
+    text = timed('GET index', 'GET', '/index')
+    cursor = next_page(text)
+    if cursor:
+        timed('GET index', 'GET', '/index?cursor=' + cursor)
+    nickname = 'user%d' % (rng.choice(followed) if followed else user_id)
+    text = timed('GET user', 'GET', '/user/' + nickname)
+    for i in range(2):
+        cursor = next_page(text)
+        if not cursor:
+            break
+        text = timed('GET user', 'GET', '/user/%s?cursor=%s' % (nickname, cursor))
+    timed('GET edit', 'GET', '/edit')
+    timed('POST edit', 'POST', '/edit', {'nickname': 'user%d' % user_id, 'about_me': 'edited %d' % rng.randint(0, 1000000)})
+    timed('POST index', 'POST', '/index', {'post': 'benchmark post %d' % rng.randint(0, 1000000)})
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def summarize(samples, elapsed):
+    pages = {}
+    for page, status, seconds in samples:
+        pages.setdefault(page, []).append((status, seconds))
+    result = {'requests': len(samples), 'seconds': elapsed,
+              'throughput': len(samples) / elapsed if elapsed else 0.0, 'pages': {}}
+    for page, values in sorted(pages.items()):
+        times = [seconds for status, seconds in values]
+        result['pages'][page] = {
+            'count': len(values),
+            'errors': sum(1 for status, seconds in values if status >= 400),
+            'p50': percentile(times, 0.50),
+            'p95': percentile(times, 0.95),
+            'p99': percentile(times, 0.99),
+        }
+    return result
+
+
+def run(users, posts, follows, sessions, threads, seed, server):
+    app = current_app._get_current_object()
+    identity_cache.clear()
+    fragments.clear()
+    metrics.clear()
+    db.drop_all()
+    db.create_all()
+    edges = generate(users, posts, follows, seed)
+    following = {}
+    for edge in edges:
+        following.setdefault(edge['follower_id'], []).append(edge['followed_id'])
+    httpd = None
+    if server:
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        httpd = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:%d' % httpd.server_port
+    rng = random.Random(seed)
+    plan = [(rng.randint(1, users), random.Random(rng.random())) for i in range(sessions)]
+    samples = []
+
+    def worker(jobs):
+        for user_id, session_rng in jobs:
+            driver = ServerDriver(app, base_url, user_id) if server else TestClientDriver(app, user_id)
+            with app.app_context():
+                play_session(driver, user_id, following.get(user_id, []), session_rng, samples)
+
+    start = time.time()
+    workers = [threading.Thread(target=worker, args=(plan[i::threads],)) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - start
+    if httpd is not None:
+        httpd.shutdown()
+    last_seen.flush()
+    db.session.remove()
+    return summarize(samples, elapsed)
+
+
+STARTUP_SCRIPT = '''
+import time
+started = time.time()
+import app.models
+imported = time.time()
+from app import create_app
+create_app({'TESTING': True})
+print('%f %f' % (imported - started, time.time() - imported))
+'''
+
+
+def measure_startup(runs):
+    """
+    Measures, in fresh interpreters, how long it takes to import the models (what the db_*.py scripts that do not serve pages pay)
+    and then to build the application with create_app(). Returns the average of both, in seconds.
+    """
+    totals = [0.0, 0.0]
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT], cwd=os.path.dirname(os.path.abspath(__file__)))
+        for j, value in enumerate(output.split()[-2:]):
+            totals[j] += float(value)
+    return totals[0] / runs, totals[1] / runs
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of the regressions found in results when compared with the baseline. Sizes and pages that are not in the
+    baseline are ignored.
+    """
+    regressions = []
+    for size, result in sorted(results.items()):
+        before = baseline.get(size)
+        if before is None:
+            continue
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append('%s: throughput %.1f req/s, baseline %.1f req/s' % (size, result['throughput'], before['throughput']))
+        for page, stats in sorted(result['pages'].items()):
+            old = before['pages'].get(page)
+            if old is not None and stats['p95'] > old['p95'] * (1 + tolerance):
+                regressions.append('%s: %s p95 %.1f ms, baseline %.1f ms' % (size, page, stats['p95'] * 1000, old['p95'] * 1000))
+    return regressions
+
+
+def report(size, result):
+    print('%s: %d requests in %.2fs, %.1f req/s' % (size, result['requests'], result['seconds'], result['throughput']))
+    print('    %-12s %6s %6s %9s %9s %9s' % ('page', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for page, stats in sorted(result['pages'].items()):
+        print('    %-12s %6d %6d %9.1f %9.1f %9.1f' % (page, stats['count'], stats['errors'],
+                                                     stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the microblog pages against a synthetic data set.')
+    parser.add_argument('--size', action='append', metavar='USERSxPOSTS',
+                        help='data set size, can be given several times (default 100x1000)')
+    parser.add_argument('--follows', type=int, default=20, help='users followed by each user')
+    parser.add_argument('--sessions', type=int, default=50, help='scripted sessions played per data set')
+    parser.add_argument('--threads', type=int, default=1, help='sessions played at the same time')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--server', action='store_true', help='go through a real local HTTP server')
+    parser.add_argument('--baseline', help='compare with the results saved in this JSON file')
+    parser.add_argument('--save-baseline', help='save the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before a regression is reported')
+    parser.add_argument('--startup', type=int, default=0, metavar='RUNS',
+                        help='also measure the import and create_app() time, averaged over RUNS fresh interpreters')
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        models, factory = measure_startup(args.startup)
+        print('startup: import app.models %.1f ms, create_app() %.1f ms' % (models * 1000, factory * 1000))
+    tmpdir = tempfile.mkdtemp()
+    # the errors of a run are counted in the report, they must not be mailed to the admins
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmpdir, 'benchmark.db'),
+                      'WTF_CSRF_ENABLED': False,
+                      'SQLALCHEMY_MAX_QUERIES_PER_REQUEST': None,
+                      'MAIL_SERVER': None})
+    results = {}
+    try:
+        with app.app_context():
+            for size in args.size or ['100x1000']:
+                users, posts = [int(n) for n in size.lower().split('x')]
+                results[size] = run(users, posts, args.follows, args.sessions, args.threads, args.seed, args.server)
+                report(size, results[size])
+            db.get_engine().dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -30,11 +30,132 @@ The SQLALCHEMY_MIGRATE_REPO is the folder where we will store the SQLAlchemy-mig
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
 SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
 
+"""
+SQLITE_PROFILE = 'production' switches app.db to WAL journaling, applies the pragmas in DEFAULT_PRAGMAS (or SQLITE_PRAGMAS, when it is set
+here) to every connection, pools SQLITE_POOL_SIZE connections per process and sends read-only view queries through a separate pool of
+SQLITE_READ_POOL_SIZE read-only connections (see app/database.py).
+"""
+SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'default')
+SQLITE_POOL_SIZE = 5
+SQLITE_READ_POOL_SIZE = 10
+
 """
 FSADeprecationWarning: SQLALCHEMY_TRACK_MODIFICATIONS adds significant overhead and will be disabled by default in the future.  Set it to True or False to suppress this warning.
+
+Nothing in the application listens to those signals, the caches subscribe to the much cheaper ChangeBus in app/events.py instead.
+"""
+SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+"""
+The last_seen timestamps are kept in memory and written back in batches. A visit is only recorded again once LAST_SEEN_WINDOW seconds
+have passed, and the pending timestamps are flushed to the database every LAST_SEEN_FLUSH_INTERVAL seconds (0 disables the background
+flusher, the timestamps are then only written at shutdown or when flush() is called explicitly).
+"""
+LAST_SEEN_WINDOW = 60
+LAST_SEEN_FLUSH_INTERVAL = 30
+
+"""
+The identity cache keeps up to IDENTITY_CACHE_SIZE logged in users in memory for IDENTITY_CACHE_TTL seconds, so that Flask-Login does not
+have to query the user table on every request. Setting the size to 0 disables it.
+"""
+IDENTITY_CACHE_SIZE = 1024
+IDENTITY_CACHE_TTL = 300
+
+"""
+Home timelines are materialized in the feed table when a post is written. Authors with more than FEED_FANOUT_MAX_FOLLOWERS followers, or
+that wrote more than FEED_FANOUT_MAX_POSTS_PER_HOUR posts in the last hour, are read from the post table instead. FEED_BACKFILL is the number
+of recent posts copied into a feed when a new follow starts.
+"""
+POSTS_PER_PAGE = 20
+FEED_FANOUT_MAX_FOLLOWERS = 1000
+FEED_FANOUT_MAX_POSTS_PER_HOUR = 60
+FEED_BACKFILL = 100
+
+"""
+In debug and testing setups SQLALCHEMY_MAX_QUERIES_PER_REQUEST can be set to a number, any request that runs more SQL statements than that
+fails with QueryBudgetExceeded. This is how we catch pages that lazy load one row per item they render. None disables the check.
+"""
+SQLALCHEMY_MAX_QUERIES_PER_REQUEST = None
+
+"""
+Request, template and SQL timings are served in the Prometheus text format at METRICS_URL. When the application runs in several worker
+processes METRICS_DIR must point to a directory shared by all of them, each worker writes its numbers there every METRICS_WRITE_INTERVAL
+seconds. Requests slower than METRICS_SLOW_REQUEST seconds are logged with their METRICS_SLOW_QUERIES slowest SQL statements.
+"""
+METRICS_URL = '/metrics'
+METRICS_DIR = None
+METRICS_WRITE_INTERVAL = 5
+METRICS_SLOW_REQUEST = 1.0
+METRICS_SLOW_QUERIES = 5
+
+# db_import.py writes IMPORT_BATCH_SIZE rows per executemany and commits every IMPORT_BATCHES_PER_COMMIT batches
+IMPORT_BATCH_SIZE = 1000
+IMPORT_BATCHES_PER_COMMIT = 10
+
+# posts read per query by the streaming export
+EXPORT_CHUNK_SIZE = 1000
+
+# number of rendered post rows and profile headers kept by the fragment cache
+FRAGMENT_CACHE_SIZE = 2048
+
+
+"""
+OPENID_STORE selects where Flask-OpenID keeps its associations and nonces: 'sql' (tables in the application database), 'memory' (an
+in-memory database, only for a single process) or 'filesystem' (files in OPENID_FS_STORE_PATH). Expired rows are deleted at most
+OPENID_STORE_CLEANUP_BATCH at a time, every OPENID_STORE_CLEANUP_INTERVAL seconds.
+"""
+OPENID_STORE = 'sql'
+OPENID_STORE_CLEANUP_INTERVAL = 300
+OPENID_STORE_CLEANUP_BATCH = 500
+OPENID_FS_STORE_PATH = os.path.join(basedir, 'tmp')
+
+"""
+The nickname index keeps every nickname in memory for the "is this nickname taken" checks and the autocomplete view, and reloads
+itself in the background every NICKNAME_INDEX_REFRESH seconds to pick up changes made by other processes (see app/nicknames.py).
+NICKNAME_INDEX = False sends every lookup to the database.
+"""
+NICKNAME_INDEX = True
+NICKNAME_INDEX_REFRESH = 300
+NICKNAME_AUTOCOMPLETE_LIMIT = 10
+
+"""
+Responses of the COMPRESS_MIMETYPES types larger than COMPRESS_MIN_SIZE bytes are compressed with brotli (when the brotli package is
+installed) or gzip, whichever the client prefers. We care more about the bytes sent to phones than about CPU, so gzip runs at its
+highest level (see app/compression.py).
+"""
+COMPRESS_MIN_SIZE = 500
+COMPRESS_GZIP_LEVEL = 9
+COMPRESS_BROTLI_QUALITY = 5
+
+"""
+With POST_GROUP_COMMIT new posts are written by a single writer thread that commits up to POST_BATCH_SIZE of them at once, waiting at
+most POST_BATCH_WINDOW seconds for a group to fill up. At most POST_QUEUE_SIZE posts wait for it, a request that finds the queue full
+for POST_QUEUE_TIMEOUT seconds, or whose post is not written within POST_WRITE_TIMEOUT seconds, is answered with a 503 (see
+app/post_writer.py).
 """
-SQLALCHEMY_TRACK_MODIFICATIONS = True
+POST_GROUP_COMMIT = False
+POST_QUEUE_SIZE = 1000
+POST_QUEUE_TIMEOUT = 2.0
+POST_BATCH_SIZE = 100
+POST_BATCH_WINDOW = 0.005
+POST_WRITE_TIMEOUT = 10.0
 
+"""
+Avatars are fetched from AVATAR_UPSTREAM (%(hash)s and %(size)d are filled in) and kept in AVATAR_CACHE_DIR under the hash of
+their content, at most AVATAR_CACHE_MAX_BYTES bytes of them, for AVATAR_CACHE_TTL seconds. With AVATAR_RESIZE and Pillow installed
+only the AVATAR_MAX_SIZE image is fetched and the smaller sizes are scaled here. Browsers may keep them for AVATAR_MAX_AGE seconds.
+When the upstream does not answer within AVATAR_UPSTREAM_TIMEOUT seconds a placeholder is served and the upstream is not asked again
+for AVATAR_UPSTREAM_RETRY seconds (see app/avatars.py).
+"""
+AVATAR_UPSTREAM = 'https://www.gravatar.com/avatar/%(hash)s?d=404&s=%(size)d'
+AVATAR_CACHE_DIR = os.path.join(basedir, 'tmp', 'avatars')
+AVATAR_CACHE_MAX_BYTES = 64 * 1024 * 1024
+AVATAR_CACHE_TTL = 7 * 24 * 3600
+AVATAR_MAX_SIZE = 512
+AVATAR_MAX_AGE = 24 * 3600
+AVATAR_RESIZE = True
+AVATAR_UPSTREAM_TIMEOUT = 3
+AVATAR_UPSTREAM_RETRY = 30
 
 # mail server settings
 MAIL_SERVER = 'localhost'
@@ -44,3 +165,11 @@ MAIL_PASSWORD = 'ZhEn1981@810904ZE'
 
 # administrator list
 ADMINS = ['zhouen.nathan@gmail.com']
+
+"""
+Log records are queued (at most LOG_QUEUE_SIZE of them, the rest are dropped and counted) and written to LOG_FILE by a background thread.
+Errors are mailed to ADMINS as one digest every LOG_MAIL_INTERVAL seconds, with repeated tracebacks collapsed into a single entry.
+"""
+LOG_FILE = os.path.join(basedir, 'tmp', 'microblog.log')
+LOG_QUEUE_SIZE = 10000
+LOG_MAIL_INTERVAL = 60
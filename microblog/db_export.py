@@ -0,0 +1,41 @@
+#!../flask/bin/python
+"""
+Exporting the posts of a user
+
+This script writes all the posts of a user to a file (or to the standard output) as JSON lines or CSV, using the same streaming
+export as the /export/posts.<format> page:
+
+./db_export.py miguel --format csv -o miguel.csv
+./db_export.py miguel --gzip -o miguel.ndjson.gz
+
+The posts are read in chunks and written as they come, so exporting a user with hundreds of thousands of posts does not need more
+memory than exporting one with ten.
+"""
+import argparse
+import sys
+from flask import current_app
+from app import create_app
+from app.models import User
+from app.compression import compress_stream
+from app.export import export_posts, FORMATS, NDJSON
+
+parser = argparse.ArgumentParser(description='Export the posts of a user.')
+parser.add_argument('nickname')
+parser.add_argument('--format', choices=sorted(FORMATS), default=NDJSON)
+parser.add_argument('--gzip', action='store_true', help='compress the output')
+parser.add_argument('-o', '--output', help='output file (default standard output)')
+args = parser.parse_args()
+with create_app().app_context():
+    user = User.query.filter_by(nickname=args.nickname).first()
+    if user is None:
+        sys.exit('User %s not found.' % args.nickname)
+    pieces = (piece.encode('utf-8') for piece in export_posts(user.id, args.format))
+    if args.gzip:
+        pieces = compress_stream(pieces, 'gzip', current_app.config['COMPRESS_GZIP_LEVEL'])
+    out = open(args.output, 'wb') if args.output else getattr(sys.stdout, 'buffer', sys.stdout)
+    try:
+        for piece in pieces:
+            out.write(piece)
+    finally:
+        if args.output:
+            out.close()
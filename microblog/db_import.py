@@ -0,0 +1,31 @@
+#!../flask/bin/python
+"""
+Importing users and posts
+
+Adding an existing corpus through the web interface, or with a script that adds and commits one object at a time, is far too slow
+once there are more than a few thousand records. This script streams a JSONL or CSV file into the database with the bulk importer
+in app/bulk_import.py. Users have to be imported before their posts, because posts find their author by nickname:
+
+./db_import.py users users.jsonl
+./db_import.py posts posts.csv
+
+The progress is committed together with the records, so if an import is interrupted just run the same command again and it will
+continue where it stopped. Use --restart to import a file from the beginning. Records that cannot be read are skipped, their line
+numbers are written to the log and the number of them is printed at the end.
+"""
+import argparse
+import sys
+from app import create_app
+from app.bulk_import import import_file, USERS, POSTS
+
+parser = argparse.ArgumentParser(description='Import users or posts from a JSONL or CSV file.')
+parser.add_argument('kind', choices=[USERS, POSTS])
+parser.add_argument('path')
+parser.add_argument('--batch-size', type=int, help='rows per executemany (default IMPORT_BATCH_SIZE)')
+parser.add_argument('--batches-per-commit', type=int, help='batches per transaction (default IMPORT_BATCHES_PER_COMMIT)')
+parser.add_argument('--restart', action='store_true', help='ignore the saved progress of this file')
+args = parser.parse_args()
+with create_app().app_context():
+    stats = import_file(args.kind, args.path, args.batch_size, args.batches_per_commit, args.restart)
+print('%(read)d records read, %(inserted)d inserted, %(skipped)d skipped, %(invalid)d invalid' % stats)
+sys.exit(0)
@@ -5,6 +5,7 @@ Now that we have defined our model, we can incorporate it into our database. We
 import imp
 from migrate.versioning import api
 from app import db
+import app.models
 from config import SQLALCHEMY_DATABASE_URI
 from config import SQLALCHEMY_MIGRATE_REPO
 v = api.db_version(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO)
@@ -23,5 +24,7 @@ The script looks complicated, but it doesn't really do much. The way SQLAlchemy-
 
 While I have never had problems generating migrations automatically with the above script, I could see that sometimes it would be hard to determine what changes were made just by comparing the old and the new format. To make it easy for SQLAlchemy-migrate to determine the changes I never rename existing fields, I limit my changes to adding or removing models or fields, or changing types of existing fields. And I always review the generated migration script to make sure it is right.
 
+The generated scripts only change the structure of the database. When a migration also has to fill in data (a new column derived from existing ones, for example) do not write it as one big UPDATE, that keeps the database locked until every row is written. Use backfill() from app/backfill.py instead, it fills the rows in small batches that can be interrupted and resumed, and the application can keep writing while it runs.
+
 It goes without saying that you should never attempt to migrate your database without having a backup, in case something goes wrong. Also never run a migration for the first time on a production database, always make sure the migration works correctly on a development database.
 """
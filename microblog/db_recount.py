@@ -0,0 +1,23 @@
+#!../flask/bin/python
+"""
+Repairing the counters
+
+The post, follower and following counters in the user table are kept up to date by the application. If they ever drift (for
+example after posts or follows were deleted by hand) this script counts everything again, in batches, and repairs the users whose
+numbers are wrong:
+
+./db_recount.py
+
+If it is interrupted, run it with --resume to finish the pass instead of starting over.
+"""
+import argparse
+from app import create_app, db
+from app.counters import reconcile
+
+parser = argparse.ArgumentParser(description='Recount the post and follower counters of every user.')
+parser.add_argument('--batch-size', type=int, default=1000, help='users per transaction')
+parser.add_argument('--resume', action='store_true', help='continue an interrupted pass')
+args = parser.parse_args()
+with create_app().app_context():
+    repaired = reconcile(db.engine, args.batch_size, resume=args.resume, log=print)
+print('%d users repaired.' % repaired)
@@ -0,0 +1,16 @@
+#!../flask/bin/python
+"""
+Rebuilding the search index
+
+The post_search full text index follows the post table on its own, through triggers. If it ever gets out of sync (for example
+after posts were copied into the database with the triggers missing) this script rebuilds it from the post table:
+
+./db_reindex.py
+"""
+from app import create_app, db
+from app.search import rebuild
+
+with create_app().app_context():
+    rebuild()
+    db.session.commit()
+print('Search index rebuilt.')
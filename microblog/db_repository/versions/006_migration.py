@@ -0,0 +1,54 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+followers = Table('followers', post_meta,
+    Column('follower_id', Integer, ForeignKey('user.id'), primary_key=True, nullable=False),
+    Column('followed_id', Integer, ForeignKey('user.id'), primary_key=True, nullable=False),
+    Index('ix_followers_followed_id', 'followed_id'),
+)
+
+post = Table('post', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('body', String(length=140)),
+    Column('timestamp', DateTime),
+    Column('user_id', Integer, ForeignKey('user.id')),
+)
+
+feed = Table('feed', post_meta,
+    Column('user_id', Integer, ForeignKey('user.id'), primary_key=True, nullable=False),
+    Column('post_id', Integer, ForeignKey('post.id'), primary_key=True, nullable=False),
+    Column('timestamp', DateTime),
+    Index('ix_feed_user_timestamp_post', 'user_id', 'timestamp', 'post_id'),
+)
+
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('nickname', String(length=64)),
+    Column('email', String(length=120)),
+    Column('about_me', String(length=140)),
+    Column('last_seen', DateTime),
+    Column('fanout_on_read', Boolean, default=ColumnDefault(False)),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['followers'].create()
+    post_meta.tables['feed'].create()
+    post_meta.tables['user'].columns['fanout_on_read'].create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['followers'].drop()
+    post_meta.tables['feed'].drop()
+    post_meta.tables['user'].columns['fanout_on_read'].drop()
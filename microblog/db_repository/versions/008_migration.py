@@ -0,0 +1,44 @@
+from sqlalchemy import *
+from migrate import *
+from hashlib import md5
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('nickname', String(length=64)),
+    Column('email', String(length=120)),
+    Column('about_me', String(length=140)),
+    Column('last_seen', DateTime),
+    Column('fanout_on_read', Boolean, default=ColumnDefault(False)),
+    Column('email_hash', String(length=32)),
+)
+
+# frozen copy of app.models.AVATAR_EMAIL_ALIASES at the time of this migration
+AVATAR_EMAIL_ALIASES = {
+    'zhouen.nathan@yahoo.com': 'nathanzhou@qq.com',
+}
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['user'].columns['email_hash'].create()
+    # backfill the hash of the existing users
+    rows = []
+    for id, email in migrate_engine.execute(select([user.c.id, user.c.email]).where(user.c.email != None)):
+        email = AVATAR_EMAIL_ALIASES.get(email, email)
+        rows.append({'_id': id, 'email_hash': md5(email.encode('utf-8')).hexdigest()})
+    if rows:
+        migrate_engine.execute(user.update().where(user.c.id == bindparam('_id')), rows)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['user'].columns['email_hash'].drop()
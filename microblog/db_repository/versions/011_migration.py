@@ -0,0 +1,34 @@
+from sqlalchemy import *
+from migrate import *
+
+
+"""
+The post_search full text index is an FTS5 virtual table kept in sync by triggers, SQLAlchemy-migrate cannot generate it from the
+models so the statements are written out here (they are the same as SEARCH_DDL in app/search.py). The last statement fills the
+index with the posts that are already in the database.
+"""
+SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE post_search USING fts5(body, content='post', content_rowid='id')",
+    "CREATE TRIGGER post_search_insert AFTER INSERT ON post BEGIN "
+    "INSERT INTO post_search(rowid, body) VALUES (new.id, new.body); END",
+    "CREATE TRIGGER post_search_delete AFTER DELETE ON post BEGIN "
+    "INSERT INTO post_search(post_search, rowid, body) VALUES ('delete', old.id, old.body); END",
+    "CREATE TRIGGER post_search_update AFTER UPDATE OF body ON post BEGIN "
+    "INSERT INTO post_search(post_search, rowid, body) VALUES ('delete', old.id, old.body); "
+    "INSERT INTO post_search(rowid, body) VALUES (new.id, new.body); END",
+    "INSERT INTO post_search(post_search) VALUES ('rebuild')",
+]
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    for statement in SEARCH_DDL:
+        migrate_engine.execute(statement)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    for trigger in ('post_search_insert', 'post_search_delete', 'post_search_update'):
+        migrate_engine.execute('DROP TRIGGER IF EXISTS %s' % trigger)
+    migrate_engine.execute('DROP TABLE IF EXISTS post_search')
@@ -0,0 +1,40 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+openid_association = Table('openid_association', post_meta,
+    Column('server_url', String(length=2047), primary_key=True, nullable=False),
+    Column('handle', String(length=255), primary_key=True, nullable=False),
+    Column('secret', LargeBinary(length=128)),
+    Column('issued', Integer),
+    Column('lifetime', Integer),
+    Column('assoc_type', String(length=64)),
+    Column('expires', Integer, index=True),
+)
+
+openid_nonce = Table('openid_nonce', post_meta,
+    Column('server_url', String(length=2047), primary_key=True, nullable=False),
+    Column('timestamp', Integer, primary_key=True, nullable=False),
+    Column('salt', String(length=40), primary_key=True, nullable=False),
+    Index('ix_openid_nonce_timestamp', 'timestamp'),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['openid_association'].create()
+    post_meta.tables['openid_nonce'].create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['openid_association'].drop()
+    post_meta.tables['openid_nonce'].drop()
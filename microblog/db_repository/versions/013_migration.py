@@ -0,0 +1,65 @@
+from sqlalchemy import *
+from migrate import *
+
+from app.backfill import backfill, backfill_progress, column_exists
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('nickname', String(length=64)),
+    Column('email', String(length=120)),
+    Column('about_me', String(length=140)),
+    Column('last_seen', DateTime),
+    Column('fanout_on_read', Boolean, default=ColumnDefault(False)),
+    Column('email_hash', String(length=32)),
+    Column('profile_version', Integer, default=ColumnDefault(0)),
+    Column('post_count', Integer, default=ColumnDefault(0)),
+    Column('follower_count', Integer, default=ColumnDefault(0)),
+    Column('followed_count', Integer, default=ColumnDefault(0)),
+)
+
+post = Table('post', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('user_id', Integer),
+)
+
+followers = Table('followers', post_meta,
+    Column('follower_id', Integer, primary_key=True, nullable=False),
+    Column('followed_id', Integer, primary_key=True, nullable=False),
+)
+
+COUNTERS = ('post_count', 'follower_count', 'followed_count')
+
+
+def fill(conn, first_id, last_id):
+    # the same statement as recount() in app/counters.py
+    conn.execute(user.update().where(and_(user.c.id >= first_id, user.c.id <= last_id)).values(
+        post_count=select([func.count()]).select_from(post).where(post.c.user_id == user.c.id).as_scalar(),
+        follower_count=select([func.count()]).select_from(followers).where(followers.c.followed_id == user.c.id).as_scalar(),
+        followed_count=select([func.count()]).select_from(followers).where(followers.c.follower_id == user.c.id).as_scalar(),
+    ))
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    for name in COUNTERS:
+        if not column_exists(migrate_engine, 'user', name):
+            post_meta.tables['user'].columns[name].create()
+    backfill(migrate_engine, '013_user_counters', user, fill)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    for name in COUNTERS:
+        post_meta.tables['user'].columns[name].drop()
+    # an upgrade after this has to fill the columns again
+    backfill_progress.create(migrate_engine, checkfirst=True)
+    migrate_engine.execute(backfill_progress.delete().where(backfill_progress.c.name == '013_user_counters'))
@@ -0,0 +1,24 @@
+from sqlalchemy import *
+from migrate import *
+
+
+"""
+The trigger that lowers post_count when a post is deleted, the same statement as COUNTER_DDL in app/counters.py. The counters of
+posts deleted before the trigger existed are repaired by ./db_recount.py.
+"""
+COUNTER_DDL = [
+    "CREATE TRIGGER post_count_delete AFTER DELETE ON post BEGIN "
+    "UPDATE user SET post_count = post_count - 1 WHERE id = old.user_id; END",
+]
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    for statement in COUNTER_DDL:
+        migrate_engine.execute(statement)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    migrate_engine.execute('DROP TRIGGER IF EXISTS post_count_delete')
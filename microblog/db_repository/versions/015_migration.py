@@ -0,0 +1,29 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+import_progress = Table('import_progress', post_meta,
+    Column('source', String(length=255), primary_key=True, nullable=False),
+    Column('position', Integer, default=ColumnDefault(0)),
+    Column('inserted', Integer, default=ColumnDefault(0)),
+    Column('skipped', Integer, default=ColumnDefault(0)),
+    Column('invalid', Integer, default=ColumnDefault(0)),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['import_progress'].columns['invalid'].create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['import_progress'].columns['invalid'].drop()
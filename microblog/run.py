@@ -1,8 +1,8 @@
 #!../flask/bin/python
 
 """
-The script simply imports the app variable from our app package and invokes its run method to start the server. 
-Remember that the app variable holds the Flask instance that we created it above.
+The script simply builds the application with the create_app function from our app package and invokes its run method to start the server.
 """
-from app import app
+from app import create_app
+app = create_app()
 app.run(debug=False)
@@ -3,7 +3,7 @@
 """
 Discussing the unittest module is outside the scope of this article. Let's just say that class TestCase holds our tests. The setUp and tearDown methods are special, these are run before and after each test respectively. A more complex setup could include several groups of tests each represented by a unittest.TestCase subclass, and each group then would have independent setUp and tearDown methods.
 
-These particular setUp and tearDown methods are pretty generic. In setUp the configuration is edited a bit. For instance, we want the testing database to be different that the main database. In tearDown we just reset the database contents.
+These particular setUp and tearDown methods are pretty generic. In setUp the configuration is edited a bit. For instance, we want the testing database to be different that the main database. In tearDown we just reset the database contents (see the fixtures below).
 
 Tests are implemented as methods. A test is supposed to run some function of the application that has a known outcome, and should assert if the result is different than the expected one.
 
@@ -12,30 +12,344 @@ So far we have two tests in the testing framework. The first one verifies that t
 The second test verifies the make_unique_nickname method we just wrote, also in the User class. This test is a bit more elaborate, it creates a new user and writes it to the database, then ensures the same name is not allowed as a unique name. It then creates a second user with the suggested unique name and tries one more time to request the first nickname. The expected result for this second part is to get a suggested nickname that is different from the previous two.
 """
 
+import csv
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import logging
 import os
+import shutil
+import socketserver
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
 
 from config import basedir
-from app import app, db
-from app.models import User
+from app import create_app, db
+from app.extensions import last_seen, identity_cache, querycount, changes, fragments, metrics, nicknames, post_writer, avatars
+from app.models import User, Post, FeedEntry, ImportProgress, hash_email, openid_nonces
+from app import timeline
+from app.pagination import paginate
+from app.querycount import QueryBudgetExceeded
+from app.database import SQLiteProfile
+from app.logs import LogPipeline
+from app import bulk_import
+from app.avatars import placeholder
+from app.post_writer import PostQueueFull
+from app.counters import reconcile
+from app.search import search_posts, match_query, rebuild
+from app.backfill import backfill, backfill_progress, column_exists, progress
+from app.views import load_user, oid
+from app.openid_store import OpenIDStores, SQLStore
+from openid.association import Association
+from openid.store import nonce
+
+class AvatarHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Stands in for Gravatar in the avatar tests: /<hash>/<size> answers with server.images[hash] (404 if there is none) after
+    server.delay seconds, and every request is appended to server.requests.
+    """
+    def do_GET(self):
+        email_hash, size = self.path.strip('/').split('/')
+        self.server.requests.append((email_hash, int(size)))
+        time.sleep(self.server.delay)
+        image = self.server.images.get(email_hash)
+        if image is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(image) + int(size)))
+        self.end_headers()
+        self.wfile.write(image + b'.' * int(size))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough of an SMTP server for the log pipeline tests, every message received is appended to server.messages.
+    """
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self.reply('220 localhost')
+        while True:
+            line = self.rfile.readline().decode('utf-8')
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif command == 'DATA':
+                self.reply('354 go ahead')
+                lines = []
+                while True:
+                    line = self.rfile.readline().decode('utf-8')
+                    if line in ('.\r\n', ''):
+                        break
+                    lines.append(line)
+                self.server.messages.append(''.join(lines))
+                self.reply('250 ok')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+"""
+Creating and dropping every table around every test gets slower with each model we add, and a database file on disk means two runs of
+the suite cannot happen at the same time. Instead every process that runs tests gets its own in-memory SQLite database, in shared
+cache mode so that all the connections of the process see it. The tables are created once when this module is imported, and the
+keeper connection keeps the database alive for as long as the process runs. Nothing is shared between processes, so the suite can be
+split across several of them (pip install pytest-xdist, then python -m pytest -n auto tests.py).
+
+Each test then runs inside a transaction that is rolled back in tearDown, which leaves the tables empty for the next test no matter
+how much it wrote. The session is bound to the connection of that transaction and works inside a savepoint, a commit in the test or in
+a view releases the savepoint and starts the next one, and a rollback goes back to the last commit, like it would for real.
+
+Code that writes through a connection of its own (the bulk importer, the backfill, the last_seen flush) cannot join that transaction,
+the tests for it are marked @committing. They commit for real and the tables are emptied after them.
+
+The connections read uncommitted data (read_uncommitted only has an effect in shared cache mode), so a query that does not go through
+the session, like a lookup of the nickname index, still sees what the test has written.
+"""
+MEMORY_DATABASE = 'file:microblog-tests-%d?mode=memory&cache=shared' % os.getpid()
+
+
+def connect():
+    connection = sqlite3.connect(MEMORY_DATABASE, uri=True, check_same_thread=False)
+    # pysqlite would otherwise start and end transactions on its own, we emit BEGIN ourselves (see begin_explicitly below)
+    connection.isolation_level = None
+    connection.execute('PRAGMA read_uncommitted = 1')
+    return connection
+
+
+keeper = connect()
+app = create_app({
+    'TESTING': True,
+    'WTF_CSRF_ENABLED': False,
+    'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+    'SQLALCHEMY_ENGINE_OPTIONS': {'creator': connect, 'poolclass': QueuePool, 'pool_size': 5},
+    'LAST_SEEN_FLUSH_INTERVAL': 0,
+    'NICKNAME_INDEX': False,
+    'SQLALCHEMY_MAX_QUERIES_PER_REQUEST': 10,
+    'AVATAR_CACHE_DIR': os.path.join(tempfile.gettempdir(), 'microblog-avatars-%d' % os.getpid()),
+    # nothing listens on the discard port, the avatar tests start their own upstream
+    'AVATAR_UPSTREAM': 'http://127.0.0.1:9/%(hash)s/%(size)d',
+})
+with app.app_context():
+    event.listen(db.engine, 'begin', lambda conn: conn.execute('BEGIN'))
+    db.create_all()
+
+
+@event.listens_for(db.session, 'after_transaction_end')
+def restart_savepoint(session, transaction):
+    if session.info.get('savepoints') and transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
+def committing(test):
+    test.committing = True
+    return test
+
 
 class TestCase(unittest.TestCase):
     def setUp(self):
-        app.config['TESTING'] = True
-        app.config['WTF_CSRF_ENABLED'] = False
-        app.config['SQLALCHEMY_DATABASE_URI'] ='sqlite:///' + os.path.join(basedir, 'test.db')
+        self.config = dict(app.config)
         self.app = app.test_client()
-        db.create_all()
-    
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.committing = getattr(getattr(self, self._testMethodName), 'committing', False)
+        if not self.committing:
+            self.begin()
+
+    def begin(self):
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.session_options = dict(db.session.session_factory.kw)
+        self.create_session = db.session.registry.createfunc
+        def create_session():
+            session = self.create_session()
+            close = session.close
+            def close_session():
+                # give the savepoint back to the connection, close() would leave it open
+                session.info['savepoints'] = False
+                session.rollback()
+                close()
+            session.close = close_session
+            session.info['savepoints'] = True
+            session.begin_nested()
+            return session
+        db.session.remove()
+        db.session.configure(bind=self.connection, binds={})
+        db.session.registry.createfunc = create_session
+
     def tearDown(self):
+        identity_cache.clear()
+        fragments.clear()
+        metrics.clear()
+        last_seen.clear()
+        nicknames.clear()
+        avatars.clear()
         db.session.remove()
-        db.drop_all()
+        if self.committing:
+            with db.engine.begin() as conn:
+                for table in reversed(db.metadata.sorted_tables):
+                    conn.execute(table.delete())
+        else:
+            db.session.registry.createfunc = self.create_session
+            db.session.session_factory.kw = self.session_options
+            self.transaction.rollback()
+            self.connection.close()
+        self.ctx.pop()
+        app.config.clear()
+        app.config.update(self.config)
+
+    def login(self, user):
+        with self.app.session_transaction() as session:
+            session['user_id'] = session['_user_id'] = str(user.id)
+            session['_fresh'] = True
     
     def test_avatar(self):
         u = User(nickname='join', email='nathan@email.com')
-        avatar = u.avatar(128)
-        expected = 'http://www.gravatar.com/avatar/9d4806832c56ee86c6aae26889c53c67?d=mm&s=128'
-        assert avatar[0:len(expected)] == expected
+        with app.test_request_context():
+            avatar = u.avatar(128)
+        assert avatar == '/avatar/9d4806832c56ee86c6aae26889c53c67/128'
+
+    def test_avatar_hash_is_stored(self):
+        u = User(nickname='john', email='john@example.com')
+        assert u.email_hash == 'd4c74594d841139328695756648b6bd6'
+        u.email = 'zhouen.nathan@yahoo.com'
+        assert u.email_hash == hash_email('nathanzhou@qq.com')
+        db.session.add(u)
+        db.session.commit()
+        db.session.expire_all()
+        u = User.query.get(u.id)
+        with app.test_request_context():
+            assert u.avatar(50) == '/avatar/%s/50' % hash_email('nathanzhou@qq.com')
+
+    def start_upstream(self, images, delay=0):
+        """
+        Starts an AvatarHandler upstream with these images and points AVATAR_UPSTREAM at it, it is stopped after the test.
+        """
+        upstream = http.server.ThreadingHTTPServer(('127.0.0.1', 0), AvatarHandler)
+        upstream.images = images
+        upstream.requests = []
+        upstream.delay = delay
+        # a short poll interval, shutdown() waits for it
+        thread = threading.Thread(target=upstream.serve_forever, args=(0.05,))
+        thread.start()
+        def stop():
+            upstream.shutdown()
+            upstream.server_close()
+            thread.join()
+        self.addCleanup(stop)
+        app.config['AVATAR_UPSTREAM'] = 'http://127.0.0.1:%d/%%(hash)s/%%(size)d' % upstream.server_address[1]
+        return upstream
+
+    def test_avatar_concurrent_misses_share_one_request(self):
+        upstream = self.start_upstream({'a' * 32: b'PNG a'}, delay=0.2)
+        responses = []
+        def get():
+            responses.append(app.test_client().get('/avatar/%s/50' % ('a' * 32)))
+        clients = [threading.Thread(target=get) for i in range(5)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        assert upstream.requests == [('a' * 32, 50)]
+        assert [rv.data for rv in responses] == [b'PNG a' + b'.' * 50] * 5
+        assert responses[0].mimetype == 'image/png' and 'max-age=86400' in responses[0].headers['Cache-Control']
+
+    def test_avatar_is_served_from_the_cache(self):
+        upstream = self.start_upstream({'a' * 32: b'PNG a'})
+        first = self.app.get('/avatar/%s/50' % ('a' * 32))
+        rv = self.app.get('/avatar/%s/50' % ('a' * 32))
+        assert rv.data == first.data and len(upstream.requests) == 1
+        assert self.app.get('/avatar/%s/50' % ('a' * 32), headers={'If-None-Match': rv.headers['ETag']}).status_code == 304
+        # the ETag is the name the image is stored under
+        digest = rv.headers['ETag'].strip('"')
+        assert os.path.exists(os.path.join(app.config['AVATAR_CACHE_DIR'], 'blobs', digest[:2], digest + '.png'))
+
+    def test_avatar_placeholder(self):
+        upstream = self.start_upstream({})
+        rv = self.app.get('/avatar/%s/50' % ('c' * 32))
+        assert rv.mimetype == 'image/svg+xml' and rv.data == placeholder('c' * 32, 50)
+        assert self.app.get('/avatar/%s/50' % ('c' * 32)).data == rv.data and len(upstream.requests) == 1
+        assert placeholder('d' * 32, 50) != rv.data
+
+    def test_avatar_bad_urls(self):
+        for url in ('/avatar/nothex/50', '/avatar/%s/0' % ('a' * 32), '/avatar/%s/513' % ('a' * 32)):
+            assert self.app.get(url).status_code == 404
+
+    def test_avatar_cache_eviction(self):
+        upstream = self.start_upstream({'a' * 32: b'PNG a', 'b' * 32: b'PNG b'})
+        app.config['AVATAR_CACHE_MAX_BYTES'] = len(placeholder('c' * 32, 50)) + 55 + 60
+        self.app.get('/avatar/%s/50' % ('a' * 32))
+        self.app.get('/avatar/%s/50' % ('c' * 32))
+        # the least recently served files are evicted to stay under AVATAR_CACHE_MAX_BYTES
+        self.app.get('/avatar/%s/100' % ('b' * 32))
+        stats = avatars.stats()
+        assert stats['bytes'] <= app.config['AVATAR_CACHE_MAX_BYTES'] and stats['evictions'] == 1
+        self.app.get('/avatar/%s/50' % ('a' * 32))
+        assert len(upstream.requests) == 4
+        assert os.listdir(os.path.join(app.config['AVATAR_CACHE_DIR'], 'refs', 'aa')) == ['%s-50' % ('a' * 32)]
+
+    def test_avatar_images_are_shared(self):
+        self.start_upstream({'a' * 32: b'PNG a', 'e' * 32: b'PNG a'})
+        data = self.app.get('/avatar/%s/50' % ('a' * 32)).data
+        before = avatars.stats()
+        # the images are stored under the hash of their content, two users with the same picture share it
+        assert self.app.get('/avatar/%s/50' % ('e' * 32)).data == data
+        stats = avatars.stats()
+        assert stats['avatars'] == before['avatars'] + 1 == 2 and stats['images'] == before['images'] == 1
+        assert stats['bytes'] == before['bytes']
+        digest = hashlib.sha256(data).hexdigest()
+        assert os.path.exists(os.path.join(app.config['AVATAR_CACHE_DIR'], 'blobs', digest[:2], digest + '.png'))
+
+    def test_avatar_scaled_locally(self):
+        upstream = self.start_upstream({'b' * 32: b'PNG b'})
+        # the avatars extension hides the module of the same name in the app package
+        avatars_module = sys.modules['app.avatars']
+        image, resize = avatars_module.Image, avatars_module.resize
+        avatars_module.Image, avatars_module.resize = object(), lambda data, size: data[:5] + b' %d' % size
+        try:
+            # with an image library the largest size is fetched once and the others are scaled from it here
+            assert self.app.get('/avatar/%s/30' % ('b' * 32)).data == b'PNG b 30'
+            assert self.app.get('/avatar/%s/40' % ('b' * 32)).data == b'PNG b 40'
+            assert self.app.get('/avatar/%s/40' % ('d' * 32)).data == placeholder('d' * 32, 40)
+        finally:
+            avatars_module.Image, avatars_module.resize = image, resize
+        assert upstream.requests == [('b' * 32, 512), ('d' * 32, 512)] and avatars.stats()['resized'] == 2
+
+    def test_avatar_upstream_down(self):
+        before = avatars.stats()
+        # nothing listens on the default test upstream
+        rv = self.app.get('/avatar/%s/60' % ('b' * 32))
+        assert rv.data == placeholder('b' * 32, 60) and rv.headers['Cache-Control'] == 'public, no-cache'
+        # the placeholder is not cached, and the upstream is left alone for a while
+        self.app.get('/avatar/%s/70' % ('b' * 32))
+        stats = avatars.stats()
+        assert stats['upstream_errors'] == before['upstream_errors'] + 1
+        assert stats['upstream_requests'] == before['upstream_requests'] + 1 and stats['avatars'] == 0
 
     def test_make_unique_nickname(self):
         u = User(nickname='john', email='john@example.com')
@@ -50,6 +364,1034 @@ class TestCase(unittest.TestCase):
         assert nickname2 != 'john'
         assert nickname2 != nickname
 
+    def test_make_unique_nickname_query_count(self):
+        def queries_for_next_nickname():
+            with querycount.count_queries() as statements:
+                nickname = User.make_unique_nickname('john')
+            return nickname, len(statements)
+        db.session.add(User(nickname='john', email='john@example.com'))
+        db.session.add(User(nickname='johnny', email='johnny@example.com'))
+        db.session.add(User(nickname='john02', email='john02@example.com'))
+        db.session.commit()
+        nickname, few = queries_for_next_nickname()
+        assert nickname == 'john2'
+        for i in range(2, 52):
+            db.session.add(User(nickname='john%d' % i, email='john%d@example.com' % i))
+        db.session.commit()
+        nickname, many = queries_for_next_nickname()
+        assert nickname == 'john52'
+        assert many == few == 1
+
+    @committing
+    def test_nickname_index(self):
+        john = User(nickname='john', email='john@example.com')
+        db.session.add_all([john, User(nickname='johnny', email='johnny@example.com'),
+                            User(nickname='susan', email='susan@example.com')])
+        db.session.commit()
+        # cold, the answers come from the database
+        assert nicknames.prefixed('jo') == ['john', 'johnny']
+        app.config['NICKNAME_INDEX'] = True
+        assert nicknames.load() == 3
+        with querycount.count_queries() as statements:
+            assert nicknames.is_taken('john') and not nicknames.is_taken('mary')
+            assert nicknames.prefixed('jo') == ['john', 'johnny']
+            assert nicknames.prefixed('j', limit=1) == ['john']
+            assert User.make_unique_nickname('john') == 'john2'
+        assert statements == []
+        # commits are applied to the index
+        susan = User.query.filter_by(nickname='susan').first()
+        susan.nickname = 'joe'
+        db.session.add(User(nickname='mary', email='mary@example.com'))
+        db.session.delete(User.query.filter_by(nickname='johnny').first())
+        db.session.commit()
+        assert nicknames.prefixed('jo') == ['joe', 'john']
+        assert nicknames.is_taken('mary') and not nicknames.is_taken('susan')
+        assert nicknames.stats()['size'] == 3 and nicknames.stats()['memory'] > 0
+        self.login(john)
+        db.session.remove()
+        rv = self.app.get('/autocomplete/nicknames?q=jo')
+        assert json.loads(rv.data.decode('utf-8')) == {'nicknames': ['joe', 'john']}
+        rv = self.app.post('/edit', data=dict(nickname='mary', about_me=''))
+        assert 'This nickname is already in use' in rv.data.decode('utf-8')
+        # a nickname written by another process is not in the index yet, the unique index catches it
+        db.engine.execute(User.__table__.insert(), nickname='zed', email='zed@example.com')
+        rv = self.app.post('/edit', data=dict(nickname='zed', about_me=''))
+        assert 'This nickname is already in use' in rv.data.decode('utf-8')
+        assert 'microblog_nickname_index_entries 3.0' in self.app.get('/metrics').data.decode('utf-8')
+
+    def test_create_unique_retries_on_race(self):
+        db.session.add(User(nickname='john', email='john@example.com'))
+        db.session.add(User(nickname='john2', email='john2@example.com'))
+        db.session.commit()
+        suggestions = ['john2']
+        make_unique_nickname = User.make_unique_nickname
+        def racing(nickname, cached=True):
+            # the first suggestion was computed before the other signup committed
+            if suggestions:
+                return suggestions.pop()
+            return make_unique_nickname(nickname, cached)
+        User.make_unique_nickname = staticmethod(racing)
+        try:
+            u = User.create_unique('john', 'susan@example.com')
+        finally:
+            User.make_unique_nickname = staticmethod(make_unique_nickname)
+        assert u.nickname == 'john3'
+        assert User.create_unique('john', 'susan@example.com').id == u.id
+
+    def test_home_timeline_fan_out_on_write(self):
+        john = User(nickname='john', email='john@example.com')
+        susan = User(nickname='susan', email='susan@example.com')
+        mary = User(nickname='mary', email='mary@example.com')
+        db.session.add_all([john, susan, mary])
+        db.session.commit()
+        now = datetime.utcnow()
+        old = timeline.publish(susan.id, 'post from susan', now)
+        db.session.commit()
+        assert timeline.follow(john.id, susan.id)
+        assert not timeline.follow(john.id, susan.id)
+        db.session.commit()
+        p1 = timeline.publish(john.id, 'post from john', now + timedelta(seconds=1))
+        p2 = timeline.publish(susan.id, 'another from susan', now + timedelta(seconds=2))
+        p3 = timeline.publish(mary.id, 'post from mary', now + timedelta(seconds=3))
+        db.session.commit()
+        assert FeedEntry.query.filter_by(user_id=john.id).count() == 3
+        assert [p.id for p in timeline.home_timeline(john.id, 10)] == [p2.id, p1.id, old.id]
+        assert [p.id for p in timeline.home_timeline(john.id, 2)] == [p2.id, p1.id]
+        assert [p.id for p in timeline.home_timeline(mary.id, 10)] == [p3.id]
+        assert timeline.unfollow(john.id, susan.id)
+        db.session.commit()
+        assert [p.id for p in timeline.home_timeline(john.id, 10)] == [p1.id]
+
+    def test_home_timeline_fan_out_on_read(self):
+        app.config['FEED_FANOUT_MAX_FOLLOWERS'] = 1
+        try:
+            star = User(nickname='star', email='star@example.com')
+            fans = [User(nickname='fan%d' % i, email='fan%d@example.com' % i) for i in range(3)]
+            db.session.add_all([star] + fans)
+            db.session.commit()
+            for fan in fans:
+                timeline.follow(fan.id, star.id)
+            post = timeline.publish(star.id, 'hello fans')
+            db.session.commit()
+            assert User.query.get(star.id).fanout_on_read
+            assert FeedEntry.query.count() == 1
+            for fan in fans:
+                assert [p.id for p in timeline.home_timeline(fan.id, 10)] == [post.id]
+        finally:
+            app.config['FEED_FANOUT_MAX_FOLLOWERS'] = 1000
+
+    def follow_and_post(self):
+        """
+        john and susan follow each other, mary followed susan and stopped, and susan wrote two posts. Returns their ids.
+        """
+        john = User(nickname='john', email='john@example.com')
+        susan = User(nickname='susan', email='susan@example.com')
+        mary = User(nickname='mary', email='mary@example.com')
+        db.session.add_all([john, susan, mary])
+        db.session.commit()
+        john_id, susan_id, mary_id = john.id, susan.id, mary.id
+        timeline.follow(john_id, susan_id)
+        timeline.follow(mary_id, susan_id)
+        timeline.follow(susan_id, john_id)
+        timeline.publish(susan_id, 'one')
+        timeline.publish(susan_id, 'two')
+        db.session.commit()
+        timeline.unfollow(mary_id, susan_id)
+        db.session.commit()
+        return john_id, susan_id, mary_id
+
+    def counts(self, user_id):
+        return db.session.query(User.post_count, User.follower_count, User.followed_count).filter_by(id=user_id).one()
+
+    def test_user_counters(self):
+        john_id, susan_id, mary_id = self.follow_and_post()
+        assert self.counts(susan_id) == (2, 1, 1) and self.counts(john_id) == (0, 1, 1) and self.counts(mary_id) == (0, 0, 0)
+
+    def test_profile_reads_the_counters(self):
+        john_id, susan_id, mary_id = self.follow_and_post()
+        self.login(User.query.get(john_id))
+        with querycount.count_queries() as statements:
+            page = self.app.get('/user/susan').get_data(as_text=True)
+        assert '2 posts | 1 followers | 1 following' in page
+        assert statements and not [statement for statement in statements if 'count(' in statement.lower()]
+
+    @committing
+    def test_reconcile_repairs_the_counters(self):
+        john_id, susan_id, mary_id = self.follow_and_post()
+        # drift made behind the application's back
+        db.session.execute('UPDATE user SET post_count = 7 WHERE id = %d' % susan_id)
+        db.session.execute('DELETE FROM followers WHERE follower_id = %d' % john_id)
+        db.session.commit()
+        try:
+            assert reconcile(db.engine, batch_size=2, pause=0) == 2
+            assert self.counts(susan_id) == (2, 0, 1) and self.counts(john_id) == (0, 1, 0)
+            assert reconcile(db.engine, batch_size=2, pause=0) == 0
+        finally:
+            db.session.remove()
+            backfill_progress.drop(db.engine, checkfirst=True)
+
+    def test_deleted_post_lowers_post_count(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        first = timeline.publish(u.id, 'one')
+        timeline.publish(u.id, 'two')
+        db.session.commit()
+        db.session.delete(first)
+        db.session.commit()
+        assert db.session.query(User.post_count).filter_by(id=u.id).scalar() == 1
+        db.session.execute('DELETE FROM post WHERE user_id = %d' % u.id)
+        db.session.commit()
+        assert db.session.query(User.post_count).filter_by(id=u.id).scalar() == 0
+
+    def test_follow_twice_counts_once(self):
+        john = User(nickname='john', email='john@example.com')
+        susan = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        assert timeline.follow(john.id, susan.id)
+        assert not timeline.follow(john.id, susan.id)
+        db.session.commit()
+        counts = db.session.query(User.follower_count, User.followed_count)
+        assert counts.filter_by(id=john.id).one() == (0, 1) and counts.filter_by(id=susan.id).one() == (1, 0)
+        assert timeline.unfollow(john.id, susan.id)
+        assert not timeline.unfollow(john.id, susan.id)
+        db.session.commit()
+        assert counts.filter_by(id=john.id).one() == (0, 0) and counts.filter_by(id=susan.id).one() == (0, 0)
+
+    def start_post_writer(self, **config):
+        """
+        Creates john and sets up the post writer with config, the writer is stopped and reset after the test.
+        """
+        john = User(nickname='john', email='john@example.com')
+        db.session.add(john)
+        db.session.commit()
+        app.config.update(POST_GROUP_COMMIT=True, **config)
+        def reset():
+            post_writer.stop()
+            post_writer.init_app(app)
+        self.addCleanup(reset)
+        return john.id
+
+    def publish_in_thread(self, user_id, body, ids=None):
+        def write():
+            with app.app_context():
+                post_id = post_writer.publish(user_id, body)
+            if ids is not None:
+                ids.append(post_id)
+        thread = threading.Thread(target=write)
+        thread.start()
+        return thread
+
+    def block_post_writer(self):
+        """
+        Makes the writer wait before it writes each post, until the returned event is set.
+        """
+        release = threading.Event()
+        publish = timeline.publish
+        def blocked(*args):
+            release.wait()
+            return publish(*args)
+        timeline.publish = blocked
+        def restore():
+            release.set()
+            timeline.publish = publish
+        self.addCleanup(restore)
+        return release
+
+    @committing
+    def test_post_writer_group_commit(self):
+        john_id = self.start_post_writer(POST_BATCH_SIZE=10, POST_BATCH_WINDOW=0.2)
+        before = post_writer.stats()
+        ids = []
+        for thread in [self.publish_in_thread(john_id, 'post %d' % i, ids) for i in range(8)]:
+            thread.join()
+        assert len(ids) == 8 and Post.query.count() == 8
+        assert FeedEntry.query.filter_by(user_id=john_id).count() == 8
+        stats = post_writer.stats()
+        batches = stats['batches'] - before['batches']
+        assert stats['posts'] - before['posts'] == 8 and batches < 8 and stats['queued'] == 0
+        assert 'microblog_post_batch_size_count{endpoint="post_writer"} %d' % batches in \
+            self.app.get('/metrics').data.decode('utf-8')
+
+    @committing
+    def test_post_writer_bad_post_fails_on_its_own(self):
+        john_id = self.start_post_writer(POST_BATCH_SIZE=10, POST_BATCH_WINDOW=0.2)
+        ids = []
+        thread = self.publish_in_thread(john_id, 'good', ids)
+        with self.assertRaises(Exception):
+            post_writer.publish(john_id, 'bad', 'not a date')
+        thread.join()
+        assert len(ids) == 1 and [p.body for p in Post.query] == ['good']
+
+    @committing
+    def test_post_writer_turns_posts_away_when_full(self):
+        john_id = self.start_post_writer(POST_QUEUE_SIZE=1, POST_QUEUE_TIMEOUT=0.01, POST_BATCH_SIZE=1)
+        release = self.block_post_writer()
+        # one post is held by the writer, the other one fills the queue
+        threads = []
+        for i in range(2):
+            threads.append(self.publish_in_thread(john_id, 'post %d' % i))
+            time.sleep(0.1)
+        self.login(User.query.get(john_id))
+        db.session.remove()
+        rv = self.app.post('/index', data=dict(post='too many'))
+        assert rv.status_code == 503 and rv.headers['Retry-After'] == '1'
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert Post.query.count() == 2
+
+    @committing
+    def test_post_writer_gives_up_after_the_write_timeout(self):
+        john_id = self.start_post_writer(POST_QUEUE_SIZE=10, POST_BATCH_SIZE=1, POST_WRITE_TIMEOUT=0.2)
+        release = self.block_post_writer()
+        thread = self.publish_in_thread(john_id, 'held')
+        time.sleep(0.1)
+        with self.assertRaises(PostQueueFull):
+            post_writer.publish(john_id, 'given up')
+        release.set()
+        thread.join()
+        post_writer.stop()
+        # a post the writer did not get to in time is not written later
+        assert [p.body for p in Post.query] == ['held']
+
+    @committing
+    def test_post_writer_refuses_posts_once_stopped(self):
+        john_id = self.start_post_writer()
+        post_writer.stop()
+        start = time.time()
+        with self.assertRaises(PostQueueFull):
+            post_writer.publish(john_id, 'too late')
+        assert time.time() - start < 0.1
+
+    def test_keyset_pagination(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        now = datetime.utcnow()
+        for i in range(7):
+            # pairs of posts share a timestamp, the id breaks the tie
+            timeline.publish(u.id, 'post #%d' % i, now + timedelta(seconds=i // 2))
+        db.session.commit()
+        expected = [p.id for p in Post.query.order_by(Post.timestamp.desc(), Post.id.desc())]
+        for page_of in (lambda cursor: paginate(Post.query.filter_by(user_id=u.id), Post.timestamp, Post.id, cursor, 3),
+                        lambda cursor: timeline.home_timeline(u.id, 3, cursor)):
+            seen, cursor = [], None
+            while True:
+                page = page_of(cursor)
+                seen.extend(p.id for p in page)
+                if not page.has_next:
+                    break
+                cursor = page.next_cursor
+            assert seen == expected
+
+    def test_keyset_pagination_uses_index(self):
+        plan = db.session.execute(
+            'EXPLAIN QUERY PLAN SELECT id FROM post WHERE user_id = 1 AND timestamp <= :ts '
+            'AND (timestamp < :ts OR id < 10) ORDER BY timestamp DESC, id DESC LIMIT 21',
+            {'ts': datetime.utcnow()}).fetchall()
+        details = ' '.join(str(row[-1]) for row in plan)
+        assert 'ix_post_user_timestamp_id' in details
+        assert 'TEMP B-TREE' not in details
+
+    def test_post_lists_do_not_lazy_load_authors(self):
+        viewer = User(nickname='viewer', email='viewer@example.com')
+        authors = [User(nickname='author%d' % i, email='author%d@example.com' % i) for i in range(15)]
+        db.session.add_all([viewer] + authors)
+        db.session.commit()
+        for author in authors:
+            timeline.follow(viewer.id, author.id)
+            timeline.publish(author.id, 'hello from %s' % author.nickname)
+        db.session.commit()
+        self.login(viewer)
+        with querycount.max_queries(5):
+            rv = self.app.get('/index')
+        assert rv.status_code == 200
+        assert b'hello from author0' in rv.data
+        with querycount.max_queries(5):
+            rv = self.app.get('/user/author3')
+        assert rv.status_code == 200
+
+    def test_query_budget_fails_the_request(self):
+        db.session.add(User(nickname='john', email='john@example.com'))
+        db.session.commit()
+        with self.assertRaises(QueryBudgetExceeded):
+            with querycount.max_queries(1):
+                User.query.count()
+                User.query.count()
+        app.config['SQLALCHEMY_MAX_QUERIES_PER_REQUEST'] = 0
+        self.login(User.query.first())
+        with self.assertRaises(QueryBudgetExceeded):
+            self.app.get('/user/john')
+
+    def test_app_factory(self):
+        # importing the models must not build an application or load the views, and every application gets its own config
+        script = ('import sys, app.models\n'
+                  'assert not [m for m in ("app.views", "flask_login", "flask_openid", "wtforms") if m in sys.modules]\n'
+                  'from app import create_app\n'
+                  'other = create_app({"TESTING": True, "POSTS_PER_PAGE": 5})\n'
+                  'assert other.config["POSTS_PER_PAGE"] == 5 and "main.index" in other.view_functions\n'
+                  'print("ok")\n')
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=basedir)
+        assert output.decode('utf-8').strip() == 'ok'
+        assert app.config['POSTS_PER_PAGE'] == 20
+
+    def test_sqlite_production_profile(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            other = Flask(__name__)
+            other.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmpdir, 'app.db')
+            other.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+            other.config['SQLITE_PROFILE'] = 'production'
+            other_db = SQLAlchemy(other)
+            profile = SQLiteProfile(other, other_db)
+            with other.app_context():
+                assert other_db.session.execute('PRAGMA journal_mode').scalar() == 'wal'
+                assert other_db.session.execute('PRAGMA busy_timeout').scalar() == 5000
+                other_db.session.execute('CREATE TABLE t (x INTEGER)')
+                other_db.session.execute('INSERT INTO t VALUES (1)')
+                other_db.session.commit()
+                reads = profile.read_session()
+                assert reads is not other_db.session
+                assert reads.execute('SELECT count(*) FROM t').scalar() == 1
+                with self.assertRaises(OperationalError):
+                    reads.execute('INSERT INTO t VALUES (2)')
+                reads.rollback()
+                other_db.session.remove()
+                other_db.get_engine().dispose()
+        finally:
+            shutil.rmtree(tmpdir)
+        assert app.extensions['sqlite_profile'].read_session() is db.session
+
+    def test_change_bus(self):
+        seen = []
+        subscription = changes.subscribe(User, fields=['nickname'])(seen.append)
+        try:
+            u = User(nickname='john', email='john@example.com')
+            db.session.add(u)
+            db.session.flush()
+            assert seen == []
+            db.session.commit()
+            assert [(c.id, c.op) for c in seen] == [(u.id, 'insert')]
+            u.about_me = 'not watched'
+            db.session.commit()
+            assert len(seen) == 1
+            u.nickname = 'johnny'
+            db.session.flush()
+            db.session.rollback()
+            assert len(seen) == 1
+            u.nickname = 'johnny'
+            db.session.commit()
+            assert [(c.op, c.fields) for c in seen[1:]] == [('update', frozenset(['nickname']))]
+            db.session.delete(u)
+            db.session.commit()
+            assert seen[-1].op == 'delete'
+        finally:
+            changes.unsubscribe(User, subscription)
+
+    def show_profile(self):
+        """
+        Creates john with three posts, logs him in and returns him with the ETag of his profile page.
+        """
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        for i in range(3):
+            timeline.publish(u.id, 'post #%d' % i)
+        db.session.commit()
+        self.login(u)
+        rv = self.app.get('/user/john')
+        assert rv.status_code == 200
+        return u, rv.headers['ETag']
+
+    def test_profile_not_modified(self):
+        u, tag = self.show_profile()
+        assert u.profile_version == 0
+        before = fragments.stats()
+        with querycount.count_queries() as statements:
+            rv = self.app.get('/user/john', headers={'If-None-Match': tag})
+        assert rv.status_code == 304
+        assert not [s for s in statements if 'post.body' in s]
+        assert fragments.stats() == before
+
+    def test_profile_etag_follows_the_csrf_token(self):
+        u, tag = self.show_profile()
+        # a new CSRF token in the session makes the page stale, the search form in it would be rejected
+        with self.app.session_transaction() as session:
+            session['csrf_token'] = 'another token'
+        assert self.app.get('/user/john', headers={'If-None-Match': tag}).status_code == 200
+        with self.app.session_transaction() as session:
+            del session['csrf_token']
+        assert self.app.get('/user/john', headers={'If-None-Match': tag}).status_code == 304
+
+    def test_profile_etag_expires_with_the_csrf_token(self):
+        self.show_profile()
+        app.config['WTF_CSRF_TIME_LIMIT'] = 0.2
+        tag = self.app.get('/user/john').headers['ETag']
+        time.sleep(0.1)
+        assert self.app.get('/user/john', headers={'If-None-Match': tag}).status_code == 200
+
+    def test_profile_fragments_are_reused(self):
+        self.show_profile()
+        before = fragments.stats()
+        rv = self.app.get('/user/john', headers={'If-None-Match': '"stale"'})
+        assert rv.status_code == 200
+        stats = fragments.stats()
+        assert stats['hits'] == before['hits'] + 4
+        assert stats['misses'] == before['misses']
+
+    def test_profile_etag_changes_with_the_profile(self):
+        u, tag = self.show_profile()
+        u = User.query.get(u.id)
+        u.about_me = 'new about me'
+        u.nickname = 'john'
+        db.session.commit()
+        assert u.profile_version == 1
+        rv = self.app.get('/user/john', headers={'If-None-Match': tag})
+        assert rv.status_code == 200
+        assert b'new about me' in rv.data
+
+    def test_profile_etag_changes_with_a_new_post(self):
+        u, tag = self.show_profile()
+        timeline.publish(u.id, 'one more post')
+        db.session.commit()
+        assert self.app.get('/user/john', headers={'If-None-Match': tag}).status_code == 200
+
+    def test_profile_version_of_a_stale_snapshot(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        stale = identity_cache.load(u.id, User.query.get)
+        u.about_me = 'edited elsewhere'
+        db.session.commit()
+        assert u.profile_version == 1
+        db.session.expunge_all()
+        assert stale.profile_version == 0
+        stale.about_me = 'edited here'
+        db.session.add(stale)
+        db.session.commit()
+        assert stale.profile_version == 2
+
+    def test_edited_post_is_rendered_again(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        post = timeline.publish(u.id, 'first draft')
+        db.session.commit()
+        self.login(u)
+        assert 'first draft' in self.app.get('/user/john').get_data(as_text=True)
+        post.body = 'second draft'
+        db.session.commit()
+        html = self.app.get('/user/john').get_data(as_text=True)
+        assert 'second draft' in html and 'first draft' not in html
+
+    @committing
+    def test_last_seen_is_coalesced(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        now = datetime.utcnow()
+        assert last_seen.touch(u.id, now)
+        assert not last_seen.touch(u.id, now + timedelta(seconds=1))
+        assert last_seen.last_seen(u.id) == now
+        assert User.query.get(u.id).last_seen is None
+        assert last_seen.flush() == 1
+        assert last_seen.flush() == 0
+        db.session.expire_all()
+        assert User.query.get(u.id).last_seen == now
+        # once the window has passed the flushed visit is forgotten and read from the database
+        assert last_seen.flush(now + timedelta(seconds=30)) == 0
+        assert last_seen.last_seen(u.id) == now
+        assert last_seen.flush(now + timedelta(seconds=61)) == 0
+        assert last_seen.last_seen(u.id) is None
+        assert last_seen.last_seen(u.id, now) == now
+        assert last_seen.touch(u.id, now + timedelta(seconds=62))
+
+    def test_identity_cache(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        uid = u.id
+        db.session.remove()
+        before = identity_cache.stats()
+        first = load_user(str(uid))
+        second = load_user(str(uid))
+        stats = identity_cache.stats()
+        assert stats['misses'] == before['misses'] + 1
+        assert stats['hits'] == before['hits'] + 1
+        assert first is not second
+        assert second.nickname == 'john'
+        second.about_me = 'hello'
+        db.session.add(second)
+        db.session.commit()
+        assert User.query.count() == 1
+        assert load_user(str(uid)).about_me == 'hello'
+        assert identity_cache.stats()['misses'] == before['misses'] + 2
+
+    def test_identity_cache_eviction(self):
+        identity_cache.maxsize = 2
+        try:
+            for i in range(3):
+                db.session.add(User(nickname='user%d' % i, email='user%d@example.com' % i))
+            db.session.commit()
+            before = identity_cache.stats()['evictions']
+            for u in User.query.all():
+                load_user(str(u.id))
+            assert identity_cache.stats()['evictions'] == before + 1
+            assert identity_cache.stats()['size'] == 2
+        finally:
+            identity_cache.maxsize = app.config['IDENTITY_CACHE_SIZE']
+
+    def show_john(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.login(u)
+        with querycount.count_queries() as statements:
+            assert self.app.get('/user/john').status_code == 200
+        return statements
+
+    def metrics_dir(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        # write the file after every request
+        app.config.update(METRICS_DIR=tmpdir, METRICS_WRITE_INTERVAL=0)
+        return tmpdir
+
+    def test_metrics(self):
+        statements = self.show_john()
+        text = self.app.get('/metrics').get_data(as_text=True)
+        assert '# TYPE microblog_request_duration_seconds histogram' in text
+        assert 'microblog_request_duration_seconds_count{endpoint="main.user"} 1' in text
+        assert 'microblog_request_duration_seconds_bucket{endpoint="main.user",le="+Inf"} 1' in text
+        assert 'microblog_sql_queries_count{endpoint="main.user"} 1' in text
+        assert 'microblog_sql_queries_sum{endpoint="main.user"} %r' % float(len(statements)) in text
+        assert 'microblog_sql_queries_bucket{endpoint="main.user",le="1"} 0' in text
+        assert 'microblog_template_render_seconds_count{endpoint="main.user"} 1' in text
+        assert 'endpoint="metrics"' not in text
+
+    def test_metrics_log_slow_requests(self):
+        app.config['METRICS_SLOW_REQUEST'] = 0
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            statements = self.show_john()
+        assert 'slow request GET /user/john' in logs.output[0]
+        assert '%d SQL statements' % len(statements) in logs.output[0]
+        assert 'SELECT' in logs.output[0]
+
+    def test_metrics_of_the_other_workers(self):
+        tmpdir = self.metrics_dir()
+        self.show_john()
+        # another worker that is running, and one that is gone
+        worker = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        other = [['microblog_request_duration_seconds', 'main.user', [0] * 11 + [2], 30.0, 2]]
+        for pid in (worker.pid, dead.pid):
+            with open(os.path.join(tmpdir, 'metrics_%d.json' % pid), 'w') as f:
+                json.dump(other, f)
+        try:
+            text = self.app.get('/metrics').get_data(as_text=True)
+        finally:
+            worker.kill()
+            worker.wait()
+        assert 'microblog_request_duration_seconds_count{endpoint="main.user"} 3' in text
+        own = 'metrics_%d.json' % os.getpid()
+        assert sorted(os.listdir(tmpdir)) == sorted([own, 'metrics_%d.json' % worker.pid])
+        # a worker that is gone drops out
+        assert 'microblog_request_duration_seconds_count{endpoint="main.user"} 1' in \
+            self.app.get('/metrics').get_data(as_text=True)
+        assert os.listdir(tmpdir) == [own]
+
+    def test_metrics_file_is_removed_on_exit(self):
+        tmpdir = self.metrics_dir()
+        self.show_john()
+        assert os.listdir(tmpdir) == ['metrics_%d.json' % os.getpid()]
+        metrics.remove()
+        assert os.listdir(tmpdir) == []
+
+    @committing
+    def test_benchmark_sessions(self):
+        import random
+        import benchmark
+        edges = benchmark.generate(5, 60, 2, seed=3)
+        assert User.query.count() == 5
+        assert Post.query.count() == 60
+        assert len(edges) == 10
+        assert FeedEntry.query.count() == 60 + sum(Post.query.filter_by(user_id=edge['followed_id']).count() for edge in edges)
+        for u in User.query.all():
+            assert u.post_count == u.posts.count() and u.followed_count == 2
+            assert u.follower_count == len([edge for edge in edges if edge['followed_id'] == u.id])
+        db.session.remove()
+        backfill_progress.drop(db.engine, checkfirst=True)
+        samples = []
+        benchmark.play_session(benchmark.TestClientDriver(app, 1), 1, [edge['followed_id'] for edge in edges if edge['follower_id'] == 1],
+                               random.Random(3), samples)
+        result = benchmark.summarize(samples, 1.0)
+        assert set(result['pages']) == set(['GET index', 'GET user', 'GET edit', 'POST edit', 'POST index'])
+        assert sum(stats['errors'] for stats in result['pages'].values()) == 0
+        slower = dict(result, throughput=result['throughput'] / 2)
+        assert benchmark.compare({'5x60': slower}, {'5x60': result}, 0.2) == [
+            '5x60: throughput %.1f req/s, baseline %.1f req/s' % (slower['throughput'], result['throughput'])]
+
+    @committing
+    def test_bulk_import(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        users = os.path.join(tmpdir, 'users.jsonl')
+        with open(users, 'w') as f:
+            for nickname in ['john', 'susan', 'john', 'mary']:
+                f.write(json.dumps({'nickname': nickname, 'email': nickname + '@example.com'}) + '\n')
+            f.write(json.dumps({'nickname': 'anonymous'}) + '\n')
+        assert bulk_import.import_file('users', users, batch_size=2) == {'read': 5, 'inserted': 4, 'skipped': 1, 'invalid': 0}
+        john = User.query.filter_by(nickname='john').one()
+        assert john.email_hash == hash_email('john@example.com')
+        anonymous = User.query.filter_by(nickname='anonymous').one()
+        assert anonymous.email is None and anonymous.email_hash is None
+
+    @committing
+    def test_bulk_import_resumes_after_an_interruption(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        john = User(nickname='john', email='john@example.com')
+        susan = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        john_id, susan_id = john.id, susan.id
+        timeline.follow(susan_id, john_id)
+        db.session.commit()
+        posts = os.path.join(tmpdir, 'posts.csv')
+        with open(posts, 'w') as f:
+            f.write('nickname,body,timestamp\n')
+            for i in range(5):
+                f.write('john,post %d,2016-01-0%d 10:00:00\n' % (i, i + 1))
+            f.write('nobody,lost post,2016-01-01 10:00:00\n')
+        original = bulk_import._insert_posts
+        calls = []
+
+        def interrupted(conn, batch, nicknames):
+            calls.append(batch)
+            if len(calls) == 2:
+                raise RuntimeError('interrupted')
+            return original(conn, batch, nicknames)
+        bulk_import._insert_posts = interrupted
+        try:
+            with self.assertRaises(RuntimeError):
+                bulk_import.import_file('posts', posts, batch_size=2, batches_per_commit=1)
+        finally:
+            bulk_import._insert_posts = original
+        assert Post.query.count() == 2
+        assert ImportProgress.query.get('posts:' + posts).position == 2
+        db.session.remove()
+        assert bulk_import.import_file('posts', posts, batch_size=2) == {'read': 6, 'inserted': 5, 'skipped': 1, 'invalid': 0}
+        assert Post.query.count() == 5
+        assert FeedEntry.query.filter_by(user_id=john_id).count() == 5
+        assert FeedEntry.query.filter_by(user_id=susan_id).count() == 5
+        assert User.query.get(john_id).post_count == 5
+        page = timeline.home_timeline(susan_id, 10)
+        assert [p.body for p in page.items] == ['post 4', 'post 3', 'post 2', 'post 1', 'post 0']
+
+    @committing
+    def test_bulk_import_fan_out_on_read(self):
+        app.config['FEED_FANOUT_MAX_POSTS_PER_HOUR'] = 2
+        tmpdir = tempfile.mkdtemp()
+        try:
+            john = User(nickname='john', email='john@example.com')
+            susan = User(nickname='susan', email='susan@example.com')
+            db.session.add_all([john, susan])
+            db.session.commit()
+            john_id, susan_id = john.id, susan.id
+            timeline.follow(susan_id, john_id)
+            db.session.commit()
+            posts = os.path.join(tmpdir, 'posts.csv')
+            with open(posts, 'w') as f:
+                f.write('nickname,body,timestamp\n')
+                for i in range(4):
+                    f.write('john,post %d,2016-01-01 10:0%d:00\n' % (i, i))
+                f.write('susan,hello,2016-01-01 09:00:00\n')
+            assert bulk_import.import_file('posts', posts)['inserted'] == 5
+            db.session.remove()
+            assert User.query.get(john_id).fanout_on_read and not User.query.get(susan_id).fanout_on_read
+            assert FeedEntry.query.filter_by(user_id=john_id).count() == 4
+            assert FeedEntry.query.filter_by(user_id=susan_id).count() == 1
+            assert [p.body for p in timeline.home_timeline(susan_id, 10).items] == \
+                ['post 3', 'post 2', 'post 1', 'post 0', 'hello']
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @committing
+    def test_bulk_import_skips_invalid_records(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            users = os.path.join(tmpdir, 'users.jsonl')
+            with open(users, 'w') as f:
+                f.write(json.dumps({'nickname': 'john'}) + '\n')
+                f.write('{"nickname": "broken"\n')
+                f.write('\n')
+                f.write(json.dumps({'nickname': 'susan', 'last_seen': 'yesterday'}) + '\n')
+                f.write(json.dumps(['mary']) + '\n')
+                f.write(json.dumps({'nickname': 'mary'}) + '\n')
+            with self.assertLogs(app.logger, 'WARNING') as logs:
+                stats = bulk_import.import_file('users', users, batch_size=2)
+            assert stats == {'read': 5, 'inserted': 2, 'skipped': 0, 'invalid': 3}
+            assert len(logs.output) == 3
+            for number, message in zip((2, 4, 5), logs.output):
+                assert '%s line %d: ' % (users, number) in message
+            assert sorted(u.nickname for u in User.query) == ['john', 'mary']
+            assert ImportProgress.query.get('users:' + users).invalid == 3
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @committing
+    def test_bulk_import_alongside_the_app(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            john = User(nickname='john', email='john@example.com')
+            db.session.add(john)
+            db.session.commit()
+            john_id = john.id
+            posts = os.path.join(tmpdir, 'posts.csv')
+            with open(posts, 'w') as f:
+                f.write('nickname,body,timestamp\n')
+                for i in range(4):
+                    f.write('john,imported %d,2016-01-01 10:0%d:00\n' % (i, i))
+            original = bulk_import._insert_posts
+
+            def alongside(conn, batch, nicknames):
+                timeline.publish(john_id, 'written by the app')
+                db.session.commit()
+                return original(conn, batch, nicknames)
+            bulk_import._insert_posts = alongside
+            try:
+                assert bulk_import.import_file('posts', posts, batch_size=2, batches_per_commit=1)['inserted'] == 4
+            finally:
+                bulk_import._insert_posts = original
+            db.session.remove()
+            assert Post.query.count() == 6 and User.query.get(john_id).post_count == 6
+            assert FeedEntry.query.filter_by(user_id=john_id).count() == 6
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_export_posts(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        start = datetime(2016, 1, 1)
+        for i in range(7):
+            db.session.add(Post(body='post, "%d"' % i, timestamp=start + timedelta(minutes=i // 2), author=u))
+        db.session.commit()
+        self.login(u)
+        app.config['EXPORT_CHUNK_SIZE'] = 3
+        try:
+            with querycount.count_queries() as statements:
+                response = self.app.get('/export/posts.ndjson')
+                lines = response.get_data(as_text=True).splitlines()
+            assert len([s for s in statements if 'FROM post' in s]) == 3
+            assert response.mimetype == 'application/x-ndjson'
+            assert [json.loads(line)['body'] for line in lines] == ['post, "%d"' % i for i in reversed(range(7))]
+            assert json.loads(lines[-1])['timestamp'] == '2016-01-01T00:00:00'
+            response = self.app.get('/export/posts.csv', headers={'Accept-Encoding': 'gzip'})
+            assert response.headers['Content-Encoding'] == 'gzip'
+            rows = list(csv.reader(io.StringIO(gzip.decompress(response.get_data()).decode('utf-8'))))
+            assert rows[0] == ['id', 'timestamp', 'body']
+            assert [row[2] for row in rows[1:]] == ['post, "%d"' % i for i in reversed(range(7))]
+            assert self.app.get('/export/posts.xml').status_code == 404
+        finally:
+            app.config['EXPORT_CHUNK_SIZE'] = 1000
+
+    def test_compression(self):
+        john = User(nickname='john', email='john@example.com', about_me='about john ' * 100)
+        db.session.add(john)
+        db.session.commit()
+        self.login(john)
+        plain = self.app.get('/user/john')
+        assert 'Content-Encoding' not in plain.headers and 'Accept-Encoding' in plain.headers['Vary']
+        rv = self.app.get('/user/john', headers={'Accept-Encoding': 'br;q=0.5, gzip'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(rv.get_data()) == plain.get_data()
+        assert rv.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'
+        rv = self.app.get('/user/john', headers={'Accept-Encoding': 'gzip', 'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 304
+        # small bodies are not worth it
+        rv = self.app.get('/autocomplete/nicknames?q=jo', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in rv.headers
+
+    def test_search(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        now = datetime.utcnow()
+        bodies = ['apple pie', 'apple apple apple', 'banana split', 'an apple a day keeps the doctor away', 'NOT "quoted"']
+        posts = [Post(body=body, timestamp=now, author=u) for body in bodies]
+        db.session.add_all(posts)
+        db.session.commit()
+        assert [p.body for p in search_posts('apple', 10)] == ['apple apple apple', 'apple pie',
+                                                               'an apple a day keeps the doctor away']
+        assert [p.body for p in search_posts('apple day', 10)] == ['an apple a day keeps the doctor away']
+        assert [p.body for p in search_posts('NOT "quoted', 10)] == ['NOT "quoted"']
+        assert match_query('a "b') == '"a" """b"'
+        seen = []
+        cursor = None
+        while True:
+            page = search_posts('apple', 1, cursor)
+            seen.extend(p.body for p in page)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        assert seen == ['apple apple apple', 'apple pie', 'an apple a day keeps the doctor away']
+        posts[0].body = 'cherry pie'
+        db.session.delete(posts[1])
+        db.session.commit()
+        assert [p.body for p in search_posts('apple', 10)] == ['an apple a day keeps the doctor away']
+        assert [p.body for p in search_posts('cherry', 10)] == ['cherry pie']
+        rebuild()
+        db.session.commit()
+        assert len(search_posts('pie', 10)) == 1
+        self.login(u)
+        response = self.app.post('/search', data={'search': 'banana'})
+        assert response.status_code == 302 and response.location.endswith('/search_results?q=banana')
+        assert 'banana split' in self.app.get('/search_results?q=banana').get_data(as_text=True)
+
+    def test_search_with_a_slash(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.add(Post(body='either and/or neither', timestamp=datetime.utcnow(), author=u))
+        db.session.commit()
+        self.login(u)
+        response = self.app.post('/search', data={'search': 'and/or'})
+        assert response.status_code == 302
+        rv = self.app.get(response.location)
+        assert rv.status_code == 200 and 'either and/or neither' in rv.get_data(as_text=True)
+
+    @committing
+    def test_chunked_backfill(self):
+        for i in range(10):
+            db.session.add(User(nickname='user%d' % i, email='user%d@example.com' % i))
+        db.session.commit()
+        db.session.execute('DELETE FROM user WHERE id IN (3, 4, 5)')
+        db.session.commit()
+        users = User.__table__
+        ranges = []
+
+        def fill(conn, first_id, last_id):
+            ranges.append((first_id, last_id))
+            if len(ranges) == 2:
+                raise RuntimeError('interrupted')
+            conn.execute(users.update().where(users.c.id.between(first_id, last_id)).values(about_me='filled'))
+
+        try:
+            assert column_exists(db.engine, 'user', 'about_me')
+            assert not column_exists(db.engine, 'user', 'missing')
+            with self.assertRaises(RuntimeError):
+                backfill(db.engine, 'test', users, fill, batch_size=3, pause=0)
+            assert tuple(progress(db.engine, 'test')) == (6, 1, False)
+            assert backfill(db.engine, 'test', users, fill, batch_size=3, pause=0) == 2
+            assert ranges == [(1, 6), (7, 9), (7, 9), (10, 10)]
+            assert User.query.filter(User.about_me == 'filled').count() == 7
+            assert tuple(progress(db.engine, 'test')) == (10, 3, True)
+            assert backfill(db.engine, 'test', users, fill, batch_size=3, pause=0) == 0
+        finally:
+            db.session.remove()
+            backfill_progress.drop(db.engine, checkfirst=True)
+
+    def make_log_pipeline(self, name, **config):
+        other = Flask(__name__)
+        other.config.update(config)
+        logger = logging.getLogger(name)
+        logger.propagate = False
+        pipeline = LogPipeline()
+        pipeline.init_app(other, logger=logger)
+        self.addCleanup(logger.removeHandler, pipeline.queue_handler)
+        return pipeline, logger
+
+    def test_log_pipeline_sends_one_digest(self):
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPHandler)
+        server.messages = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            pipeline, logger = self.make_log_pipeline('microblog.tests.digest', MAIL_SERVER='127.0.0.1',
+                                                      MAIL_PORT=server.server_address[1], ADMINS=['admin@example.com'],
+                                                      LOG_MAIL_INTERVAL=3600)
+            for i in range(5):
+                try:
+                    {}['missing']
+                except KeyError:
+                    logger.exception('request failed')
+            logger.error('something else')
+            logger.info('not mailed')
+            pipeline.stop()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert len(server.messages) == 1
+        message = server.messages[0]
+        assert 'Subject: microblog failure (6 errors, 2 distinct)' in message
+        assert '5 x ' in message
+        assert 'something else' in message
+        assert 'not mailed' not in message
+        assert pipeline.stats()['mails_sent'] == 1
+
+    def test_log_pipeline_drops_when_full(self):
+        pipeline, logger = self.make_log_pipeline('microblog.tests.full', LOG_QUEUE_SIZE=1)
+        pipeline.queue_handler.on_enqueue = None
+        for i in range(3):
+            logger.warning('burst %d', i)
+        assert pipeline.dropped == 2
+        assert pipeline.queue.get_nowait().msg == 'burst 0'
+
+    def test_log_pipeline_leaves_the_record_alone(self):
+        pipeline, logger = self.make_log_pipeline('microblog.tests.copy')
+        pipeline.queue_handler.on_enqueue = None
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        try:
+            {}['missing']
+        except KeyError:
+            logger.exception('request %s failed', 'GET /')
+        queued = pipeline.queue.get_nowait()
+        assert queued.msg == 'request GET / failed' and queued.args is None and queued.exc_info is None
+        assert 'KeyError' in queued.exc_text
+        assert records[0].msg == 'request %s failed' and records[0].args == ('GET /',) and records[0].exc_info[0] is KeyError
+
+    def check_openid_store(self, store):
+        now = int(time.time())
+        assert store.useNonce('http://openid.example.com/', now, 'salt')
+        assert not store.useNonce('http://openid.example.com/', now, 'salt')
+        assert not store.useNonce('http://openid.example.com/', now - nonce.SKEW - 10, 'old')
+        store.storeAssociation('http://openid.example.com/', Association('old', b'secret', now - 100, 50, 'HMAC-SHA1'))
+        store.storeAssociation('http://openid.example.com/', Association('new', b'secret', now, 600, 'HMAC-SHA1'))
+        assert store.getAssociation('http://openid.example.com/').handle == 'new'
+        assert store.getAssociation('http://openid.example.com/', 'old') is None
+        assert store.getAssociation('http://openid.example.com/', 'new').secret == b'secret'
+        assert store.removeAssociation('http://openid.example.com/', 'new')
+        assert store.getAssociation('http://openid.example.com/') is None
+
+    @committing
+    def test_openid_store(self):
+        # the application uses the SQL store of config.py
+        assert isinstance(oid.store_factory(), SQLStore)
+        self.check_openid_store(oid.store_factory())
+        # the in-memory store behaves the same, and deletes expired nonces in batches as logins come in
+        other = Flask(__name__)
+        other.config.update(OPENID_STORE='memory', OPENID_STORE_CLEANUP_BATCH=2, OPENID_STORE_CLEANUP_INTERVAL=3600)
+        OpenIDStores(other)
+        store = other.extensions['openid_store']
+        self.check_openid_store(store)
+        engine = store.get_engine()
+        old = int(time.time()) - nonce.SKEW - 10
+        engine.execute(openid_nonces.insert(), [{'server_url': 'x', 'timestamp': old, 'salt': str(i)} for i in range(5)])
+        count = lambda: engine.execute(select([func.count()]).select_from(openid_nonces)).scalar()
+        store._next_cleanup = 0
+        store.getAssociation('x')
+        assert count() == 4  # the salt nonce is still valid, two old ones were deleted
+        store.getAssociation('x')
+        store.getAssociation('x')
+        assert count() == 1
+        store.getAssociation('x')
+        assert count() == 1 and store._next_cleanup > time.time()
 
 if __name__ == '__main__':
     unittest.main()